@@ -0,0 +1,117 @@
+#  -*- coding: utf-8 -*-
+"""
+Compares the thread-per-connection HTTPServer with the same server running on an EventLoop:
+the memory used by idle connections and the requests per second over all of them.
+
+Usage: python benchmark_event_loop.py [--connections 10000] [--rounds 5] [--mode both|loop|thread]
+
+Every mode runs in a fresh process, so the memory numbers don't affect each other. 10k connections
+need about 20k file descriptors (the clients live in the same process), the soft limit is raised
+up to the hard one if possible.
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+import argparse
+import selectors
+import socket
+import subprocess
+import sys
+import time
+from threading import Thread
+
+from kutil import HTTPServer, HTTPServerConnection, EventLoop
+from kutil.protocol.HTTP import HTTPRequest, HTTPResponse, HTTPHeaders
+
+REQUEST: bytes = b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+BODY: bytes = b'Hello world'
+
+
+def rssKB() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource  # The peak, not the current value, but better than nothing
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def raiseFileLimit(wanted: int) -> None:
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        limit: int = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+
+
+def onData(conn: HTTPServerConnection, req: HTTPRequest):
+    conn.sendData(HTTPResponse(200, "OK", HTTPHeaders(), BODY))
+
+
+def startServer(mode: str) -> tuple[str, int]:
+    server: HTTPServer = HTTPServer(("127.0.0.1", 0), lambda conn: onData)
+    if mode == "loop":
+        loop: EventLoop = EventLoop()
+        loop.start()
+        server.listen(eventLoop=loop)
+    else:
+        Thread(target=server.listen, daemon=True).start()
+    return server.sock.getsockname()
+
+
+def runRounds(clients: list[socket.socket], rounds: int) -> float:
+    """Sends one request on every connection and waits for all the responses, `rounds` times"""
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        client.setblocking(False)
+        selector.register(client, selectors.EVENT_READ)
+    start: float = time.perf_counter()
+    for _ in range(rounds):
+        for client in clients:
+            client.sendall(REQUEST)
+        waiting: int = len(clients)
+        while waiting > 0:
+            for key, _ in selector.select():
+                data: bytes = key.fileobj.recv(65536)
+                if not data:
+                    raise ConnectionError("The server closed a connection")
+                waiting -= data.count(BODY)
+    elapsed: float = time.perf_counter() - start
+    selector.close()
+    return len(clients) * rounds / elapsed
+
+
+def benchmark(mode: str, connections: int, rounds: int) -> None:
+    raiseFileLimit(2 * connections + 100)
+    address: tuple[str, int] = startServer(mode)
+    time.sleep(.1)
+    before: int = rssKB()
+    clients: list[socket.socket] = []
+    for _ in range(connections):
+        clients.append(socket.create_connection(address))
+    time.sleep(1)  # Let the server accept everything
+    idle: int = rssKB() - before
+    print(f"{mode:>6}: {connections} idle connections use {idle / 1024:.1f} MB "
+          f"({idle * 1024 / connections:.0f} B each, clients included)")
+    print(f"{mode:>6}: {runRounds(clients, rounds):.0f} requests per second")
+    for client in clients:
+        client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--mode", choices=("both", "loop", "thread"), default="both")
+    args = parser.parse_args()
+    if args.mode == "both":
+        for mode in ("loop", "thread"):
+            subprocess.run([sys.executable, __file__, "--connections", str(args.connections),
+                            "--rounds", str(args.rounds), "--mode", mode])
+    else:
+        benchmark(args.mode, args.connections, args.rounds)
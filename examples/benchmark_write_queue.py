@@ -0,0 +1,88 @@
+#  -*- coding: utf-8 -*-
+"""
+Measures how many small messages per second a ProtocolConnection sends over a loopback TCP
+connection, one syscall per message versus coalesced by cork()/uncork().
+
+Usage: python benchmark_write_queue.py [--messages 200000] [--size 64] [--batch 100]
+
+The batch is how many messages are sent between cork() and uncork(), e.g., one broadcast.
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+import argparse
+import socket
+import time
+from threading import Thread
+
+from kutil import ProtocolConnection, ByteBuffer
+from kutil.protocol.AbstractProtocol import AbstractProtocol
+from kutil.protocol.TCPConnection import TCPProtocol
+from kutil.typing_help import neverCall
+
+
+class LineProtocol(AbstractProtocol):
+    """Newline-terminated messages, only the sending side is needed here"""
+    name = "LineProtocol"
+
+    def unpackData(self, buff: ByteBuffer) -> bytes:
+        raise NotImplementedError
+
+    def unpackSubProtocol(self, buff: ByteBuffer) -> ByteBuffer:
+        raise NotImplementedError
+
+    def packData(self, data: bytes, buff: ByteBuffer):
+        buff.write(data)
+        buff.write(b'\n')
+
+    def packSubProtocol(self, buff: ByteBuffer):
+        pass
+
+
+def drain(sock: socket.socket, expected: int) -> None:
+    """Receives until all the messages arrived"""
+    received: int = 0
+    while received < expected:
+        data: bytes = sock.recv(1024 * 1024)
+        if not data:
+            raise ConnectionError("The sender closed the connection")
+        received += data.count(b'\n')
+
+
+def benchmark(corked: bool, messages: int, size: int, batch: int) -> float:
+    listener: socket.socket = socket.create_server(("127.0.0.1", 0))
+    client: socket.socket = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    conn: ProtocolConnection = ProtocolConnection(("", 0), [], neverCall, server)
+    conn.addProtocol(TCPProtocol(conn))
+    conn.addProtocol(LineProtocol(conn))
+
+    message: bytes = b'x' * (size - 1)
+    reader: Thread = Thread(target=drain, args=(client, messages))
+    reader.start()
+    start: float = time.perf_counter()
+    for first in range(0, messages, batch):
+        if corked:
+            conn.cork()
+        for _ in range(min(batch, messages - first)):
+            conn.sendData(message)
+        if corked:
+            conn.uncork()
+    reader.join()
+    elapsed: float = time.perf_counter() - start
+    if corked:
+        print(f"  queue high-water mark: {conn.queueHighWater} B")
+    conn.close()
+    client.close()
+    return messages / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--batch", type=int, default=100)
+    args = parser.parse_args()
+    for corked in (False, True):
+        rate: float = benchmark(corked, args.messages, args.size, args.batch)
+        print(f"{'corked' if corked else 'direct':>6}: {rate:.0f} messages per second")
@@ -0,0 +1,57 @@
+#  -*- coding: utf-8 -*-
+"""
+Measures the WebSocket payload (un)masking throughput, the old byte-by-byte loop versus maskData(),
+which XORs the whole payload as one big integer, and maskInPlace(), which XORs a bytearray chunk by
+chunk.
+
+Usage: python benchmark_ws_mask.py [--sizes 1024 65536 16777216] [--seconds 1]
+
+The loop is skipped for the payloads bigger than --loop-limit, it takes seconds per 16 MB frame.
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+import argparse
+import os
+import time
+from typing import Callable
+
+from kutil.protocol.WS import maskData, maskInPlace
+
+MASKING_KEY: bytes = b'\x37\xfa\x21\x3d'
+
+
+def maskLoop(data: bytes, maskingKey: bytes) -> bytes:
+    """How WSData.mask used to do it"""
+    masked: bytearray = bytearray(data)
+    for i, byte in enumerate(data):
+        masked[i] = byte ^ maskingKey[i % 4]
+    return bytes(masked)
+
+
+def benchmark(mask: Callable[[bytes, bytes], bytes], data: bytes, seconds: float) -> float:
+    """Returns the throughput in MB/s"""
+    rounds: int = 0
+    start: float = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < seconds or rounds == 0:
+        mask(data, MASKING_KEY)
+        rounds += 1
+    return rounds * len(data) / elapsed / 1024 / 1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 64 * 1024, 16 * 1024 * 1024])
+    parser.add_argument("--seconds", type=float, default=1)
+    parser.add_argument("--loop-limit", type=int, default=1024 * 1024)
+    args = parser.parse_args()
+    for size in args.sizes:
+        payload: bytes = os.urandom(size)
+        assert maskData(payload[:4096], MASKING_KEY) == maskLoop(payload[:4096], MASKING_KEY)
+        fast: float = benchmark(maskData, payload, args.seconds)
+        inPlace: float = benchmark(lambda data, key: maskInPlace(data, key), bytearray(payload),
+                                   args.seconds)
+        line: str = f"{size:>10} B: maskData {fast:10.1f} MB/s, maskInPlace {inPlace:10.1f} MB/s"
+        if size <= args.loop_limit:
+            slow: float = benchmark(maskLoop, payload, args.seconds)
+            line += f", loop {slow:8.1f} MB/s ({fast / slow:.0f}x)"
+        print(line)
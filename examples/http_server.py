@@ -11,17 +11,19 @@ from kutil.buffer.MemoryByteBuffer import MemoryByteBuffer
 
 from kutil.io.file import bCRLF
 
-from kutil.protocol.HTTP import HTTPRequest, HTTPResponse, HTTPHeaders, HTTPThing
+from kutil.protocol.HTTP import (HTTPRequest, HTTPResponse, HTTPHeaders, HTTPThing,
+                                 StaticFileHandler)
 from kutil.protocol.WS import WSData
 from kutil.protocol.SSE import SSEMessage
-from kutil import HTTPServer, HTTPServerConnection, ProtocolConnection, readFile, ThreadWaiter
+from kutil import (HTTPServer, HTTPServerConnection, ProtocolConnection, ThreadWaiter,
+                   SlowConsumerPolicy)
 
 index_page = b"""<h1>HTTP server test</h1>
-<a href="/test-ws">Test websocket (WS)</a><br>
-<a href="/test-sse">Test server sent events (SSE)</a><br>
+<a href="/static/websocket_server.html">Test websocket (WS)</a><br>
+<a href="/static/sse_server.html">Test server sent events (SSE)</a><br>
 <a href="/big-file" download="big-file.txt">Download a big file</a>"""
-ws_test_page = readFile("websocket_server.html", "bytes")
-sse_test_page = readFile("sse_server.html", "bytes")
+# The test pages (and the other files of this directory), cached in memory, with ETags and ranges
+static: StaticFileHandler = StaticFileHandler(".", "/static/")
 
 sse_conns: list[HTTPServerConnection] = []
 sse_thread_waiter: ThreadWaiter = ThreadWaiter()
@@ -73,10 +75,8 @@ def onData(conn: HTTPServerConnection, data: HTTPRequest | WSData | SSEMessage):
         resp = HTTPResponse(405, "Method not Allowed", HTTPHeaders(), b'This is for websocket.')
     elif req.requestURI == "/sse":
         resp = HTTPResponse(405, "Method not Allowed", HTTPHeaders(), b'This is for SSE.')
-    elif req.requestURI == "/test-ws":
-        resp.body = ws_test_page
-    elif req.requestURI == "/test-sse":
-        resp.body = sse_test_page
+    elif static.handles(req):
+        resp = static.respond(req)
     elif req.requestURI == "/big-file":
         resp.headers["Content-Type"] = "text/plain"
         # Roughly 42 MB * 100 = 4.2 GB
@@ -99,6 +99,8 @@ def onWebsocketEstablishment(conn: HTTPServerConnection, req: HTTPRequest):
 def onSSEEstablishment(conn: HTTPServerConnection, req: HTTPRequest):
     assert conn.didUpgradeToSSE
     # print("SSE open")
+    # Only the latest time matters, a slow client mustn't block the updates of the others
+    conn.slowConsumerPolicy = SlowConsumerPolicy.DROP_OLDEST
     sse_conns.append(conn)
     sse_thread_waiter.reset()
 
@@ -93,7 +93,7 @@ class AppendedByteBuffer(ByteBuffer[TInnerBuffers]):
         assert last is not None
         return last.readLastByte()
 
-    def index(self, seq: bytes) -> int:
+    def index(self, seq: bytes, start: int = 0) -> int:
         self.assertNotDestroyed()
         from kutil.io.native_io_wrapper import UnsupportedOperation
         raise UnsupportedOperation(
@@ -246,6 +246,28 @@ class AppendedByteBuffer(ByteBuffer[TInnerBuffers]):
         except StopIteration:
             return buffer, i
 
+    def segments(self) -> Iterator[tuple[ByteBuffer, int, int]]:
+        """
+        Iterates over the parts of the underlying buffers that are left to read,
+        ignoring and not mutating the pointer.
+        :return: The iterator of (buffer, offset in the buffer, length)
+        """
+        self.assertNotDestroyed()
+        return self._segmentsFrom(self._pointer)
+
+    def _segmentsFrom(self, position: int) -> Iterator[tuple[ByteBuffer, int, int]]:
+        """The parts from the position on, the nested AppendedByteBuffers are flattened"""
+        start: int = 0
+        for buffer in self.__iterate_buffers():
+            length: int = buffer.fullLength()
+            if start + length > position:
+                offset: int = max(0, position - start)
+                if isinstance(buffer, AppendedByteBuffer):
+                    yield from buffer._segmentsFrom(offset)
+                else:
+                    yield buffer, offset, length - offset
+            start += length
+
     @property
     def buffers(self) -> list[ByteBuffer]:
         self.assertNotDestroyed()
@@ -119,10 +119,12 @@ class ByteBuffer[TData: Any](ByteBufferLike, ABC):
         return data
 
     @abstractmethod
-    def index(self, seq: bytes) -> int:
+    def index(self, seq: bytes, start: int = 0) -> int:
         """
         Returns the index of the first byte in seq within the buffer from the pointer.
         :param seq: The bytes to find the index of.
+        :param start: Where to start searching, relative to the pointer (useful when resuming
+         a search after more data was written)
         :return: The index of the first byte in seq within the buffer from the pointer
         :exception IndexError: If the sequence is not found
         """
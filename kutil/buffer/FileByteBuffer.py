@@ -1,6 +1,8 @@
 #  -*- coding: utf-8 -*-
 __author__ = "Jakub Augustýn <kubik.augustyn@post.cz>"
 
+import errno
+import os
 from typing import Iterable, Self, Optional, BinaryIO, Iterator, Never, Final
 
 from kutil.buffer.ByteBuffer import ByteBuffer, OutOfBoundsReadError, bCRLF
@@ -10,6 +12,7 @@ class FileByteBuffer(ByteBuffer[BinaryIO]):
     MAX_SAFE_INSERT: Final[int] = 1024 * 1024 * 1024 * 8  # 8 GB
 
     _data: BinaryIO
+    fileOffset: int = 0  # Where the buffer's content starts in the file, see FileRegionByteBuffer
 
     def __init__(self, file: BinaryIO | None):
         """
@@ -56,14 +59,21 @@ class FileByteBuffer(ByteBuffer[BinaryIO]):
             raise ValueError("Cannot read a negative amount of bytes")
         return bytearray(self._readInner(amount=amount))
 
-    def index(self, seq: bytes) -> int:
+    def index(self, seq: bytes, start: int = 0) -> int:
         self.assertNotDestroyed()
         self.assertHas(len(seq))
 
-        for ptr, i in enumerate(range(self.leftLength() - len(seq) + 1), start=self._pointer):
-            part: bytes = self._readInnerWithoutPointer(pointer=ptr, amount=len(seq))
-            if part == seq:
-                return i
+        # Search block by block, the blocks overlap so the sequence can't be split between them
+        blockSize: int = max(64 * 1024, 2 * len(seq))
+        position: int = self._pointer + start
+        end: int = self.fullLength()
+        while position + len(seq) <= end:
+            block: bytes = self._readInnerWithoutPointer(pointer=position,
+                                                         amount=min(blockSize, end - position))
+            i: int = block.find(seq)
+            if i != -1:
+                return position + i - self._pointer
+            position += len(block) - len(seq) + 1
         raise IndexError
 
     def fullLength(self) -> int:
@@ -256,9 +266,13 @@ class FileByteBuffer(ByteBuffer[BinaryIO]):
         """
         self.assertNotDestroyed()
 
+        other.reset()  # Clear the other buffer
+        if self._copyIntoKernel(other):
+            other._pointer = self._pointer
+            return self
+
         # Copy the data 10MB at a time
         self._syncPointer(0)
-        other.reset()  # Clear the other buffer
         other._syncPointer(0)
         while True:
             chunk = self._data.read(1024 * 1024 * 10)
@@ -269,6 +283,73 @@ class FileByteBuffer(ByteBuffer[BinaryIO]):
         other._pointer = self._pointer
         return self
 
+    def _copyIntoKernel(self, other: Self) -> bool:
+        """
+        Copies the whole file into the other (already cleared) FileByteBuffer inside the kernel
+        using ``os.copy_file_range`` or ``os.sendfile``, so the data never passes through Python.
+
+        This is only possible if both buffers wrap real files (e.g., not a BytesIO).
+
+        :param other: The buffer to copy into
+        :return: Whether the data was copied. If False, nothing was copied.
+        """
+        from kutil.io.native_io_wrapper import UnsupportedOperation, SEEK_END
+        try:
+            srcFd: int = self._data.fileno()
+            dstFd: int = other._data.fileno()
+        except (UnsupportedOperation, AttributeError, OSError):
+            return False
+
+        size: int = self.fullLength()
+        # Make sure the kernel sees everything Python may still have buffered
+        if self._data.writable():
+            self._data.flush()
+        other._syncPointer(0)
+        other._data.flush()
+
+        copied: int = 0
+        useSendfile: bool = not hasattr(os, "copy_file_range")
+        while copied < size:
+            try:
+                if useSendfile:
+                    # Writes at (and advances) the destination's file offset, which is at 0
+                    amount: int = os.sendfile(dstFd, srcFd, copied, size - copied)
+                else:
+                    amount: int = os.copy_file_range(srcFd, dstFd, size - copied, copied, copied)
+            except AttributeError:  # os.sendfile() is not available either
+                return False
+            except OSError as e:
+                if copied != 0 or e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                                                  errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                if useSendfile:
+                    return False  # Neither of the syscalls supports these files
+                useSendfile = True  # E.g., copy_file_range() across file systems on old kernels
+                continue
+            if amount == 0:
+                break  # The source file got truncated meanwhile
+            copied += amount
+
+        # Python's cached file position is stale now, force it to re-sync
+        other._data.seek(0, SEEK_END)
+        return True
+
+    def fileno(self) -> Optional[int]:
+        """
+        Returns the file descriptor of the underlying file, flushing what Python buffered so the
+        kernel sees the whole content (e.g., for ``os.sendfile``).
+        :return: The file descriptor, None if the buffer doesn't wrap a real file (e.g., a BytesIO)
+        """
+        self.assertNotDestroyed()
+        from kutil.io.native_io_wrapper import UnsupportedOperation
+        try:
+            fd: int = self._data.fileno()
+        except (UnsupportedOperation, AttributeError, OSError):
+            return None
+        if self._data.writable():
+            self._data.flush()
+        return fd
+
     def _destroyInner(self) -> None:
         if not self._data.closed:
             self._data.close()
@@ -284,4 +365,68 @@ class FileByteBuffer(ByteBuffer[BinaryIO]):
         return iter(self.export())  # A lazy solution to re-use code
 
 
-__all__ = ["FileByteBuffer"]
+class FileRegionByteBuffer(FileByteBuffer):
+    """
+    A read-only part of a file, e.g., a requested range of a file sent by ``os.sendfile``.
+    The buffer's pointer 0 is the part's start, it closes the file when destroyed.
+    """
+    _length: int
+
+    def __init__(self, file: BinaryIO, offset: int, length: int):
+        """
+        Creates a FileRegionByteBuffer by an open binary file handle.
+        :param file: The open binary file handle
+        :param offset: Where the part starts in the file
+        :param length: The part's length, the file mustn't be shorter than offset + length
+        """
+        assert offset >= 0 and length >= 0
+        super(FileRegionByteBuffer, self).__init__(file)
+        self.fileOffset = offset
+        self._length = length
+
+    def _readInnerWithoutPointer(self, *, pointer: int, amount: int) -> bytes:
+        if pointer == -1:
+            pointer = self._length - amount
+        if pointer < 0 or pointer + amount > self._length:
+            raise OutOfBoundsReadError(f"Not enough bytes (reading {amount} at {pointer}, but the "
+                                       f"region is {self._length} bytes long)")
+        return super()._readInnerWithoutPointer(pointer=self.fileOffset + pointer, amount=amount)
+
+    def fullLength(self) -> int:
+        self.assertNotDestroyed()
+        return self._length
+
+    def readRest(self) -> bytearray:
+        self.assertNotDestroyed()
+        return self.read(self.leftLength())
+
+    def _writeInternal(self, *, data: Iterable[int], i: int = -1) -> None:
+        self.assertCanWrite()
+
+    def reset(self, data: Optional[Iterable[int]] = None) -> Self:
+        self.assertCanWrite()
+        return self
+
+    def resetBeforePointer(self) -> Self:
+        self.assertCanWrite()
+        return self
+
+    def assertCanWrite(self) -> None:
+        self.assertNotDestroyed()
+        from kutil.io.native_io_wrapper import UnsupportedOperation
+        raise UnsupportedOperation("Cannot write to a FileRegionByteBuffer")
+
+    def copyInto(self, other: FileByteBuffer) -> Self:
+        self.assertNotDestroyed()
+        other.reset(self.export())  # Only the region, not the whole file
+        other._pointer = self._pointer
+        return self
+
+    def __repr__(self) -> str:
+        self.assertNotDestroyed()
+        return (f"FileRegionByteBuffer(offset={self.fileOffset}, length={self._length}, "
+                f"bytes_left={self.leftLength()}, pointer={self._pointer}, "
+                f"file={repr(self._data)})")
+
+
+__all__ = ["FileByteBuffer", "FileRegionByteBuffer"]
@@ -36,13 +36,13 @@ class MemoryByteBuffer(ByteBuffer[bytearray]):
         self._pointer += amount
         return self._data[self._pointer - amount:self._pointer]
 
-    def index(self, seq: bytes) -> int:
+    def index(self, seq: bytes, start: int = 0) -> int:
         self.assertNotDestroyed()
         self.assertHas(len(seq))
-        for i in range(self.leftLength() - len(seq) + 1):
-            if self._data[self._pointer + i:self._pointer + i + len(seq)] == seq:
-                return i
-        raise IndexError
+        i: int = self._data.find(seq, self._pointer + start)
+        if i == -1:
+            raise IndexError
+        return i - self._pointer
 
     def fullLength(self) -> int:
         self.assertNotDestroyed()
@@ -88,7 +88,7 @@ class MemoryByteBuffer(ByteBuffer[bytearray]):
 
     def resetBeforePointer(self) -> Self:
         self.assertNotDestroyed()
-        self._data = self._data[self._pointer:]
+        del self._data[:self._pointer]  # Cheap, bytearray only moves its start
         self.resetPointer()
         return self
 
@@ -128,5 +128,18 @@ class MemoryByteBuffer(ByteBuffer[bytearray]):
         self.assertNotDestroyed()
         return iter(self._data)
 
+    # Type-specific methods
+    def view(self, start: int = 0, amount: Optional[int] = None) -> memoryview:
+        """
+        Returns a read-only view of the buffer's data (not a copy), ignoring the pointer.
+        The buffer can't be resized (or destroyed) until the view is released.
+        :param start: Where the view starts
+        :param amount: The view's length, None for the rest of the buffer
+        :return: The view
+        """
+        self.assertNotDestroyed()
+        end: int = len(self._data) if amount is None else start + amount
+        return memoryview(self._data)[start:end].toreadonly()
+
 
 __all__ = ["MemoryByteBuffer"]
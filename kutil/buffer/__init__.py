@@ -3,7 +3,7 @@ __author__ = "kubik.augustyn@post.cz"
 
 from kutil.buffer.ByteBuffer import ByteBuffer
 from kutil.buffer.MemoryByteBuffer import MemoryByteBuffer
-from kutil.buffer.FileByteBuffer import FileByteBuffer
+from kutil.buffer.FileByteBuffer import FileByteBuffer, FileRegionByteBuffer
 from kutil.buffer.AppendedByteBuffer import AppendedByteBuffer
 from kutil.buffer.DataBuffer import DataBuffer
 from kutil.buffer.BidirectionalByteArray import BidirectionalByteArray
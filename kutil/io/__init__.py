@@ -1,6 +1,7 @@
 #  -*- coding: utf-8 -*-
 __author__ = "kubik.augustyn@post.cz"
 
-from kutil.io.file import writeFile, readFile, NL, bNL, getFileExtension, \
-    splitFileExtension, getFileName
-from kutil.io.directory import enumFiles, enumDirs, getDirParent, getDunderFileDir
+from kutil.io.file import writeFile, readFile, readFiles, FsyncBatcher, NL, bNL, \
+    getFileExtension, splitFileExtension, getFileName
+from kutil.io.directory import enumFiles, enumDirs, walkFiles, getDirParent, getDunderFileDir
+from kutil.io.read_cache import ReadCache
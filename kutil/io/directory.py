@@ -3,7 +3,11 @@ __author__ = "kubik.augustyn@post.cz"
 
 import os
 import warnings
-from typing import Iterator, overload, Literal
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from queue import Queue, Full
+from threading import Event, Lock
+from typing import Iterator, overload, Literal, Optional, Final
 from kutil.runtime import getVariableValueByName
 
 
@@ -61,6 +65,154 @@ def enumDirs(path: str, extendedInfo: bool) -> \
                 yield dirEntry.name, dirEntry.path
 
 
+WALK_BATCH_SIZE: Final[int] = 256  # How many files a walkFiles() worker hands over at once
+
+
+@overload
+def walkFiles(root: str, *, pattern: Optional[str] = None, minSize: Optional[int] = None,
+              maxSize: Optional[int] = None, newerThan: Optional[float] = None,
+              followSymlinks: bool = False, workers: int = 8,
+              extendedInfo: Literal[False] = False) -> Iterator[tuple[str, str]]: ...
+
+
+@overload
+def walkFiles(root: str, *, pattern: Optional[str] = None, minSize: Optional[int] = None,
+              maxSize: Optional[int] = None, newerThan: Optional[float] = None,
+              followSymlinks: bool = False, workers: int = 8,
+              extendedInfo: Literal[True]) -> Iterator[tuple[str, str, os.DirEntry]]: ...
+
+
+def walkFiles(root: str, *, pattern: Optional[str] = None, minSize: Optional[int] = None,
+              maxSize: Optional[int] = None, newerThan: Optional[float] = None,
+              followSymlinks: bool = False, workers: int = 8, extendedInfo: bool = False) -> \
+        Iterator[tuple[str, str] | tuple[str, str, os.DirEntry]]:
+    """
+    Recursively walks the directory, scanning the subdirectories concurrently on a thread pool,
+    and yields the files matching all the given filters as soon as they're found
+    (in no particular order).
+
+    The filters are applied on the os.DirEntry directly. The name pattern is checked first,
+    and the (cached) DirEntry.stat() is only called when a size or time filter is used.
+
+    :param root: Path of the directory
+    :param pattern: A shell-style pattern the file name must match (e.g., "*.png")
+    :param minSize: The minimum file size in bytes (inclusive)
+    :param maxSize: The maximum file size in bytes (inclusive)
+    :param newerThan: A timestamp the file's modification time must be newer than
+    :param followSymlinks: Whether to follow symbolic links to files and directories
+    :param workers: The maximum number of directories scanned at once
+    :param extendedInfo: Whether you want extended info about the files
+    :return: An iterator yielding a file name, file path, and (optionally, if extendedInfo=True) os.DirEntry
+    """
+    assert workers > 0
+    needsStat: bool = minSize is not None or maxSize is not None or newerThan is not None
+    results: Queue = Queue(maxsize=workers * 4)  # Batches of files, an error, or None when done
+    cancelled: Event = Event()
+    lock: Lock = Lock()
+    pendingDirs: int = 0
+    visitedDirs: set[tuple[int, int]] = set()  # Prevents symlink loops when following them
+    executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers,
+                                                      thread_name_prefix="walkFiles")
+
+    def put(item) -> None:
+        # Don't block forever if the consumer went away
+        while not cancelled.is_set():
+            try:
+                results.put(item, timeout=.1)
+                return
+            except Full:
+                continue
+
+    def matches(entry: os.DirEntry) -> bool:
+        if pattern is not None and not fnmatch(entry.name, pattern):
+            return False
+        if not needsStat:
+            return True
+        try:
+            stat: os.stat_result = entry.stat(follow_symlinks=followSymlinks)
+        except OSError:
+            return False
+        if minSize is not None and stat.st_size < minSize:
+            return False
+        if maxSize is not None and stat.st_size > maxSize:
+            return False
+        if newerThan is not None and stat.st_mtime <= newerThan:
+            return False
+        return True
+
+    def submit(path: str) -> None:
+        nonlocal pendingDirs
+        if followSymlinks:
+            try:
+                stat: os.stat_result = os.stat(path)
+            except OSError:
+                return
+            with lock:
+                if (stat.st_dev, stat.st_ino) in visitedDirs:
+                    return
+                visitedDirs.add((stat.st_dev, stat.st_ino))
+        with lock:
+            if cancelled.is_set():
+                return
+            pendingDirs += 1
+        try:
+            executor.submit(scan, path, path == root)
+        except RuntimeError:  # The executor was shut down meanwhile
+            with lock:
+                pendingDirs -= 1
+
+    def scan(path: str, isRoot: bool) -> None:
+        nonlocal pendingDirs
+        batch: list[tuple[str, str] | tuple[str, str, os.DirEntry]] = []
+        try:
+            with os.scandir(path) as iterator:
+                for dirEntry in iterator:
+                    if cancelled.is_set():
+                        return
+                    try:
+                        if dirEntry.is_dir(follow_symlinks=followSymlinks):
+                            submit(dirEntry.path)
+                            continue
+                        if not dirEntry.is_file(follow_symlinks=followSymlinks):
+                            continue
+                    except OSError:
+                        continue
+                    if not matches(dirEntry):
+                        continue
+
+                    if extendedInfo:  # Name, path, os.DirEntry
+                        batch.append((dirEntry.name, dirEntry.path, dirEntry))
+                    else:  # Name, path
+                        batch.append((dirEntry.name, dirEntry.path))
+                    if len(batch) >= WALK_BATCH_SIZE:
+                        put(batch)
+                        batch = []
+        except OSError as e:
+            if isRoot:
+                put(e)  # Let the caller know, subdirectories we can't read are skipped
+        finally:
+            if len(batch) > 0:
+                put(batch)
+            with lock:
+                pendingDirs -= 1
+                done: bool = pendingDirs == 0
+            if done:
+                put(None)
+
+    try:
+        submit(root)
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield from item
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 def getDirParent(path: str) -> str:
     """
     Gets the parent directory of a provided directory.
@@ -92,4 +244,4 @@ def getDunderFileDir(*, skipFrames: int = 0) -> str:
     return os.path.dirname(os.path.abspath(dunderFile))
 
 
-__all__ = ["enumFiles", "enumDirs", "getDirParent", "getDunderFileDir"]
+__all__ = ["enumFiles", "enumDirs", "walkFiles", "getDirParent", "getDunderFileDir"]
@@ -3,37 +3,83 @@ __author__ = "kubik.augustyn@post.cz"
 
 import json
 import os.path
+import stat
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from secrets import token_hex
+from threading import Lock
 
 from kutil.buffer.ByteBuffer import ByteBuffer
 from kutil.buffer.FileByteBuffer import FileByteBuffer
-from kutil.typing_help import FinalStr, Final, Literal, overload, BinaryIO
+from kutil.io.json_stream import JSONPath, iterJSON, iterJSONItems
+from kutil.io.read_cache import ReadCache
+from kutil.typing_help import FinalStr, Final, Literal, overload, BinaryIO, Optional, Self, \
+    Iterator, Iterable, Any
 
-type OUTPUT_STR = Literal["text", "bytes", "bytearray", "json", "buffer"]
+type OUTPUT_STR = Literal["text", "bytes", "bytearray", "json", "buffer", "jsonstream",
+                          "jsonitems"]
 type OUTPUT = str | bytes | bytearray | dict | ByteBuffer
+type READ_RESULT = tuple[str, Optional[OUTPUT], Optional[Exception]]  # Path, content, error
 
 
 # Read file
 @overload  # https://mypy.readthedocs.io/en/latest/more_types.html#function-overloading
-def readFile(path: str, output: Literal["text"], encoding: str = "utf-8") -> str: ...
+def readFile(path: str, output: Literal["text"], encoding: str = "utf-8",
+             cached: bool = False) -> str: ...
 
 
 @overload
-def readFile(path: str, output: Literal["bytes"], encoding: str = "utf-8") -> bytes: ...
+def readFile(path: str, output: Literal["bytes"], encoding: str = "utf-8",
+             cached: bool = False) -> bytes: ...
 
 
 @overload
-def readFile(path: str, output: Literal["bytearray"], encoding: str = "utf-8") -> bytearray: ...
+def readFile(path: str, output: Literal["bytearray"], encoding: str = "utf-8",
+             cached: bool = False) -> bytearray: ...
 
 
 @overload
-def readFile(path: str, output: Literal["json"], encoding: str = "utf-8") -> dict: ...
+def readFile(path: str, output: Literal["json"], encoding: str = "utf-8",
+             cached: bool = False) -> dict: ...
 
 
 @overload
 def readFile(path: str, output: Literal["buffer"], encoding: str = "utf-8") -> ByteBuffer: ...
 
 
-def readFile(path: str, output: OUTPUT_STR = "text", encoding: str = "utf-8") -> OUTPUT:
+@overload
+def readFile(path: str, output: Literal["jsonstream"],
+             encoding: str = "utf-8") -> Iterator[tuple[JSONPath, Any]]: ...
+
+
+@overload
+def readFile(path: str, output: Literal["jsonitems"], encoding: str = "utf-8") -> Iterator[Any]: ...
+
+
+def readFile(path: str, output: OUTPUT_STR = "text", encoding: str = "utf-8",
+             cached: bool = False) -> OUTPUT | Iterator:
+    """
+    Reads a file.
+    :param path: The path of the file
+    :param output: What to read the file as
+    :param encoding: The encoding of text or JSON
+    :param cached: Whether to return the content from the process-wide ReadCache if the file
+     didn't change since it was last read (only for text, bytes, bytearray and json).
+     The cached JSON objects are shared, so don't modify them.
+    :return: The file's content - jsonstream and jsonitems return an iterator opening the file on
+     its first next() (so an error, e.g., FileNotFoundError, is raised from it)
+    """
+    if cached:
+        if output not in ("text", "bytes", "bytearray", "json"):
+            raise ValueError(f"Cannot cache the {output} output kind.")
+        if output == "bytearray":  # Don't share a mutable object
+            return bytearray(ReadCache().get(path, "bytes", encoding,
+                                             lambda: readFile(path, "bytes")))
+        return ReadCache().get(path, output, encoding, lambda: readFile(path, output, encoding))
+
+    if output in ("jsonstream", "jsonitems"):
+        return _iterJSONFile(path, output, encoding)  # Opens the file once iterated, not to leak it
+
     f: BinaryIO | None = None
     try:
         f = open(path, "rb")
@@ -64,22 +110,220 @@ def readFile(path: str, output: OUTPUT_STR = "text", encoding: str = "utf-8") ->
             f.close()
 
 
+def _iterJSONFile(path: str, output: OUTPUT_STR, encoding: str) -> Iterator:
+    buff: ByteBuffer = FileByteBuffer(open(path, "rb"))  # Closed once exhausted or closed
+    try:
+        if output == "jsonitems":
+            yield from iterJSONItems(buff, encoding=encoding)
+        else:
+            yield from iterJSON(buff, encoding=encoding)
+    finally:
+        buff.destroy()
+
+
+def readFiles(paths: Iterable[str], output: OUTPUT_STR = "text", encoding: str = "utf-8", *,
+              workers: int = 8, ordered: bool = True, cached: bool = False) -> \
+        Iterator[READ_RESULT]:
+    """
+    Reads many files concurrently on a bounded thread pool, which hides the latency of network
+    file systems and cold page caches.
+
+    A file that fails to be read doesn't abort the batch, its error is yielded instead.
+
+    :param paths: The paths of the files
+    :param output: What to read the files as (the streaming kinds are not supported)
+    :param encoding: The encoding of text or JSON
+    :param workers: The maximum number of files read at once
+    :param ordered: Whether to yield the files in the input order, or as soon as they're read
+    :param cached: Whether to use the ReadCache, see readFile()
+    :return: An iterator yielding the path, the content (or None) and the error (or None)
+    """
+    assert workers > 0
+    if output in ("buffer", "jsonstream", "jsonitems"):
+        raise ValueError(f"Cannot read many files as {output}.")
+
+    def load(path: str) -> READ_RESULT:
+        try:
+            return path, readFile(path, output, encoding, cached), None
+        except Exception as e:
+            return path, None, e
+
+    pathIterator: Iterator[str] = iter(paths)
+    inFlight: deque[Future] = deque()
+    executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers,
+                                                      thread_name_prefix="readFiles")
+
+    def submitNext() -> None:
+        path: Optional[str] = next(pathIterator, None)
+        if path is not None:
+            inFlight.append(executor.submit(load, path))
+
+    try:
+        # Keep the pool busy, but don't hold the results of the whole batch in memory
+        for _ in range(workers * 2):
+            submitNext()
+        while len(inFlight) > 0:
+            if ordered:
+                future: Future = inFlight.popleft()
+            else:
+                done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                future: Future = done.pop()
+                inFlight.remove(future)
+            result: READ_RESULT = future.result()
+            submitNext()
+            yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 # Write file
-def writeFile(path: str, data: OUTPUT, encoding: str = "utf-8") -> None:
+class FsyncBatcher:
+    """
+    Groups the fsync() calls of many written files into a single commit (a group commit),
+    which is much cheaper than syncing every small file on its own.
+
+    Pass it as the ``fsync`` argument of writeFile(). Atomically written files stay in their
+    temporary files until commit() is called, so either the old or the new version is visible.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as tmp:
+    ...     with FsyncBatcher() as batcher:
+    ...         writeFile(os.path.join(tmp, "a.txt"), "a", atomic=True, fsync=batcher)
+    ...         os.path.exists(os.path.join(tmp, "a.txt"))
+    ...     readFile(os.path.join(tmp, "a.txt"), "text")
+    False
+    'a'
+    """
+    maxPending: Optional[int]
+
+    _lock: Lock
+    _pending: list[tuple[str, Optional[str]]]  # Written path, final path (None if not atomic)
+
+    def __init__(self, maxPending: Optional[int] = None):
+        """
+        Creates a blank batcher.
+        :param maxPending: If set, the batch is committed automatically once it holds this many
+         files
+        """
+        assert maxPending is None or maxPending > 0
+        self.maxPending = maxPending
+        self._lock = Lock()
+        self._pending = []
+
+    def add(self, writtenPath: str, finalPath: Optional[str] = None) -> None:
+        """
+        Adds a written file to the batch.
+        :param writtenPath: The path the data was written to
+        :param finalPath: The path to move the written file to on commit, None to keep it
+        """
+        with self._lock:
+            self._pending.append((writtenPath, finalPath))
+            commitNow: bool = self.maxPending is not None and len(self._pending) >= self.maxPending
+        if commitNow:
+            self.commit()
+
+    def commit(self) -> int:
+        """
+        Syncs all the pending files to the disk, moves the atomically written ones to their
+        final paths and syncs their directories.
+        :return: The number of committed files
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        for writtenPath, _ in pending:
+            _fsyncPath(writtenPath)
+        directories: set[str] = set()
+        for writtenPath, finalPath in pending:
+            if finalPath is not None:
+                os.replace(writtenPath, finalPath)
+            directories.add(os.path.dirname(os.path.abspath(finalPath or writtenPath)))
+        for directory in directories:
+            _fsyncDirectory(directory)
+        return len(pending)
+
+    def discard(self) -> None:
+        """
+        Forgets all the pending files, deleting the temporary files of the atomic writes.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for writtenPath, finalPath in pending:
+            if finalPath is not None and os.path.exists(writtenPath):
+                os.remove(writtenPath)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, excType, excValue, traceback) -> None:
+        if excType is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+def _fsyncPath(path: str) -> None:
+    fd: int = os.open(path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsyncDirectory(path: str) -> None:
+    # Makes a rename durable. Windows can't open directories, but it doesn't need this anyway.
+    if os.name == "nt":
+        return
+    fd: int = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _openTemporary(path: str) -> tuple[str, BinaryIO]:
+    """
+    Creates a new temporary file next to the path, so it can be os.replace()-d over it.
+    :param path: The final path of the file
+    :return: The temporary file's path and its open binary handle
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    flags: int = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    while True:
+        tmpPath: str = os.path.join(directory, f".{name}.{token_hex(4)}.tmp")
+        try:
+            fd: int = os.open(tmpPath, flags, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        # Keep the permissions of the file we're replacing
+        os.chmod(tmpPath, stat.S_IMODE(os.stat(path).st_mode))
+    except FileNotFoundError:
+        pass
+    return tmpPath, os.fdopen(fd, "wb")
+
+
+def _writeData(f: BinaryIO, data: OUTPUT, encoding: str, fsync: bool) -> None:
+    target: Optional[FileByteBuffer] = None
     # Special case: JSON
     if isinstance(data, dict):
-        with open(path, "w", encoding=encoding) as txtFile:
-            json.dump(data, txtFile)
-        return
+        from kutil.io.native_io_wrapper import TextIOWrapper
+        txtFile = TextIOWrapper(f, encoding=encoding)
+        json.dump(data, txtFile)
+        txtFile.flush()
+        txtFile.detach()  # Don't close the underlying file
     # Special case: FileByteBuffer
     elif isinstance(data, FileByteBuffer):
-        with open(path, "wb") as f:
-            # Copy the files very efficiently (hopefully)
-            data.copyInto(FileByteBuffer(f))
-        return
-
+        # Copy the files very efficiently (inside the kernel if possible). Keep the target
+        # referenced until we're done, as destroying it closes the file.
+        target = FileByteBuffer(f)
+        data.copyInto(target)
     # Other cases create a byte object in memory
-    with open(path, "wb") as f:
+    else:
         if isinstance(data, bytes):
             content = data
         elif isinstance(data, bytearray):
@@ -93,6 +337,47 @@ def writeFile(path: str, data: OUTPUT, encoding: str = "utf-8") -> None:
 
         f.write(content)
 
+    if fsync:
+        f.flush()
+        os.fsync(f.fileno())
+    if target is not None:
+        target.destroy()
+
+
+def writeFile(path: str, data: OUTPUT, encoding: str = "utf-8", *, atomic: bool = False,
+              fsync: bool | FsyncBatcher = False) -> None:
+    """
+    Writes data to a file. A dict is written as JSON, a str is encoded.
+    :param path: The path of the file
+    :param data: The data to write
+    :param encoding: The encoding of text or JSON
+    :param atomic: Whether to write to a temporary file in the same directory first and then
+     replace the file with it, so a crash never leaves a half-written file behind
+    :param fsync: Whether to make sure the data is on the disk before returning. Pass a
+     FsyncBatcher to defer the syncing (and the replacing, if atomic) to its commit() instead
+    """
+    batcher: Optional[FsyncBatcher] = fsync if isinstance(fsync, FsyncBatcher) else None
+    if atomic:
+        writtenPath, f = _openTemporary(path)
+    else:
+        writtenPath, f = path, open(path, "wb")
+
+    try:
+        with f:
+            _writeData(f, data, encoding, fsync is True)
+    except BaseException:
+        if atomic:
+            os.remove(writtenPath)
+        raise
+
+    ReadCache().invalidate(path)
+    if batcher is not None:
+        batcher.add(writtenPath, path if atomic else None)
+    elif atomic:
+        os.replace(writtenPath, path)
+        if fsync is True:
+            _fsyncDirectory(os.path.dirname(os.path.abspath(path)))
+
 
 # Newline stuff
 type NL_TYPE = Literal["CR", "LF", "CRLF"]
@@ -143,7 +428,7 @@ def getFileExtension(path: str) -> str:
 
 
 __all__ = [
-    "readFile", "writeFile",
+    "readFile", "readFiles", "writeFile", "FsyncBatcher",
     "CR", "LF", "CRLF",
     "bCR", "bLF", "bCRLF",
     "cCR", "cLF",
@@ -0,0 +1,251 @@
+#  -*- coding: utf-8 -*-
+"""
+An incremental JSON reader, which reads a ByteBuffer in fixed-size chunks and yields the values
+as soon as they're parsed, instead of loading the whole document at once.
+
+Every leaf value is yielded together with its path (the keys and indexes leading to it):
+
+>>> from kutil.buffer.MemoryByteBuffer import MemoryByteBuffer
+>>> list(iterJSON(MemoryByteBuffer(b'{"a": [1, {"b": null}], "c": "d"}'), chunkSize=4))
+[(('a', 0), 1), (('a', 1, 'b'), None), (('c',), 'd')]
+
+Values deeper than maxDepth are materialised as a whole:
+
+>>> list(iterJSON(MemoryByteBuffer(b'{"a": [1, {"b": null}], "c": {}}'), maxDepth=1))
+[(('a',), [1, {'b': None}]), (('c',), {})]
+
+>>> list(iterJSONItems(MemoryByteBuffer(b'[{"x": 1}, 2.5, "three"]'), chunkSize=3))
+[{'x': 1}, 2.5, 'three']
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+import codecs
+import json
+import re
+from typing import Iterator, Any, Optional, Final
+
+from kutil.buffer.ByteBuffer import ByteBuffer
+
+type JSONPath = tuple[str | int, ...]
+
+DEFAULT_CHUNK_SIZE: Final[int] = 64 * 1024  # 64 kB
+_WHITESPACE: Final[re.Pattern] = re.compile(r"[ \t\n\r]*")
+_DECODER: Final[json.JSONDecoder] = json.JSONDecoder()
+_NUMBER_CHARS: Final[frozenset[str]] = frozenset("0123456789+-.eE")
+
+
+class JSONStreamReader:
+    """
+    Parses a JSON document from chunks of bytes. Use iterJSON() or iterJSONItems() instead.
+    """
+    maxDepth: Optional[int]
+
+    _chunks: Iterator[bytes]
+    _decoder: codecs.IncrementalDecoder
+    _text: str
+    _pos: int
+    _eof: bool
+
+    def __init__(self, chunks: Iterator[bytes], maxDepth: Optional[int] = None,
+                 encoding: str = "utf-8"):
+        """
+        Creates a reader of the chunks.
+        :param chunks: The chunks of the encoded document
+        :param maxDepth: The depth at which the values are materialised as a whole,
+         None for never (only scalars and empty containers are yielded)
+        :param encoding: The encoding of the document
+        """
+        assert maxDepth is None or maxDepth >= 0
+        self.maxDepth = maxDepth
+        self._chunks = chunks
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._text = ""
+        self._pos = 0
+        self._eof = False
+
+    def _readMore(self, greedy: bool = False) -> bool:
+        """
+        Reads the next chunk, dropping the already parsed text.
+        :param greedy: Read at least as much text as is left unparsed, so re-parsing a big value
+         costs O(n) in total
+        :return: Whether anything was read (False at EOF)
+        """
+        if self._eof:
+            return False
+        parts: list[str] = [self._text[self._pos:]]
+        self._pos = 0
+        wanted: int = len(parts[0]) if greedy else 1
+        read: int = 0
+        while read < wanted:
+            chunk: Optional[bytes] = next(self._chunks, None)
+            if chunk is None:
+                parts.append(self._decoder.decode(b'', final=True))
+                self._eof = True
+                break
+            part: str = self._decoder.decode(bytes(chunk))
+            parts.append(part)
+            read += len(part)
+        self._text = "".join(parts)
+        return read > 0 or not self._eof
+
+    def _peek(self) -> str:
+        """
+        Skips the whitespace and returns the next character without consuming it.
+        :return: The next character or an empty string at EOF
+        """
+        while True:
+            self._pos = _WHITESPACE.match(self._text, self._pos).end()
+            if self._pos < len(self._text):
+                return self._text[self._pos]
+            if not self._readMore():
+                return ""
+
+    def _error(self, message: str) -> json.JSONDecodeError:
+        return json.JSONDecodeError(message, self._text, self._pos)
+
+    def _decodeValue(self) -> Any:
+        """
+        Decodes a whole value at the current position, reading more chunks if it's incomplete.
+        :return: The value
+        """
+        complete: bool = False  # Whether the text surely holds the whole number
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._text, self._pos)
+            except json.JSONDecodeError:
+                if self._readMore(greedy=True):
+                    continue
+                raise
+            # A number at the end of the text might continue in the next chunk (e.g., "1.5e"
+            # is parsed as 1.5 until we see the rest of the exponent)
+            if (not complete and not self._eof and isinstance(value, int | float)
+                    and not isinstance(value, bool)
+                    and (end == len(self._text) or self._text[end] in _NUMBER_CHARS)):
+                self._readNumber(end - self._pos)
+                complete = True
+                continue
+            self._pos = end
+            return value
+
+    def _readNumber(self, scanned: int) -> None:
+        """
+        Reads the chunks only until the number at the current position is followed by a character
+        that can't be a part of it (or until EOF), not to read the rest of the document.
+        :param scanned: How many characters of the number were already seen
+        """
+        while True:
+            i: int = self._pos + scanned
+            while i < len(self._text) and self._text[i] in _NUMBER_CHARS:
+                i += 1
+            if i < len(self._text):
+                return
+            scanned = i - self._pos
+            if not self._readMore():  # Keeps the unparsed text, the number starts at 0 then
+                return
+
+    def _readKey(self) -> str:
+        if self._peek() != '"':
+            raise self._error("Expecting property name enclosed in double quotes")
+        key: str = self._decodeValue()
+        if self._peek() != ":":
+            raise self._error("Expecting ':' delimiter")
+        self._pos += 1
+        return key
+
+    def events(self) -> Iterator[tuple[JSONPath, Any]]:
+        """
+        Parses the document, yielding the leaf values with their paths.
+        :return: An iterator yielding the paths and the values
+        """
+        path: list[str | int] = []
+        containers: list[str] = []  # The opening characters of the containers we're in
+        expectingValue: bool = True
+        while True:
+            if expectingValue:
+                char: str = self._peek()
+                if char == "":
+                    raise self._error("Expecting value")
+                if char not in "{[" or (self.maxDepth is not None and
+                                        len(path) >= self.maxDepth):
+                    yield tuple(path), self._decodeValue()
+                    expectingValue = False
+                else:
+                    self._pos += 1
+                    if self._peek() == ("}" if char == "{" else "]"):
+                        self._pos += 1
+                        yield tuple(path), {} if char == "{" else []
+                        expectingValue = False
+                    else:
+                        containers.append(char)
+                        path.append(self._readKey() if char == "{" else 0)
+                    continue
+
+            if len(containers) == 0:
+                if self._peek() != "":
+                    raise self._error("Extra data")
+                return
+
+            char: str = self._peek()
+            isObject: bool = containers[-1] == "{"
+            if char == ",":
+                self._pos += 1
+                if isObject:
+                    path[-1] = self._readKey()
+                else:
+                    path[-1] += 1
+                expectingValue = True
+            elif char == ("}" if isObject else "]"):
+                self._pos += 1
+                containers.pop()
+                path.pop()
+            else:
+                raise self._error(f"Expecting ',' delimiter or '{'}' if isObject else ']'}'")
+
+    def items(self) -> Iterator[Any]:
+        """
+        Parses a document with an array at its root, yielding the materialised array items.
+        :return: An iterator yielding the items
+        """
+        if self._peek() != "[":
+            raise ValueError("The JSON document's root is not an array")
+        self.maxDepth = 1
+        for path, value in self.events():
+            if len(path) == 1:  # Skip the empty root array
+                yield value
+
+
+def _chunksOf(source: ByteBuffer, chunkSize: int) -> Iterator[bytes]:
+    assert chunkSize > 0
+    return source.batched(chunkSize)
+
+
+def iterJSON(source: ByteBuffer, *, chunkSize: int = DEFAULT_CHUNK_SIZE,
+             maxDepth: Optional[int] = None, encoding: str = "utf-8") -> \
+        Iterator[tuple[JSONPath, Any]]:
+    """
+    Incrementally parses a JSON document from the buffer (starting at its pointer),
+    yielding (path, value) events.
+    :param source: The buffer, e.g., a FileByteBuffer
+    :param chunkSize: How many bytes to read at once
+    :param maxDepth: The depth at which the values are materialised as a whole,
+     None for never (only scalars and empty containers are yielded)
+    :param encoding: The encoding of the document
+    :return: An iterator yielding the paths and the values
+    """
+    return JSONStreamReader(_chunksOf(source, chunkSize), maxDepth, encoding).events()
+
+
+def iterJSONItems(source: ByteBuffer, *, chunkSize: int = DEFAULT_CHUNK_SIZE,
+                  encoding: str = "utf-8") -> Iterator[Any]:
+    """
+    Incrementally parses a JSON document with an array at its root from the buffer
+    (starting at its pointer), yielding the array items one by one.
+    :param source: The buffer, e.g., a FileByteBuffer
+    :param chunkSize: How many bytes to read at once
+    :param encoding: The encoding of the document
+    :return: An iterator yielding the items
+    """
+    return JSONStreamReader(_chunksOf(source, chunkSize), 1, encoding).items()
+
+
+__all__ = ["JSONPath", "JSONStreamReader", "iterJSON", "iterJSONItems"]
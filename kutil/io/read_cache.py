@@ -0,0 +1,134 @@
+#  -*- coding: utf-8 -*-
+"""
+A process-wide cache of parsed file contents, used by ``readFile(path, kind, cached=True)``.
+
+The entries are keyed by the file's path, and they are only used while ``os.stat()`` shows the
+file unchanged (the same device, inode, modification time and size).
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+import os
+import sys
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Final
+
+from kutil.typing_help import singleton
+
+type TCacheKey = tuple[str, str, str]  # Absolute path, output kind, encoding
+type TFileSignature = tuple[int, int, int, int]  # Device, inode, modification time, size
+
+
+def fileSignature(path: str) -> TFileSignature:
+    """
+    Returns what identifies the current version of a file.
+    :param path: The file's path
+    :return: The device, inode, modification time (in ns) and size of the file
+    """
+    stat: os.stat_result = os.stat(path)
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+@singleton
+class ReadCache:
+    """
+    An LRU cache of parsed file contents with a byte budget.
+
+    Cached JSON objects are shared between the callers, so treat them as read-only.
+    """
+    DEFAULT_BUDGET: Final[int] = 64 * 1024 * 1024  # 64 MB
+
+    budget: int  # The maximum total size of the cached contents in bytes
+    hits: int
+    misses: int
+    evictions: int
+
+    _entries: OrderedDict[TCacheKey, tuple[TFileSignature, Any, int]]  # Signature, value, size
+    _size: int
+    _lock: Lock
+
+    def __init__(self):
+        self.budget = self.DEFAULT_BUDGET
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    def get(self, path: str, output: str, encoding: str, loader: Callable[[], Any]) -> Any:
+        """
+        Returns the cached content of the file if it's unchanged, otherwise loads and caches it.
+        :param path: The file's path
+        :param output: The output kind of the content
+        :param encoding: The encoding of the content
+        :param loader: Loads the content on a miss
+        :return: The content
+        """
+        key: TCacheKey = (os.path.abspath(path), output, encoding)
+        signature: TFileSignature = fileSignature(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value: Any = loader()
+        if fileSignature(path) != signature:
+            return value  # The file changed while we were reading it, don't trust it
+
+        size: int = sys.getsizeof(value) if isinstance(value, str | bytes) else signature[3]
+        with self._lock:
+            self._remove(key)
+            if size <= self.budget:
+                self._entries[key] = (signature, value, size)
+                self._size += size
+                self._evict()
+        return value
+
+    def invalidate(self, path: str) -> None:
+        """
+        Forgets all the cached contents of the file.
+        :param path: The file's path
+        """
+        absPath: str = os.path.abspath(path)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == absPath]:
+                self._remove(key)
+
+    def clear(self) -> None:
+        """
+        Forgets all the cached contents and resets the statistics.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def _remove(self, key: TCacheKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def _evict(self) -> None:
+        while self._size > self.budget:
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+    @property
+    def size(self) -> int:
+        """The total size of the cached contents in bytes."""
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return (f"ReadCache(entries={len(self)}, size={self._size}, budget={self.budget}, "
+                f"hits={self.hits}, misses={self.misses}, evictions={self.evictions})")
+
+
+__all__ = ["ReadCache", "fileSignature"]
@@ -7,7 +7,17 @@ from abc import abstractmethod, ABC
 from kutil.buffer import ByteBuffer
 
 
-class NeedMoreDataError(BaseException): ...
+class NeedMoreDataError(BaseException):
+    """
+    Raised by a protocol when the data isn't complete yet.
+    consumed means the protocol moved the buffer's pointer past the data it already processed (and
+    remembered), so the data before the pointer can be dropped instead of being parsed again.
+    """
+    consumed: bool
+
+    def __init__(self, *args, consumed: bool = False):
+        super().__init__(*args)
+        self.consumed = consumed
 
 
 class StopUnpacking(BaseException): ...
@@ -0,0 +1,58 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+from time import monotonic
+from typing import Any
+
+from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
+from kutil.protocol.ProtocolConnection import ProtocolConnection
+from kutil.protocol.AsyncProtocolServer import AsyncProtocolServer, AsyncProtocolConnection
+from kutil.protocol.HTTPServer import HTTPServer, HTTPServerConnection
+
+
+class AsyncHTTPServerConnection(AsyncProtocolConnection, HTTPServerConnection):
+    """
+    An HTTPServerConnection served by asyncio - the onData handler may be a coroutine function,
+    use ``await conn.sendDataAsync(resp)`` to send big responses without buffering them whole
+    (the response's body may be an async iterable then).
+    """
+
+    async def sendDataAsync(self, data: Any, beginAtLayer: int = -1,
+                            chunkSize: int = 1024 * 1024) -> bool:
+        close: bool = False
+        if isinstance(data, HTTPResponse) and self.didNotUpgrade and data.statusCode >= 200:
+            close = self._prepareResponse(data)
+        sent: bool = await super().sendDataAsync(data, beginAtLayer, chunkSize)
+        if sent and isinstance(data, HTTPResponse) and data.isStreamed:
+            sent = await self._sendBodyAsync(data)
+        self.lastActivity = monotonic()
+        if close:
+            self.close()
+        return sent
+
+    async def _sendBodyAsync(self, resp: HTTPResponse) -> bool:
+        """Sends the streamed body (an iterable or an async iterable) as it's produced"""
+        try:
+            if hasattr(resp.body, "__aiter__"):
+                async for data in resp.body:
+                    if len(data) > 0:
+                        await self.sock.write(resp.encodeChunk(data))
+                await self.sock.write(resp.CHUNKED_END)
+            else:
+                for chunk in resp.iterChunks():
+                    await self.sock.write(chunk)
+            return True
+        except Exception as e:  # Sending or producing the body failed, the response can't be ended
+            self.close(e)
+            return False
+
+
+class AsyncHTTPServer(AsyncProtocolServer, HTTPServer):
+    """
+    An HTTPServer (including the WebSocket and SSE upgrades) running on asyncio, see
+    AsyncProtocolServer for how to run it.
+    """
+    connectionType: type[ProtocolConnection] = AsyncHTTPServerConnection
+
+
+__all__ = ["AsyncHTTPServer", "AsyncHTTPServerConnection"]
@@ -0,0 +1,263 @@
+#  -*- coding: utf-8 -*-
+"""
+An asyncio implementation of the protocol servers, driving the same AbstractProtocol layers through
+asyncio transports, so one thread can serve many long-lived connections and the handlers can await
+(e.g., upstream downloads) instead of blocking a thread each.
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+import asyncio
+import inspect
+import socket
+from collections import deque
+from threading import get_ident
+from typing import Any, Optional
+
+from kutil.buffer.ByteBuffer import ByteBuffer
+from kutil.protocol.ProtocolConnection import ProtocolConnection, ConnectionClosed
+from kutil.protocol.ProtocolServer import ProtocolServer
+
+
+class _TransportSocket:
+    """
+    Makes an asyncio transport look like the blocking socket a ProtocolConnection sends through.
+    """
+    transport: asyncio.Transport
+    loop: asyncio.AbstractEventLoop
+    _loopThread: int
+    _writable: asyncio.Event  # Cleared while the transport's write buffer is too full
+
+    def __init__(self, transport: asyncio.Transport, loop: asyncio.AbstractEventLoop):
+        self.transport = transport
+        self.loop = loop
+        self._loopThread = get_ident()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def inLoopThread(self) -> bool:
+        return get_ident() == self._loopThread
+
+    async def write(self, data: bytes) -> None:
+        """
+        Writes the data, waiting until the transport's write buffer drains.
+        :param data: The data
+        """
+        if self.transport.is_closing():
+            raise BrokenPipeError("The transport is closed")
+        self.transport.write(data)
+        await self._writable.wait()
+
+    def sendall(self, data: bytes | bytearray | memoryview) -> None:
+        if self.inLoopThread():
+            # We can't wait for the buffer to drain without blocking the loop
+            if self.transport.is_closing():
+                raise BrokenPipeError("The transport is closed")
+            self.transport.write(bytes(data))
+            return
+        # From another thread (e.g., a synchronous handler in the executor), wait for the buffer
+        # to drain, so big responses don't pile up in the memory
+        try:
+            future = asyncio.run_coroutine_threadsafe(self.write(bytes(data)), self.loop)
+        except RuntimeError as e:  # The loop is closed
+            raise BrokenPipeError("The event loop is closed") from e
+        future.result()
+
+    def close(self) -> None:
+        if self.inLoopThread():
+            self.transport.close()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.transport.close)
+
+    @staticmethod
+    def getblocking() -> bool:
+        return True  # sendall() never raises BlockingIOError
+
+    def getpeername(self) -> Any:
+        return self.transport.get_extra_info("peername")
+
+    def getsockname(self) -> Any:
+        return self.transport.get_extra_info("sockname")
+
+
+class _ConnectionProtocol(asyncio.Protocol):
+    """Feeds the transport's events to the AsyncProtocolConnection."""
+    server: "AsyncProtocolServer"
+    sock: Optional[_TransportSocket]
+    connection: Optional[ProtocolConnection]
+
+    def __init__(self, server: "AsyncProtocolServer"):
+        self.server = server
+        self.sock = None
+        self.connection = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        if not self.server._canAccept():
+            transport.close()
+            return
+        self.sock = _TransportSocket(transport, asyncio.get_running_loop())
+        self.connection = self.server._acceptConnection(self.sock,
+                                                        transport.get_extra_info("peername"))
+        if self.connection is None:
+            transport.close()
+        if not self.server._canAccept():
+            self.server._stopAccepting()
+
+    def data_received(self, data: bytes) -> None:
+        if self.connection is None:
+            return
+        try:
+            self.connection.feedData(data)
+        except Exception as e:
+            self.connection.close(e)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self.sock is not None:
+            self.sock._writable.set()  # Wake up the writers, they'll see the closed transport
+        if self.connection is not None:
+            self.connection.close(exc if exc is not None else ConnectionClosed())
+
+    def pause_writing(self) -> None:
+        self.sock._writable.clear()
+
+    def resume_writing(self) -> None:
+        self.sock._writable.set()
+
+
+class AsyncProtocolConnection(ProtocolConnection):
+    """
+    A connection served by an asyncio transport, see AsyncProtocolServer.
+
+    The onData handler may be a coroutine function. The handlers of one connection run one after
+    another, in the order the data arrived, but the handlers of different connections interleave.
+    """
+    # Run the synchronous onData handlers in the loop's default executor, so they may block
+    syncHandlersInExecutor: bool = True
+
+    sock: _TransportSocket
+    _pendingData: deque[Any]
+    _handlerTask: Optional[asyncio.Task]
+
+    def init(self):
+        super().init()
+        self._pendingData = deque()
+        self._handlerTask = None
+
+    def startRecv(self):
+        pass  # The transport feeds the data
+
+    def handleData(self, data: Any):
+        self._pendingData.append(data)
+        if self._handlerTask is None:
+            self._handlerTask = asyncio.get_running_loop().create_task(self._runHandlers())
+
+    async def _runHandlers(self):
+        try:
+            while len(self._pendingData) > 0 and not self.closed:
+                data: Any = self._pendingData.popleft()
+                handler = self.onData
+                if inspect.iscoroutinefunction(handler) or not self.syncHandlersInExecutor:
+                    result: Any = handler(self, data)
+                else:
+                    result: Any = await asyncio.get_running_loop().run_in_executor(
+                        None, handler, self, data)
+                if inspect.isawaitable(result):
+                    await result
+        except Exception as e:
+            self.close(e)
+        finally:
+            self._handlerTask = None
+
+    async def sendDataAsync(self, data: Any, beginAtLayer: int = -1,
+                            chunkSize: int = 1024 * 1024) -> bool:
+        """
+        Sends the data like sendData(), but waits for the transport's buffer to drain instead of
+        buffering the whole (possibly huge) packed data.
+        :param data: The data
+        :param beginAtLayer: The index of the layer packing the data, -1 for the last one
+        :param chunkSize: How much data to write at once
+        :return: Whether the data was sent (False if the connection got closed)
+        """
+        if len(self._queue) > 0 and not self.flush():  # The queued data goes first
+            return False
+        buff: ByteBuffer = self._packData(data, beginAtLayer)
+        try:
+            for chunk in buff.batched(chunkSize):
+                await self.sock.write(chunk)
+            return True
+        except OSError as e:
+            self.close(e)
+            return False
+        finally:
+            buff.destroy()
+
+
+class AsyncProtocolServer(ProtocolServer):
+    """
+    A ProtocolServer accepting the connections on an asyncio event loop.
+
+    Use ``await server.serve()`` inside a running loop, or the blocking ``server.listen()``.
+    """
+    connectionType: type[ProtocolConnection] = AsyncProtocolConnection
+
+    _server: Optional[asyncio.Server]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._server = None
+
+    async def start(self, maxAmount: Optional[int] = None) -> None:
+        """
+        Starts accepting the connections on the running loop and returns.
+        :param maxAmount: How many connections to accept, None for no limit
+        """
+        self.closed = False
+        self._accepted = 0
+        self._maxAmount = maxAmount
+        self._server = await asyncio.get_running_loop().create_server(
+            lambda: _ConnectionProtocol(self), sock=self.sock,
+            backlog=maxAmount if maxAmount is not None else socket.SOMAXCONN)
+
+    async def serve(self, maxAmount: Optional[int] = None) -> None:
+        """
+        Accepts the connections on the running loop until the server is closed
+        (or maxAmount connections were accepted).
+        :param maxAmount: How many connections to accept, None for no limit
+        """
+        await self.start(maxAmount)
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            if self._server.is_serving():
+                raise  # Cancelled from the outside, not by close()
+
+    def listen(self, maxAmount: Optional[int] = None, *, eventLoop: None = None):
+        """
+        Runs the server on a new asyncio event loop, blocking until it's closed.
+        :param maxAmount: How many connections to accept, None for no limit
+        :param eventLoop: Not supported, use ``await serve()`` on your own loop instead
+        """
+        if eventLoop is not None:
+            raise ValueError("AsyncProtocolServer runs on asyncio, use 'await serve()' instead")
+        asyncio.run(self.serve(maxAmount))
+
+    def _stopAccepting(self) -> None:
+        server: Optional[asyncio.Server] = self._server
+        if server is None:
+            return
+        try:
+            asyncio.get_running_loop()
+            server.close()
+        except RuntimeError:  # Not in the loop's thread
+            server.get_loop().call_soon_threadsafe(server.close)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._server is not None:
+            self._stopAccepting()  # Closes the socket too
+        else:
+            self.sock.close()
+
+
+__all__ = ["AsyncProtocolServer", "AsyncProtocolConnection"]
@@ -0,0 +1,217 @@
+#  -*- coding: utf-8 -*-
+"""
+A process-wide cache of the host name resolutions (socket.getaddrinfo), used by the client
+connections (see ProtocolConnection.connect), so many connections to a few hosts don't wait for
+the resolver each.
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+import socket
+from collections import OrderedDict
+from ipaddress import ip_address
+from threading import Lock, Event
+from time import monotonic
+from typing import Final, Optional, Callable, Any
+
+type TSocketAddress = tuple[str, int]  # The IP address, the port
+type TDNSKey = tuple[str, int, int]  # The lowercase host, the port, the address family
+type Resolver = Callable[..., list[tuple[Any, ...]]]  # Like socket.getaddrinfo
+
+
+class _DNSEntry:
+    addresses: list[TSocketAddress]  # Empty if the resolution failed
+    error: Optional[socket.gaierror]
+    expiresAt: float  # time.monotonic()
+
+    def __init__(self, addresses: list[TSocketAddress], error: Optional[socket.gaierror],
+                 expiresAt: float):
+        self.addresses = addresses
+        self.error = error
+        self.expiresAt = expiresAt
+
+
+class DNSCache:
+    """
+    An LRU cache of the resolved addresses. getaddrinfo() doesn't tell the records' TTL, so the
+    addresses are kept for ttl seconds, and the failed resolutions for negativeTTL seconds (so an
+    unknown host doesn't ask the resolver on every connection). Concurrent resolutions of the same
+    host wait for the first one (single-flight).
+
+    The overrides map a host to fixed addresses without asking the resolver at all, e.g., to point
+    a client to a local server in the tests::
+
+        dnsCache.override("api.example.com", ["127.0.0.1"])
+        conn = HTTPConnection(("api.example.com", 8080), onData)  # Connects to 127.0.0.1:8080
+    """
+    TTL: Final[float] = 60  # Seconds
+    NEGATIVE_TTL: Final[float] = 5  # Seconds
+    MAX_ENTRIES: Final[int] = 1024
+    RESOLVE_TIMEOUT: Final[float] = 30  # Seconds a resolution waits for a concurrent one
+
+    ttl: float
+    negativeTTL: float
+    maxEntries: int
+    resolver: Resolver
+    # Statistics
+    hits: int
+    misses: int
+    coalesced: int  # The resolutions that waited for a concurrent one
+    failures: int
+
+    _entries: OrderedDict[TDNSKey, _DNSEntry]
+    _overrides: dict[str, list[str]]  # The lowercase host to its IP addresses
+    _resolving: dict[TDNSKey, Event]
+    _lock: Lock
+
+    def __init__(self, ttl: float = TTL, negativeTTL: float = NEGATIVE_TTL,
+                 maxEntries: int = MAX_ENTRIES, resolver: Resolver = socket.getaddrinfo):
+        """
+        Creates a cache.
+        :param ttl: Seconds to keep the resolved addresses for
+        :param negativeTTL: Seconds to remember a failed resolution for
+        :param maxEntries: The most hosts to remember
+        :param resolver: Resolves the hosts, socket.getaddrinfo by default
+        """
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self.maxEntries = maxEntries
+        self.resolver = resolver
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.failures = 0
+        self._entries = OrderedDict()
+        self._overrides = {}
+        self._resolving = {}
+        self._lock = Lock()
+
+    def resolve(self, host: str, port: int,
+                family: int = socket.AF_INET) -> list[TSocketAddress]:
+        """
+        Resolves the host.
+        :param host: The host name or an IP address
+        :param port: The port
+        :param family: The address family, e.g., socket.AF_INET
+        :return: The socket addresses to connect to, in the resolver's order
+        :exception socket.gaierror: If the host can't be resolved (it's remembered for a while)
+        """
+        try:
+            ip_address(host)
+            return [(host, port)]  # Nothing to resolve
+        except ValueError:
+            pass
+        name: str = host.lower()
+        overridden: Optional[list[str]] = self._overrides.get(name)
+        if overridden is not None:
+            return [(address, port) for address in overridden]
+
+        key: TDNSKey = (name, port, family)
+        while True:
+            with self._lock:
+                entry: Optional[_DNSEntry] = self._lookup(key)
+                if entry is not None:
+                    self.hits += 1
+                    return self._result(entry)
+                resolving: Optional[Event] = self._resolving.get(key)
+                if resolving is None:
+                    self.misses += 1
+                    resolving = self._resolving[key] = Event()
+                    break
+                self.coalesced += 1
+            if not resolving.wait(self.RESOLVE_TIMEOUT):
+                break  # The resolver hangs, ask it too
+        try:
+            entry = self._resolve(host, port, family)
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxEntries:
+                    self._entries.popitem(last=False)
+        finally:
+            with self._lock:
+                if self._resolving.get(key) is resolving:
+                    del self._resolving[key]
+            resolving.set()
+        return self._result(entry)
+
+    def resolveAddress(self, address: tuple[str, int],
+                       family: int = socket.AF_INET) -> TSocketAddress:
+        """
+        Resolves the address to connect a socket to.
+        :param address: The (host, port)
+        :param family: The address family
+        :return: The first resolved (IP address, port)
+        :exception socket.gaierror: If the host can't be resolved
+        """
+        return self.resolve(address[0], address[1], family)[0]
+
+    def override(self, host: str, addresses: Optional[list[str]]) -> None:
+        """
+        Makes the host resolve to the addresses, without asking the resolver.
+        :param host: The host name
+        :param addresses: The IP addresses, None to remove the override
+        """
+        with self._lock:
+            if addresses is None:
+                self._overrides.pop(host.lower(), None)
+            else:
+                self._overrides[host.lower()] = list(addresses)
+
+    def invalidate(self, host: Optional[str] = None) -> None:
+        """
+        Forgets the resolved addresses (not the overrides).
+        :param host: Only this host's ones, None for all
+        """
+        with self._lock:
+            if host is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == host.lower()]:
+                del self._entries[key]
+
+    def _lookup(self, key: TDNSKey) -> Optional[_DNSEntry]:
+        entry: Optional[_DNSEntry] = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expiresAt <= monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _resolve(self, host: str, port: int, family: int) -> _DNSEntry:
+        """Asks the resolver, outside the lock"""
+        try:
+            infos: list[tuple[Any, ...]] = self.resolver(host, port, family, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            self.failures += 1
+            return _DNSEntry([], e, monotonic() + self.negativeTTL)
+        addresses: list[TSocketAddress] = []
+        for info in infos:
+            address: TSocketAddress = info[4][:2]
+            if address not in addresses:
+                addresses.append(address)
+        if len(addresses) == 0:
+            self.failures += 1
+            return _DNSEntry([], socket.gaierror(socket.EAI_NONAME, f"No address of {host}"),
+                             monotonic() + self.negativeTTL)
+        return _DNSEntry(addresses, None, monotonic() + self.ttl)
+
+    @staticmethod
+    def _result(entry: _DNSEntry) -> list[TSocketAddress]:
+        if entry.error is not None:
+            raise socket.gaierror(*entry.error.args)
+        return list(entry.addresses)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return (f"DNSCache(entries={len(self)}, overrides={len(self._overrides)}, "
+                f"hits={self.hits}, misses={self.misses}, coalesced={self.coalesced}, "
+                f"failures={self.failures})")
+
+
+dnsCache: DNSCache = DNSCache()  # The one used by the client connections
+
+__all__ = ["DNSCache", "dnsCache"]
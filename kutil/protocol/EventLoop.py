@@ -0,0 +1,559 @@
+#  -*- coding: utf-8 -*-
+"""
+A readiness-driven I/O loop built on the selectors module (epoll on Linux, kqueue on BSD/macOS),
+used by ProtocolServer and ProtocolConnection instead of one receiver thread per connection.
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+import heapq
+import selectors
+import select
+import socket
+import sys
+from threading import Thread, Lock, current_thread, local
+from time import monotonic
+from typing import Callable, Optional, Final
+
+type ReadyCallback = Callable[[], None]
+
+RECV_BUFFER_SIZE: Final[int] = 256 * 1024  # 256 kB
+
+_threadState: local = local()  # Its loop attribute is the event loop the thread serves
+
+
+def waitWritable(sock: socket.socket, timeout: Optional[float] = None) -> bool:
+    """
+    Blocks until a (non-blocking) socket can accept more data to send.
+    :param sock: The socket
+    :param timeout: The maximum time to wait in seconds, None for no limit
+    :return: Whether the socket became writable in time
+    """
+    if hasattr(select, "poll"):  # select.select() only supports file descriptors below 1024
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        return len(poller.poll(None if timeout is None else timeout * 1000)) > 0
+    _, writable, _ = select.select([], [sock], [], timeout)
+    return len(writable) > 0
+
+
+def inIOThread() -> bool:
+    """
+    Whether the current thread is an I/O thread of an event loop (including the background loop),
+    such a thread must not block - e.g., wait for a slow peer to read.
+    :return: Whether it is
+    """
+    return getattr(_threadState, "loop", None) is not None
+
+
+class _IOThread:
+    """One selector with the thread running it, its keys' data are [onReadable, onWritable]."""
+    selector: selectors.BaseSelector
+    recvBuffer: bytearray  # Shared by all the sockets of this thread, see EventLoop.register()
+    thread: Optional[Thread]
+
+    _wakeupReader: socket.socket
+    _wakeupWriter: socket.socket
+    _pending: list[ReadyCallback]
+    _timers: list[tuple[float, int, ReadyCallback]]  # A heap of (when, sequence number, callback)
+    _timerCount: int
+    _lock: Lock
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.recvBuffer = bytearray(RECV_BUFFER_SIZE)
+        self.thread = None
+        self._wakeupReader, self._wakeupWriter = socket.socketpair()
+        self._wakeupReader.setblocking(False)
+        self._wakeupWriter.setblocking(False)
+        self._pending = []
+        self._timers = []
+        self._timerCount = 0
+        self._lock = Lock()
+        self.selector.register(self._wakeupReader, selectors.EVENT_READ, [self._drainWakeup, None])
+
+    def wakeup(self) -> None:
+        try:
+            self._wakeupWriter.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # Already woken up (or closed)
+
+    def callSoon(self, callback: ReadyCallback) -> None:
+        with self._lock:
+            self._pending.append(callback)
+        self.wakeup()
+
+    def callLater(self, delay: float, callback: ReadyCallback) -> None:
+        with self._lock:
+            heapq.heappush(self._timers, (monotonic() + delay, self._timerCount, callback))
+            first: bool = self._timers[0][1] == self._timerCount
+            self._timerCount += 1
+        if first and self.thread is not current_thread():
+            self.wakeup()  # Shorten the current select()
+
+    def _drainWakeup(self) -> None:
+        try:
+            while self._wakeupReader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def runOnce(self, timeout: Optional[float]) -> None:
+        if len(self._timers) > 0:
+            with self._lock:
+                untilFirst: float = (max(0.0, self._timers[0][0] - monotonic())
+                                     if len(self._timers) > 0 else timeout)
+            timeout = untilFirst if timeout is None else min(timeout, untilFirst)
+        for key, events in self.selector.select(timeout):
+            # The socket might have been unregistered (and its file descriptor reused) by
+            # an earlier callback of this batch, skip the stale events
+            if events & selectors.EVENT_WRITE and self._isCurrent(key) and key.data[1] is not None:
+                self._call(key.data[1])
+            if events & selectors.EVENT_READ and self._isCurrent(key) and key.data[0] is not None:
+                self._call(key.data[0])
+        if len(self._pending) > 0:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            for callback in pending:
+                self._call(callback)
+        if len(self._timers) > 0:
+            now: float = monotonic()
+            due: list[ReadyCallback] = []
+            with self._lock:
+                while len(self._timers) > 0 and self._timers[0][0] <= now:
+                    due.append(heapq.heappop(self._timers)[2])
+            for callback in due:
+                self._call(callback)
+
+    def _isCurrent(self, key: selectors.SelectorKey) -> bool:
+        return self.selector.get_map().get(key.fd) is key
+
+    @staticmethod
+    def _call(callback: ReadyCallback) -> None:
+        try:
+            callback()
+        except Exception:
+            # A broken callback mustn't stop the other sockets from being served
+            sys.excepthook(*sys.exc_info())
+
+    def close(self) -> None:
+        self.selector.close()
+        self._wakeupReader.close()
+        self._wakeupWriter.close()
+
+
+class EventLoop:
+    """
+    Multiplexes many non-blocking sockets on one or a few I/O threads.
+
+    The readiness callbacks (and so the protocol layers and the onData handlers of the connections)
+    run on the I/O threads, so they must not block for long - every other connection of the same
+    thread waits meanwhile.
+
+    >>> loop = EventLoop(ioThreads=2)
+    >>> loop.start()
+    >>> loop.running
+    True
+    >>> loop.stop()
+    >>> loop.running
+    False
+    """
+    ioThreads: int
+    running: bool
+
+    _threads: list[_IOThread]
+    _startedThreads: list[Thread]  # Not including the thread calling run()
+    _owners: dict[socket.socket, _IOThread]
+    _callbacks: dict[socket.socket, list[Optional[ReadyCallback]]]  # [onReadable, onWritable]
+    _readingPaused: set[socket.socket]
+    _nextThread: int
+    _lock: Lock
+
+    def __init__(self, ioThreads: int = 1):
+        """
+        Creates an event loop.
+        :param ioThreads: How many threads (each with its own selector) serve the sockets
+        """
+        assert ioThreads > 0
+        self.ioThreads = ioThreads
+        self.running = False
+        self._threads = [_IOThread() for _ in range(ioThreads)]
+        self._startedThreads = []
+        self._owners = {}
+        self._callbacks = {}
+        self._readingPaused = set()
+        self._nextThread = 0
+        self._lock = Lock()
+
+    def register(self, sock: socket.socket, onReadable: ReadyCallback) -> None:
+        """
+        Makes the socket non-blocking and calls the callback (on an I/O thread) whenever it has
+        data to read. Use recvBuffer() as the target of sock.recv_into() inside the callback.
+        :param sock: The socket
+        :param onReadable: The callback
+        """
+        sock.setblocking(False)
+        with self._lock:
+            ioThread: _IOThread = self._ownerOf(sock)
+            self._callbacks[sock][0] = onReadable
+            self._apply(ioThread, sock)
+        ioThread.wakeup()  # Some selectors only see the new socket on their next select()
+
+    def watchWritable(self, sock: socket.socket, onWritable: Optional[ReadyCallback]) -> None:
+        """
+        Calls the callback (on an I/O thread) whenever the socket can accept more data to send,
+        until this is called again with None. The socket doesn't have to be registered, its blocking
+        mode isn't changed then.
+        :param sock: The socket
+        :param onWritable: The callback, None to stop watching
+        """
+        with self._lock:
+            if sock not in self._owners and onWritable is None:
+                return
+            ioThread: _IOThread = self._ownerOf(sock)
+            self._callbacks[sock][1] = onWritable
+            self._apply(ioThread, sock)
+        ioThread.wakeup()
+
+    def pauseReading(self, sock: socket.socket, paused: bool) -> None:
+        """
+        Stops (or resumes) calling the onReadable callback of the socket, e.g., while its peer
+        doesn't read what's sent to it. The unread data wait in the kernel, so TCP slows the peer
+        down. Does nothing if the socket isn't registered.
+        :param sock: The socket
+        :param paused: Whether to pause the reading
+        """
+        with self._lock:
+            ioThread: Optional[_IOThread] = self._owners.get(sock)
+            if ioThread is None:
+                return
+            if paused:
+                self._readingPaused.add(sock)
+            else:
+                self._readingPaused.discard(sock)
+            self._apply(ioThread, sock)
+        ioThread.wakeup()
+
+    def unregister(self, sock: socket.socket) -> None:
+        """
+        Stops watching the socket, call this before closing it. Does nothing if it isn't registered.
+        :param sock: The socket
+        """
+        with self._lock:
+            ioThread: Optional[_IOThread] = self._owners.pop(sock, None)
+            self._callbacks.pop(sock, None)
+            self._readingPaused.discard(sock)
+            if ioThread is None:
+                return
+            try:
+                ioThread.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+
+    def _ownerOf(self, sock: socket.socket) -> _IOThread:
+        """Returns the I/O thread serving the socket, assigns one if none does, holding the lock"""
+        ioThread: Optional[_IOThread] = self._owners.get(sock)
+        if ioThread is None:
+            ioThread = self._threads[self._nextThread]
+            self._nextThread = (self._nextThread + 1) % self.ioThreads
+            self._owners[sock] = ioThread
+            self._callbacks[sock] = [None, None]
+        return ioThread
+
+    def _apply(self, ioThread: _IOThread, sock: socket.socket) -> None:
+        """Updates the selector's interest in the socket to its callbacks, holding the lock"""
+        callbacks: list[Optional[ReadyCallback]] = self._callbacks[sock]
+        if callbacks[0] is None and callbacks[1] is None:
+            del self._owners[sock]
+            del self._callbacks[sock]
+            self._readingPaused.discard(sock)
+        events: int = ((selectors.EVENT_READ if callbacks[0] is not None and
+                        sock not in self._readingPaused else 0) |
+                       (selectors.EVENT_WRITE if callbacks[1] is not None else 0))
+        try:
+            ioThread.selector.get_key(sock)
+            registered: bool = True
+        except KeyError:
+            registered = False
+        if events == 0:
+            if registered:  # A selector can't watch for no events
+                ioThread.selector.unregister(sock)
+        elif registered:
+            ioThread.selector.modify(sock, events, callbacks)
+        else:
+            ioThread.selector.register(sock, events, callbacks)
+
+    def callSoon(self, callback: ReadyCallback) -> None:
+        with self._lock:
+            self._pending.append(callback)
+        self.wakeup()
+
+    def callLater(self, delay: float, callback: ReadyCallback) -> None:
+        with self._lock:
+            heapq.heappush(self._timers, (monotonic() + delay, self._timerCount, callback))
+            first: bool = self._timers[0][1] == self._timerCount
+            self._timerCount += 1
+        if first and self.thread is not current_thread():
+            self.wakeup()  # Shorten the current select()
+
+    def _drainWakeup(self) -> None:
+        try:
+            while self._wakeupReader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def runOnce(self, timeout: Optional[float]) -> None:
+        if len(self._timers) > 0:
+            with self._lock:
+                untilFirst: float = (max(0.0, self._timers[0][0] - monotonic())
+                                     if len(self._timers) > 0 else timeout)
+            timeout = untilFirst if timeout is None else min(timeout, untilFirst)
+        for key, events in self.selector.select(timeout):
+            # The socket might have been unregistered (and its file descriptor reused) by
+            # an earlier callback of this batch, skip the stale events
+            if events & selectors.EVENT_WRITE and self._isCurrent(key) and key.data[1] is not None:
+                self._call(key.data[1])
+            if events & selectors.EVENT_READ and self._isCurrent(key) and key.data[0] is not None:
+                self._call(key.data[0])
+        if len(self._pending) > 0:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            for callback in pending:
+                self._call(callback)
+        if len(self._timers) > 0:
+            now: float = monotonic()
+            due: list[ReadyCallback] = []
+            with self._lock:
+                while len(self._timers) > 0 and self._timers[0][0] <= now:
+                    due.append(heapq.heappop(self._timers)[2])
+            for callback in due:
+                self._call(callback)
+
+    def _isCurrent(self, key: selectors.SelectorKey) -> bool:
+        return self.selector.get_map().get(key.fd) is key
+
+    @staticmethod
+    def _call(callback: ReadyCallback) -> None:
+        try:
+            callback()
+        except Exception:
+            # A broken callback mustn't stop the other sockets from being served
+            sys.excepthook(*sys.exc_info())
+
+    def close(self) -> None:
+        self.selector.close()
+        self._wakeupReader.close()
+        self._wakeupWriter.close()
+
+
+class EventLoop:
+    """
+    Multiplexes many non-blocking sockets on one or a few I/O threads.
+
+    The readiness callbacks (and so the protocol layers and the onData handlers of the connections)
+    run on the I/O threads, so they must not block for long - every other connection of the same
+    thread waits meanwhile.
+
+    >>> loop = EventLoop(ioThreads=2)
+    >>> loop.start()
+    >>> loop.running
+    True
+    >>> loop.stop()
+    >>> loop.running
+    False
+    """
+    ioThreads: int
+    running: bool
+
+    _threads: list[_IOThread]
+    _startedThreads: list[Thread]  # Not including the thread calling run()
+    _owners: dict[socket.socket, _IOThread]
+    _callbacks: dict[socket.socket, list[Optional[ReadyCallback]]]  # [onReadable, onWritable]
+    _readingPaused: set[socket.socket]
+    _nextThread: int
+    _lock: Lock
+
+    def __init__(self, ioThreads: int = 1):
+        """
+        Creates an event loop.
+        :param ioThreads: How many threads (each with its own selector) serve the sockets
+        """
+        assert ioThreads > 0
+        self.ioThreads = ioThreads
+        self.running = False
+        self._threads = [_IOThread() for _ in range(ioThreads)]
+        self._startedThreads = []
+        self._owners = {}
+        self._callbacks = {}
+        self._readingPaused = set()
+        self._nextThread = 0
+        self._lock = Lock()
+
+    def register(self, sock: socket.socket, onReadable: ReadyCallback) -> None:
+        """
+        Makes the socket non-blocking and calls the callback (on an I/O thread) whenever it has
+        data to read. Use recvBuffer() as the target of sock.recv_into() inside the callback.
+        :param sock: The socket
+        :param onReadable: The callback
+        """
+        sock.setblocking(False)
+        with self._lock:
+            ioThread: _IOThread = self._threads[self._nextThread]
+            self._nextThread = (self._nextThread + 1) % self.ioThreads
+            self._owners[sock] = ioThread
+            ioThread.selector.register(sock, selectors.EVENT_READ, [onReadable, None])
+        ioThread.wakeup()  # Some selectors only see the new socket on their next select()
+
+    def watchWritable(self, sock: socket.socket, onWritable: Optional[ReadyCallback]) -> None:
+        """
+        Calls the callback (on an I/O thread) whenever the socket can accept more data to send,
+        until this is called again with None. The socket doesn't have to be registered, its blocking
+        mode isn't changed then.
+        :param sock: The socket
+        :param onWritable: The callback, None to stop watching
+        """
+        with self._lock:
+            ioThread: Optional[_IOThread] = self._owners.get(sock)
+            if ioThread is None:
+                if onWritable is None:
+                    return
+                ioThread = self._threads[self._nextThread]
+                self._nextThread = (self._nextThread + 1) % self.ioThreads
+                self._owners[sock] = ioThread
+                ioThread.selector.register(sock, selectors.EVENT_WRITE, [None, onWritable])
+            else:
+                onReadable: Optional[ReadyCallback] = ioThread.selector.get_key(sock).data[0]
+                if onReadable is None and onWritable is None:
+                    del self._owners[sock]
+                    ioThread.selector.unregister(sock)
+                    return
+                events: int = ((selectors.EVENT_READ if onReadable is not None else 0) |
+                               (selectors.EVENT_WRITE if onWritable is not None else 0))
+                ioThread.selector.modify(sock, events, [onReadable, onWritable])
+        ioThread.wakeup()
+
+    def unregister(self, sock: socket.socket) -> None:
+        """
+        Stops watching the socket, call this before closing it. Does nothing if it isn't registered.
+        :param sock: The socket
+        """
+        with self._lock:
+            ioThread: Optional[_IOThread] = self._owners.pop(sock, None)
+            if ioThread is None:
+                return
+            try:
+                ioThread.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+
+    def callSoon(self, callback: ReadyCallback) -> None:
+        """
+        Runs the callback on the first I/O thread, thread-safe.
+        :param callback: The callback
+        """
+        self._threads[0].callSoon(callback)
+
+    def callLater(self, delay: float, callback: ReadyCallback) -> None:
+        """
+        Runs the callback on the first I/O thread after the delay, thread-safe.
+        :param delay: The delay in seconds
+        :param callback: The callback
+        """
+        self._threads[0].callLater(delay, callback)
+
+    def recvBuffer(self) -> bytearray:
+        """
+        Returns the receive buffer of the current I/O thread. Its content is only valid until
+        the readiness callback returns.
+        :return: The buffer
+        """
+        for ioThread in self._threads:
+            if ioThread.thread is current_thread():
+                return ioThread.recvBuffer
+        raise RuntimeError("Not called from an I/O thread of this event loop")
+
+    def run(self) -> None:
+        """
+        Runs the loop in the current thread (the other I/O threads are started) until stop().
+        """
+        self._startThreads(1)
+        self._serve(self._threads[0])
+
+    def start(self) -> None:
+        """
+        Runs the loop in background threads until stop().
+        """
+        self._startThreads(0)
+
+    def stop(self) -> None:
+        """
+        Stops the I/O threads after their current iteration, the sockets stay open.
+        """
+        self.running = False
+        for ioThread in self._threads:
+            ioThread.wakeup()
+        for thread in self._startedThreads:
+            if thread is not current_thread():
+                thread.join()
+        self._startedThreads = []
+
+    def _startThreads(self, first: int) -> None:
+        if self.running:
+            raise RuntimeError("The event loop is already running")
+        self.running = True
+        if first == 1:
+            self._threads[0].thread = current_thread()
+        for i in range(first, self.ioThreads):
+            self._threads[i].thread = Thread(target=self._serve, args=(self._threads[i],),
+                                             name=f"EventLoop-{i}", daemon=True)
+            self._threads[i].thread.start()
+            self._startedThreads.append(self._threads[i].thread)
+
+    def _serve(self, ioThread: _IOThread) -> None:
+        _threadState.loop = self
+        try:
+            while self.running:
+                ioThread.runOnce(None)
+        finally:
+            _threadState.loop = None
+
+    def close(self) -> None:
+        """
+        Stops the loop and releases the selectors.
+        """
+        self.stop()
+        for ioThread in self._threads:
+            ioThread.close()
+
+
+_backgroundLoop: Optional[EventLoop] = None
+_backgroundLoopLock: Lock = Lock()
+
+
+def backgroundLoop() -> EventLoop:
+    """
+    Returns the shared event loop (with one background thread) serving the timers and the
+    writability callbacks of the code that doesn't run on its own loop.
+    :return: The running loop
+    """
+    global _backgroundLoop
+    with _backgroundLoopLock:
+        if _backgroundLoop is None:
+            _backgroundLoop = EventLoop()
+            _backgroundLoop.start()
+        return _backgroundLoop
+
+
+def callLater(delay: float, callback: ReadyCallback,
+              eventLoop: Optional[EventLoop] = None) -> None:
+    """
+    Runs the callback after the delay on the event loop, or on the background loop.
+    :param delay: The delay in seconds
+    :param callback: The callback, it must not block for long
+    :param eventLoop: The event loop, None for the background loop
+    """
+    (eventLoop if eventLoop is not None else backgroundLoop()).callLater(delay, callback)
+
+
+__all__ = ["EventLoop", "waitWritable", "callLater", "backgroundLoop", "inIOThread",
+           "RECV_BUFFER_SIZE"]
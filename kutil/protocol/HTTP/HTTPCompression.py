@@ -0,0 +1,275 @@
+#  -*- coding: utf-8 -*-
+"""
+The content encoding (gzip, deflate) of the HTTP responses, negotiated by the Accept-Encoding header.
+
+Assign an HTTPCompressor to ``HTTPServer.compressor`` before calling listen(). The bodies that are
+sent repeatedly (static assets, cached API responses...) are compressed once, a CompressionCache
+keeps the compressed variants keyed by the hash of the body.
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+import zlib
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
+from typing import Final, Optional, Iterable, AsyncIterable, Iterator, AsyncIterator
+
+from kutil.buffer.FileByteBuffer import FileByteBuffer
+from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
+
+# The supported encodings and their zlib window bits, in the order of our preference
+ENCODINGS: Final[dict[str, int]] = {
+    "gzip": 16 + zlib.MAX_WBITS,  # The gzip header and trailer
+    "deflate": zlib.MAX_WBITS,  # HTTP's "deflate" is the zlib format, not the raw deflate
+}
+
+type TCompressionKey = tuple[bytes, str, int]  # The body's hash, encoding, level
+
+
+def negotiateEncoding(acceptEncoding: Optional[str],
+                      encodings: Iterable[str] = ENCODINGS) -> Optional[str]:
+    """
+    Picks the content encoding the client prefers the most.
+    :param acceptEncoding: The Accept-Encoding header's value, None if missing
+    :param encodings: The encodings we support, in the order of our preference (for equal weights)
+    :return: The encoding, None to send the body as it is
+    """
+    if not acceptEncoding:
+        return None
+    weights: dict[str, float] = {}
+    for part in acceptEncoding.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        weight: float = 1
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0
+        if coding:
+            weights[coding] = weight
+
+    best: Optional[str] = None
+    bestWeight: float = 0
+    for encoding in encodings:
+        weight: float = weights.get(encoding, weights.get("*", 0))
+        if weight > bestWeight:
+            best, bestWeight = encoding, weight
+    return best
+
+
+def compressBody(data: bytes | bytearray | memoryview, encoding: str, level: int) -> bytes:
+    """
+    Compresses a whole body.
+    :param data: The body
+    :param encoding: One of ENCODINGS
+    :param level: The zlib compression level (1-9)
+    :return: The encoded body
+    """
+    return zlib.compress(data, level, ENCODINGS[encoding])
+
+
+class CompressionCache:
+    """
+    An LRU cache of compressed bodies with a byte budget, keyed by the hash of the original body -
+    the same content is compressed once, whichever response sends it.
+    """
+    DEFAULT_BUDGET: Final[int] = 16 * 1024 * 1024  # 16 MB
+
+    budget: int  # The maximum total size of the compressed bodies in bytes
+    hits: int
+    misses: int
+    evictions: int
+
+    _entries: OrderedDict[TCompressionKey, bytes]
+    _size: int
+    _lock: Lock
+
+    def __init__(self, budget: int = DEFAULT_BUDGET):
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    def get(self, data: bytes | bytearray | memoryview, encoding: str, level: int) -> bytes:
+        """
+        Returns the cached compressed body, otherwise compresses and caches it.
+        :param data: The body
+        :param encoding: One of ENCODINGS
+        :param level: The zlib compression level
+        :return: The encoded body
+        """
+        key: TCompressionKey = (blake2b(data, digest_size=16).digest(), encoding, level)
+        with self._lock:
+            compressed: Optional[bytes] = self._entries.get(key)
+            if compressed is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+
+        compressed: bytes = compressBody(data, encoding, level)  # Outside the lock, it's slow
+        with self._lock:
+            if key not in self._entries and len(compressed) <= self.budget:
+                self._entries[key] = compressed
+                self._size += len(compressed)
+                self._evict()
+        return compressed
+
+    def clear(self) -> None:
+        """
+        Forgets all the compressed bodies and resets the statistics.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def _evict(self) -> None:
+        while self._size > self.budget:
+            _, compressed = self._entries.popitem(last=False)
+            self._size -= len(compressed)
+            self.evictions += 1
+
+    @property
+    def size(self) -> int:
+        """The total size of the compressed bodies in bytes."""
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return (f"CompressionCache(entries={len(self)}, size={self._size}, budget={self.budget}, "
+                f"hits={self.hits}, misses={self.misses}, evictions={self.evictions})")
+
+
+class HTTPCompressor:
+    """
+    Encodes the response bodies the client accepts compressed. Only the bodies of the compressible
+    types (see mimeTypes) are encoded, the small ones (see minSize) aren't worth it. The responses
+    of those types get ``Vary: Accept-Encoding``, so that the caches keep the variants apart.
+
+    A streamed body is compressed as it's produced, each of its pieces is flushed to the client.
+    A FileByteBuffer body is left for os.sendfile.
+    """
+    MIN_SIZE: Final[int] = 1024  # Bytes, smaller bodies are sent as they are
+    LEVEL: Final[int] = 6
+    MIME_TYPES: Final[frozenset[str]] = frozenset((
+        "text/html", "text/plain", "text/css", "text/javascript", "text/xml", "text/csv",
+        "text/markdown", "application/json", "application/javascript", "application/xml",
+        "application/wasm", "application/x-ndjson", "image/svg+xml", "image/x-icon",
+    ))
+    MIME_SUFFIXES: Final[tuple[str, ...]] = ("+json", "+xml")  # E.g., application/ld+json
+
+    minSize: int
+    level: int
+    mimeTypes: set[str]  # Without the parameters, e.g., "text/html"
+    encodings: list[str]  # The encodings to offer, in the order of our preference
+    cache: Optional[CompressionCache]  # None to compress every body again
+
+    def __init__(self, minSize: int = MIN_SIZE, level: int = LEVEL,
+                 cache: Optional[CompressionCache] = None, useCache: bool = True):
+        """
+        Creates a compressor.
+        :param minSize: The smallest body (in bytes) to compress
+        :param level: The zlib compression level (1-9)
+        :param cache: The cache of the compressed bodies (e.g., shared by more servers), optional
+        :param useCache: Whether to create a cache if none is given
+        """
+        assert 1 <= level <= 9
+        self.minSize = minSize
+        self.level = level
+        self.mimeTypes = set(self.MIME_TYPES)
+        self.encodings = list(ENCODINGS)
+        self.cache = cache if cache is not None or not useCache else CompressionCache()
+
+    def isCompressible(self, contentType: Optional[str]) -> bool:
+        """
+        Returns whether the bodies of the type are worth compressing.
+        :param contentType: The Content-Type header's value, None if missing
+        """
+        if contentType is None:
+            return False
+        mimeType: str = contentType.partition(";")[0].strip().lower()
+        return mimeType in self.mimeTypes or mimeType.endswith(self.MIME_SUFFIXES)
+
+    def compress(self, resp: HTTPResponse, acceptEncoding: Optional[str]) -> Optional[str]:
+        """
+        Encodes the response's body if the client accepts it, setting the headers.
+        :param resp: The final response to send
+        :param acceptEncoding: The request's Accept-Encoding header's value, None if missing
+        :return: The used encoding, None if the body is sent as it is
+        """
+        headers = resp.headers
+        if (resp.statusCode < 200 or resp.statusCode in (204, 206, 304) or
+                "Content-Encoding" in headers or not self.isCompressible(headers.get("Content-Type"))):
+            return None
+        cacheControl: Optional[str] = headers.get("Cache-Control")
+        if cacheControl is not None and "no-transform" in cacheControl.lower():
+            return None
+        addVary(resp, "Accept-Encoding")  # Even if this client gets the body as it is
+
+        body = resp.body
+        if isinstance(body, FileByteBuffer):
+            return None
+        encoding: Optional[str] = negotiateEncoding(acceptEncoding, self.encodings)
+        if encoding is None:
+            return None
+        if resp.isStreamed:
+            resp.body = (self._compressAsync(body, encoding) if hasattr(body, "__aiter__")
+                         else self._compressStream(body, encoding))
+        else:
+            if len(body) < self.minSize:
+                return None
+            data: bytes | bytearray | memoryview = (body if isinstance(body, bytes | bytearray |
+                                                                       memoryview) else bytes(body))
+            compressed: bytes = (self.cache.get(data, encoding, self.level) if self.cache is not None
+                                 else compressBody(data, encoding, self.level))
+            if len(compressed) >= len(data):
+                return None  # Already compressed data (e.g., an image sent as an icon)
+            resp.body = compressed
+        headers["Content-Encoding"] = encoding
+        etag: Optional[str] = headers.get("ETag")
+        if etag is not None and etag.endswith('"') and not etag.startswith("W/"):
+            # A strong ETag identifies the exact bytes, the encoded variant needs its own
+            headers["ETag"] = f'{etag[:-1]}-{encoding}"'
+        return encoding
+
+    def _compressStream(self, body: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, ENCODINGS[encoding])
+        for data in body:
+            if len(data) > 0:
+                yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+    async def _compressAsync(self, body: AsyncIterable[bytes], encoding: str) -> AsyncIterator[bytes]:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, ENCODINGS[encoding])
+        async for data in body:
+            if len(data) > 0:
+                yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+def addVary(resp: HTTPResponse, name: str) -> None:
+    """
+    Adds the request header's name to the response's Vary header, unless it's there already.
+    :param resp: The response
+    :param name: The request header's name the response depends on
+    """
+    vary: Optional[str] = resp.headers.get("Vary")
+    if vary is None:
+        resp.headers["Vary"] = name
+        return
+    tokens: set[str] = {token.strip().lower() for token in vary.split(",")}
+    if "*" not in tokens and name.lower() not in tokens:
+        resp.headers["Vary"] = f"{vary}, {name}"
+
+
+__all__ = ["HTTPCompressor", "CompressionCache", "negotiateEncoding", "compressBody", "addVary",
+           "ENCODINGS"]
@@ -1,50 +1,229 @@
 #  -*- coding: utf-8 -*-
 __author__ = "kubik.augustyn@post.cz"
 
-from typing import Any
-
-
-# https://stackoverflow.com/questions/2082152/case-insensitive-dictionary
-class CaseInsensitiveKey(object):
-    key: str
-
-    def __init__(self, key: str) -> None:
-        self.key = key
-
-    def __hash__(self) -> int:
-        return hash(self.key.lower())
-
-    def __eq__(self, other) -> bool:
-        return self.key.lower() == other.key.lower()
-
-    def __str__(self) -> str:
-        return self.key
-
-    def __repr__(self) -> str:
-        return f"<CaseInsensitiveKey '{self.key}'>"
-
-
-class HTTPHeaders(dict[str, str]):
-    def __init__(self) -> None:
-        super().__init__()
+from collections.abc import MutableMapping
+from typing import Any, Iterator, Final, Optional
+
+# The common names, stored in this spelling and written with the pre-encoded bytes
+COMMON_NAMES: Final[tuple[str, ...]] = (
+    "Accept", "Accept-Encoding", "Accept-Language", "Accept-Ranges", "Authorization", "Age",
+    "Cache-Control", "Connection", "Content-Disposition", "Content-Encoding", "Content-Length",
+    "Content-Range", "Content-Type", "Cookie", "Date", "ETag", "Expires", "Host",
+    "If-Modified-Since", "If-None-Match", "If-Range", "Keep-Alive", "Last-Modified", "Location",
+    "Origin", "Range", "Referer", "Retry-After", "Sec-WebSocket-Accept", "Sec-WebSocket-Extensions",
+    "Sec-WebSocket-Key", "Sec-WebSocket-Protocol", "Sec-WebSocket-Version", "Server", "Set-Cookie",
+    "Transfer-Encoding", "Upgrade", "User-Agent", "Vary", "X-Omit-Content-Length",
+)
+_INTERNED: Final[dict[str, str]] = {name.lower(): name for name in COMMON_NAMES}
+_ENCODED: Final[dict[str, bytes]] = {name.lower(): name.encode("utf-8") + b': '
+                                     for name in COMMON_NAMES}
+
+
+class HTTPHeaders(MutableMapping[str, str]):
+    """
+    Case-insensitive HTTP headers, keeping the names' spelling and the order they were added in.
+    A name may have more values (see add() and getAll()), headers[name] joins them with ", " - the
+    Cookie values with "; " and the Set-Cookie ones never (it's the first one, use getAll()).
+
+    >>> headers = HTTPHeaders()
+    >>> headers["content-type"] = "text/plain"
+    >>> headers.add("Set-Cookie", "a=1")
+    >>> headers.add("Set-Cookie", "b=2")
+    >>> headers.get("Content-Type"), headers.getAll("set-cookie")
+    ('text/plain', ['a=1', 'b=2'])
+    >>> headers["Set-Cookie"]
+    'a=1'
+    >>> headers.serialize()
+    b'Content-Type: text/plain\\r\\nSet-Cookie: a=1\\r\\nSet-Cookie: b=2\\r\\n\\r\\n'
+
+    The received headers may stay raw (see fromRaw()), a header is decoded only when it's accessed.
+    """
+    _headers: dict[str, tuple[str, list[str]]]  # The lowercase name -> (the name, the values)
+    _raw: Optional[bytes]  # The received header lines, None once they were modified
+    # The lowercase name -> (name start, colon, line end) of its lines in _raw, until decoded
+    _rawIndex: Optional[dict[bytes, list[tuple[int, int, int]]]]
+
+    def __init__(self, headers: Any = None) -> None:
+        """
+        Creates the headers.
+        :param headers: A mapping or (name, value) pairs to add, optional
+        """
+        self._headers = {}
+        self._raw = None
+        self._rawIndex = None
+        if isinstance(headers, HTTPHeaders):  # All the values, not the joined ones
+            headers = headers._pairs()
+        if headers is not None:
+            for name, value in (headers.items() if hasattr(headers, "items") else headers):
+                self.add(name, value)
+
+    @classmethod
+    def fromRaw(cls, block: bytes) -> "HTTPHeaders":
+        """
+        Creates the headers from the received header lines, only finding where they are - a header
+        is decoded once it's accessed. Until the headers are modified, serialize() returns the lines
+        byte for byte (e.g., for a proxy).
+        :param block: The header lines separated by CRLF, without the start line and the empty line
+        :return: The headers
+        :exception ValueError: If a line is malformed (decoding a header may raise it later too)
+        """
+        index: dict[bytes, list[tuple[int, int, int]]] = {}
+        start: int = 0
+        while start < len(block):
+            end: int = block.find(b'\r\n', start)
+            if end == -1:
+                end = len(block)
+            colon: int = block.find(b':', start, end)
+            name: bytes = block[start:colon]
+            if colon == -1 or len(name) == 0 or name != name.strip():
+                raise ValueError(f"Invalid header line: {block[start:end]!r}")
+            index.setdefault(name.lower(), []).append((start, colon, end))
+            start = end + 2
+        headers: HTTPHeaders = cls()
+        headers._raw = block
+        headers._rawIndex = index
+        return headers
+
+    @property
+    def raw(self) -> Optional[bytes]:
+        """The received header lines (see fromRaw()), None if they were modified"""
+        return self._raw
+
+    def _rawValues(self, key: str) -> Optional[list[str]]:
+        """Decodes the values of a header that wasn't decoded yet, None if it's missing"""
+        lines: Optional[list[tuple[int, int, int]]] = self._rawIndex.get(key.lower().encode("utf-8"))
+        if lines is None:
+            return None
+        return [self._raw[colon + 1:end].strip(b' \t').decode("utf-8") for _, colon, end in lines]
+
+    def _decode(self) -> None:
+        """Decodes all the raw headers"""
+        if self._rawIndex is None:
+            return
+        for lower, lines in self._rawIndex.items():
+            name: str = self._raw[lines[0][0]:lines[0][1]].decode("utf-8")
+            self._headers[name.lower()] = (_INTERNED.get(name.lower(), name),
+                                           self._rawValues(name))
+        self._rawIndex = None
+
+    def _modify(self) -> None:
+        """Called before the headers are modified, they aren't the received ones anymore"""
+        self._decode()
+        self._raw = None
 
     def __setitem__(self, key: str, value: str) -> None:
-        key = CaseInsensitiveKey(key)
-        super().__setitem__(key, value)
+        if self._raw is not None:
+            self._modify()
+        lower: str = key.lower()
+        self._headers[lower] = (_INTERNED.get(lower, key), [value])
 
     def __getitem__(self, key: str) -> str:
-        key = CaseInsensitiveKey(key)
-        return super().__getitem__(key)
+        if self._rawIndex is not None:
+            values: Optional[list[str]] = self._rawValues(key)
+            if values is None:
+                raise KeyError(key)
+        else:
+            values: list[str] = self._headers[key.lower()][1]
+        return self._join(key, values)
+
+    @staticmethod
+    def _join(key: str, values: list[str]) -> str:
+        """Joins the values of a header the way its syntax allows"""
+        if len(values) == 1:
+            return values[0]
+        lower: str = key.lower()
+        if lower == "set-cookie":  # A cookie's Expires contains a comma, see getAll()
+            return values[0]
+        return ("; " if lower == "cookie" else ", ").join(values)
 
     def __delitem__(self, key: str) -> None:
-        key = CaseInsensitiveKey(key)
-        return super().__delitem__(key)
+        if self._raw is not None:
+            self._modify()
+        del self._headers[key.lower()]
+
+    def __contains__(self, key: object) -> bool:
+        if not isinstance(key, str):
+            return False
+        if self._rawIndex is not None:
+            return key.lower().encode("utf-8") in self._rawIndex
+        return key.lower() in self._headers
+
+    def __iter__(self) -> Iterator[str]:
+        self._decode()
+        return (name for name, _ in self._headers.values())
+
+    def __len__(self) -> int:
+        return len(self._rawIndex) if self._rawIndex is not None else len(self._headers)
 
     def get[T: Any](self, key: str, default: T = None) -> str | T:
-        key = CaseInsensitiveKey(key)
-        if key not in self:
+        if self._rawIndex is not None:
+            values: Optional[list[str]] = self._rawValues(key)
+        else:
+            entry: tuple[str, list[str]] | None = self._headers.get(key.lower())
+            values: Optional[list[str]] = entry[1] if entry is not None else None
+        if values is None:
             return default
-        return super().__getitem__(key)
+        return self._join(key, values)
+
+    def add(self, key: str, value: str) -> None:
+        """
+        Adds a value to the header, keeping its other values (e.g., for Set-Cookie).
+        :param key: The header's name
+        :param value: The value
+        """
+        if self._raw is not None:
+            self._modify()
+        lower: str = key.lower()
+        entry: tuple[str, list[str]] | None = self._headers.get(lower)
+        if entry is None:
+            self._headers[lower] = (_INTERNED.get(lower, key), [value])
+        else:
+            entry[1].append(value)
+
+    def getAll(self, key: str) -> list[str]:
+        """
+        Returns all the values of the header.
+        :param key: The header's name
+        :return: The values, empty if it's missing
+        """
+        if self._rawIndex is not None:
+            return self._rawValues(key) or []
+        entry: tuple[str, list[str]] | None = self._headers.get(key.lower())
+        return list(entry[1]) if entry is not None else []
+
+    def _pairs(self) -> Iterator[tuple[str, str]]:
+        """The (name, value) pairs, a pair for every value of a name"""
+        for name in self:
+            for value in self.getAll(name):
+                yield name, value
+
+    def serialize(self) -> bytes:
+        """
+        Encodes the header lines, including the empty line ending them.
+        :return: The header block
+        """
+        if self._raw is not None:
+            return self._raw + b'\r\n\r\n' if len(self._raw) > 0 else b'\r\n'
+        parts: list[bytes] = []
+        for lower, (name, values) in self._headers.items():
+            prefix: bytes | None = _ENCODED.get(lower)
+            if prefix is None:
+                prefix = name.encode("utf-8") + b': '
+            for value in values:
+                parts += (prefix, value.encode("utf-8"), b'\r\n')
+        parts.append(b'\r\n')
+        return b''.join(parts)
+
+    def copy(self) -> "HTTPHeaders":
+        self._decode()
+        headers: HTTPHeaders = HTTPHeaders()
+        headers._headers = {lower: (name, list(values))
+                            for lower, (name, values) in self._headers.items()}
+        headers._raw = self._raw
+        return headers
+
+    def __repr__(self) -> str:
+        return f"HTTPHeaders({list(self._pairs())})"
 
 
 if __name__ == '__main__':
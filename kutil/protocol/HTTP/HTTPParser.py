@@ -0,0 +1,304 @@
+#  -*- coding: utf-8 -*-
+"""
+A resumable HTTP/1.1 message parser.
+
+>>> from kutil.buffer.MemoryByteBuffer import MemoryByteBuffer
+>>> parser = HTTPParser(HTTPRequest)
+>>> buff = MemoryByteBuffer(b'GET /index.html HTTP/1.1\\r\\nHost: exa')
+>>> parser.parse(buff)
+Traceback (most recent call last):
+    ...
+kutil.protocol.AbstractProtocol.NeedMoreDataError
+>>> _ = buff.write(b'mple.com\\r\\nContent-Length: 2\\r\\n\\r\\nhi')
+>>> req = parser.parse(buff)
+>>> req.method, req.requestURI, req.headers.get("host"), req.body
+(<HTTPMethod.GET: b'GET'>, '/index.html', 'example.com', b'hi')
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+from enum import Enum, unique, auto
+from typing import Final, Optional, Callable
+
+from kutil.buffer.ByteBuffer import ByteBuffer, OutOfBoundsReadError
+from kutil.protocol.AbstractProtocol import NeedMoreDataError
+from kutil.protocol.HTTP.HTTPHeaders import HTTPHeaders
+from kutil.protocol.HTTP.HTTPMethod import HTTPMethod
+from kutil.protocol.HTTP.HTTPRequest import HTTPThing, HTTPRequest
+from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
+
+HEAD_END: Final[bytes] = b"\r\n\r\n"
+
+# Called with every piece of the body as it arrives, then with b'' once the body ended
+type BodySink = Callable[[bytes], None]
+type BodySinkFactory = Callable[[HTTPThing], Optional[BodySink]]
+
+
+@unique
+class _BodyState(Enum):
+    """What part of the body HTTPParser reads next"""
+    DONE = auto()
+    LENGTH = auto()  # The Content-Length body
+    CHUNK_SIZE = auto()
+    CHUNK_DATA = auto()
+    CHUNK_END = auto()  # The CRLF after the chunk's data
+    TRAILERS = auto()  # The header lines after the last chunk
+
+
+class HTTPParseError(ValueError):
+    """A malformed HTTP message, statusCode is the status to answer a request with"""
+    statusCode: int
+    statusPhrase: str
+
+    def __init__(self, message: str, statusCode: int = 400, statusPhrase: str = "Bad Request"):
+        super().__init__(message)
+        self.statusCode = statusCode
+        self.statusPhrase = statusPhrase
+
+
+class HTTPParser:
+    """
+    Parses HTTP/1.1 requests or responses, remembering its state (the head, then the body) and how
+    far it got between the calls, so a message arriving in many small pieces costs O(n).
+    Both Content-Length and chunked (Transfer-Encoding) bodies are supported.
+
+    The buffer's pointer must be at the start of the message on every call (like it is in
+    ProtocolConnection), it's moved past the message only once the whole message was parsed -
+    except when the body goes to a sink (see bodySinkFactory), then the data is consumed as it's
+    processed (see NeedMoreDataError.consumed).
+    """
+    MAX_HEAD_SIZE: int = 64 * 1024  # 64 kB
+    MAX_CHUNK_LINE: int = 4 * 1024  # The chunk size line (with extensions) or a trailer line
+
+    messageType: type[HTTPRequest] | type[HTTPResponse]
+    # Keep the received headers raw, decoding a header once it's accessed (see HTTPHeaders.fromRaw)
+    lazyHeaders: bool
+    # Called with the message once its head is parsed, returns where to stream its body to (or None)
+    bodySinkFactory: Optional[BodySinkFactory]
+    skipBody: bool  # The next message has no body whatever its headers say (a response to HEAD)
+    _searchFrom: int  # Where the next search for the end of the head starts
+    _message: Optional[HTTPThing]  # The message with a parsed head, waiting for its body
+    _offset: int  # How much of the message (at the pointer) was already processed
+    _state: _BodyState
+    _left: int  # The bytes left of the body (or of the current chunk)
+    _body: bytearray  # The body read so far
+    _sink: Optional[BodySink]
+
+    def __init__(self, messageType: type[HTTPRequest] | type[HTTPResponse],
+                 bodySinkFactory: Optional[BodySinkFactory] = None, lazyHeaders: bool = False):
+        """
+        Creates a parser.
+        :param messageType: HTTPRequest or HTTPResponse (or their subclasses)
+        :param bodySinkFactory: Called with the message once its head is parsed, returns a sink to
+         pass the pieces of the body to as they arrive (the message's body stays empty then), or None
+        :param lazyHeaders: Whether to keep the headers raw, decoding a header once it's accessed
+        """
+        self.messageType = messageType
+        self.bodySinkFactory = bodySinkFactory
+        self.lazyHeaders = lazyHeaders
+        self.skipBody = False
+        self.reset()
+
+    def reset(self) -> None:
+        """Forgets the partially parsed message"""
+        self._searchFrom = 0
+        self._message = None
+        self._offset = 0
+        self._state = _BodyState.DONE
+        self._left = 0
+        self._body = bytearray()
+        self._sink = None
+
+    def parse(self, buff: ByteBuffer, target: Optional[HTTPThing] = None) -> HTTPThing:
+        """
+        Parses the message at the buffer's pointer.
+        :param buff: The buffer
+        :param target: The message object to fill, a new one is created by default
+        :return: The message
+        :exception NeedMoreDataError: If the message isn't complete yet, call again with more data
+        :exception HTTPParseError: If the message is malformed
+        """
+        startLeft: int = buff.leftLength()
+        if self._message is None:
+            self._readHead(buff, target)
+        elif self._offset > 0:
+            buff.skip(self._offset)
+        try:
+            while self._state is not _BodyState.DONE:
+                self._readBody(buff)
+        except NeedMoreDataError:
+            processed: int = startLeft - buff.leftLength()
+            if self._sink is not None:
+                # The processed data went to the sink, there's no need to keep it
+                self._offset = 0
+                raise NeedMoreDataError(consumed=processed > 0)
+            if processed > 0:
+                buff.back(processed)
+            self._offset = processed
+            raise
+
+        message: HTTPThing = self._message
+        if self._sink is not None:
+            self._sink(b'')  # The end of the body
+        else:
+            message.body = bytes(self._body)
+        self.reset()
+        return message
+
+    def _readHead(self, buff: ByteBuffer, target: Optional[HTTPThing]) -> None:
+        """Reads the head, moving the pointer past it, or raises NeedMoreDataError"""
+        try:
+            end: int = buff.index(HEAD_END, self._searchFrom)
+        except (IndexError, OutOfBoundsReadError):
+            left: int = buff.leftLength()
+            if left > self.MAX_HEAD_SIZE:
+                raise HTTPParseError("The head is too large", 431,
+                                     "Request Header Fields Too Large")
+            # The end might be split between this and the next piece of data
+            self._searchFrom = max(0, left - len(HEAD_END) + 1)
+            raise NeedMoreDataError
+        if end > self.MAX_HEAD_SIZE:
+            raise HTTPParseError("The head is too large", 431,
+                                 "Request Header Fields Too Large")
+        head: bytearray = buff.read(end + len(HEAD_END))
+        message: HTTPThing = target if target is not None else self.messageType()
+        bodySize: Optional[int] = self._parseHead(message, head[:end])
+        if self.skipBody:
+            bodySize = 0
+        self._message = message
+        if bodySize is None:
+            self._state = _BodyState.CHUNK_SIZE
+        elif bodySize > 0:
+            self._state = _BodyState.LENGTH
+            self._left = bodySize
+        if self._state is not _BodyState.DONE and self.bodySinkFactory is not None:
+            self._sink = self.bodySinkFactory(message)
+
+    def _readBody(self, buff: ByteBuffer) -> None:
+        """Reads the next part of the body, moving the pointer past it, or raises NeedMoreDataError"""
+        if self._state is _BodyState.LENGTH or self._state is _BodyState.CHUNK_DATA:
+            if self._sink is None and self._state is _BodyState.LENGTH:
+                # Wait for the whole body, it's then read at once
+                if buff.leftLength() < self._left:
+                    raise NeedMoreDataError
+            amount: int = min(buff.leftLength(), self._left)
+            if amount == 0:
+                raise NeedMoreDataError
+            data: bytearray = buff.read(amount)
+            if self._sink is not None:
+                self._sink(bytes(data))
+            else:
+                self._body += data
+            self._left -= amount
+            if self._left == 0:
+                self._state = (_BodyState.CHUNK_END if self._state is _BodyState.CHUNK_DATA else
+                               _BodyState.DONE)
+        elif self._state is _BodyState.CHUNK_SIZE:
+            line: bytearray = self._readLine(buff)
+            try:
+                size: int = int(line.split(b';', 1)[0].strip(b' \t'), 16)
+            except ValueError as e:
+                raise HTTPParseError(f"Invalid chunk size: {bytes(line)!r}") from e
+            if size < 0:
+                raise HTTPParseError(f"Invalid chunk size: {bytes(line)!r}")
+            self._left = size
+            self._state = _BodyState.CHUNK_DATA if size > 0 else _BodyState.TRAILERS
+        elif self._state is _BodyState.CHUNK_END:
+            if not buff.has(len(HTTPThing.CRLF)):
+                raise NeedMoreDataError
+            if buff.read(len(HTTPThing.CRLF)) != HTTPThing.CRLF:
+                raise HTTPParseError("A chunk doesn't end with CRLF")
+            self._state = _BodyState.CHUNK_SIZE
+        elif self._state is _BodyState.TRAILERS:
+            line: bytearray = self._readLine(buff)
+            if len(line) == 0:
+                self._state = _BodyState.DONE
+            else:
+                self._parseHeader(self._message.headers, line)
+
+    def _readLine(self, buff: ByteBuffer) -> bytearray:
+        """Reads a line (without the CRLF), or raises NeedMoreDataError"""
+        try:
+            end: int = buff.index(HTTPThing.CRLF)
+        except (IndexError, OutOfBoundsReadError):
+            if buff.leftLength() > self.MAX_CHUNK_LINE:
+                raise HTTPParseError("A chunk size or trailer line is too long")
+            raise NeedMoreDataError
+        line: bytearray = buff.read(end)
+        buff.skip(len(HTTPThing.CRLF))
+        return line
+
+    def _parseHead(self, message: HTTPThing, head: bytearray) -> Optional[int]:
+        """
+        Parses the start line and the headers into the message.
+        :return: The size of the body, None if it's chunked
+        """
+        startEnd: int = head.find(HTTPThing.CRLF)
+        startLine: bytearray = head[:startEnd] if startEnd != -1 else head
+        block: bytearray = head[startEnd + len(HTTPThing.CRLF):] if startEnd != -1 else bytearray()
+        try:
+            if isinstance(message, HTTPRequest):
+                method, requestURI, version = startLine.split(HTTPThing.SP)
+                message.method = HTTPMethod(bytes(method))
+                message.requestURI = HTTPThing.dec(requestURI)
+            else:
+                version, statusCode, statusPhrase = (startLine.split(HTTPThing.SP, maxsplit=2)
+                                                     + [b''])[:3]
+                message.statusCode = int(statusCode)
+                message.statusPhrase = HTTPThing.dec(statusPhrase)
+        except (ValueError, UnicodeDecodeError) as e:
+            raise HTTPParseError(f"Invalid start line: {bytes(startLine)!r}") from e
+        if version != HTTPThing.VERSION:
+            raise HTTPParseError(f"Unsupported HTTP version - supported {HTTPThing.VERSION}, "
+                                 f"got {bytes(version)}", 505, "HTTP Version Not Supported")
+
+        if self.lazyHeaders:
+            try:
+                headers: HTTPHeaders = HTTPHeaders.fromRaw(bytes(block))
+            except ValueError as e:
+                raise HTTPParseError(str(e)) from e
+        else:
+            headers: HTTPHeaders = HTTPHeaders()
+            if len(block) > 0:
+                for line in block.split(HTTPThing.CRLF):
+                    self._parseHeader(headers, line)
+        message.headers = headers
+        try:
+            return self._bodySize(message, headers)
+        except UnicodeDecodeError as e:  # A lazily decoded header
+            raise HTTPParseError(f"Invalid header: {e}") from e
+
+    @staticmethod
+    def _bodySize(message: HTTPThing, headers: HTTPHeaders) -> Optional[int]:
+        """Returns the size of the message's body, None if it's chunked"""
+        if isinstance(message, HTTPResponse) and (100 <= message.statusCode < 200 or
+                                                  message.statusCode in (204, 304)):
+            return 0  # These never have a body
+        if headers.get("Transfer-Encoding") is not None:
+            if not message.isChunked:
+                raise HTTPParseError(f"Unsupported Transfer-Encoding: "
+                                     f"{headers.get('Transfer-Encoding')}", 501, "Not Implemented")
+            return None  # The Transfer-Encoding overrides the Content-Length
+        contentLength: Optional[str] = headers.get("Content-Length")
+        if contentLength is None:
+            return 0
+        try:
+            bodySize: int = int(contentLength)
+        except ValueError as e:
+            raise HTTPParseError(f"Invalid Content-Length: {contentLength}") from e
+        if bodySize < 0:
+            raise HTTPParseError(f"Invalid Content-Length: {contentLength}")
+        return bodySize
+
+    @staticmethod
+    def _parseHeader(headers: HTTPHeaders, line: bytearray) -> None:
+        """Parses a header (or a trailer) line into the headers"""
+        name, sep, value = line.partition(b':')
+        if not sep or len(name) == 0 or name != name.strip():
+            raise HTTPParseError(f"Invalid header line: {bytes(line)!r}")
+        try:
+            headers.add(HTTPThing.dec(name), HTTPThing.dec(value.strip(b' \t')))
+        except UnicodeDecodeError as e:
+            raise HTTPParseError(f"Invalid header line: {bytes(line)!r}") from e
+
+
+__all__ = ["HTTPParser", "HTTPParseError", "BodySink", "BodySinkFactory"]
@@ -7,7 +7,10 @@ from kutil.buffer.ByteBuffer import ByteBuffer, ByteBufferLike
 from kutil.buffer.Serializable import Serializable
 from kutil.protocol.HTTP.HTTPMethod import HTTPMethod
 from kutil.protocol.HTTP.HTTPHeaders import HTTPHeaders
-from typing import Final, Optional
+from kutil.protocol.URLSearchParams import URLSearchParams
+from typing import Final, Optional, Iterable, AsyncIterable, Iterator, Sized
+
+type BodyChunks = Iterable[bytes] | AsyncIterable[bytes]  # A streamed body, see HTTPThing.isStreamed
 
 
 class HTTPThing(Serializable):
@@ -15,31 +18,71 @@ class HTTPThing(Serializable):
     CRLF: Final[bytes] = b"\r\n"
     SP: Final[bytes] = b" "
     HEADER_SEP: Final[bytes] = b": "
+    CHUNKED_END: Final[bytes] = b"0\r\n\r\n"
 
     headers: HTTPHeaders
-    body: ByteBufferLike
+    # A streamed body (an iterator, a generator...) is sent with the chunked transfer encoding
+    body: ByteBufferLike | BodyChunks
 
     def __init__(self, headers: Optional[HTTPHeaders] = None,
-                 body: Optional[ByteBufferLike] = None):
-        self.headers = headers or {}
-        self.body = body or b''
+                 body: Optional[ByteBufferLike | BodyChunks] = None):
+        # An empty HTTPHeaders is falsy, don't replace it with a case-sensitive dict
+        self.headers = headers if headers is not None else HTTPHeaders()
+        self.body = body if body is not None else b''
 
     def write(self, buff: ByteBuffer):
         raise NotImplementedError
 
     def writeRest(self, buff: ByteBuffer):
-        # Make sure the content-length is present and correct
-        if self.headers.get("X-Omit-Content-Length", "0") != "1":
+        """
+        Writes the headers and the body. A streamed body isn't written, send iterChunks() after it.
+        """
+        if self.isStreamed:
+            self.headers["Transfer-Encoding"] = "chunked"
+            if self.headers.get("Content-Length") is not None:
+                del self.headers["Content-Length"]
+        elif self.headers.get("X-Omit-Content-Length", "0") != "1":
+            # Make sure the content-length is present and correct
             self.headers["Content-Length"] = str(len(self.body))
+            if self.headers.get("Transfer-Encoding") is not None:
+                del self.headers["Transfer-Encoding"]  # E.g., a received chunked message sent on
         else:
             # The magic header is the only way to implement SSE
             del self.headers["X-Omit-Content-Length"]
 
-        for name, value in self.headers.items():
-            buff.write(self.enc(str(name))).write(self.HEADER_SEP).write(self.enc(value)).write(
-                self.CRLF)
-        buff.write(self.CRLF)
-        buff.write(self.body)
+        buff.write(self.headers.serialize())
+        if not self.isStreamed:
+            buff.write(self.body)
+
+    @property
+    def isStreamed(self) -> bool:
+        """Whether the body is produced piece by piece (it doesn't know its length)"""
+        return not isinstance(self.body, Sized)
+
+    @property
+    def isChunked(self) -> bool:
+        """Whether the message uses the chunked transfer encoding"""
+        encoding: Optional[str] = self.headers.get("Transfer-Encoding")
+        return encoding is not None and encoding.rsplit(",", 1)[-1].strip().lower() == "chunked"
+
+    @staticmethod
+    def encodeChunk(data: bytes | bytearray | memoryview) -> bytes:
+        """
+        Encodes a piece of a streamed body as one chunk.
+        :param data: The piece, mustn't be empty (that's the last chunk)
+        :return: The chunk
+        """
+        return b'%x\r\n%b\r\n' % (len(data), data)
+
+    def iterChunks(self) -> Iterator[bytes]:
+        """
+        Encodes the (synchronous) streamed body, ending with the last chunk.
+        :return: The chunks to send after the head
+        """
+        for data in self.body:
+            if len(data) > 0:
+                yield self.encodeChunk(data)
+        yield self.CHUNKED_END
 
     def read(self, buff: ByteBuffer):
         raise NotImplementedError
@@ -49,7 +92,7 @@ class HTTPThing(Serializable):
         self.headers = HTTPHeaders()
         while len(line) > 0:
             name, value = line.split(self.HEADER_SEP, maxsplit=1)
-            self.headers[self.dec(name)] = self.dec(value)
+            self.headers.add(self.dec(name), self.dec(value))
             line = buff.readLine(self.CRLF)
         try:
             bodySize: int = max(0, int(self.headers.get("Content-Length", "0")))
@@ -57,6 +100,10 @@ class HTTPThing(Serializable):
             bodySize: int = 0
         self.body = bytes(buff.read(bodySize))
 
+    @property
+    def bodyDescription(self) -> str:
+        return "streamed body" if self.isStreamed else f"body length: {len(self.body)}"
+
     @property
     def json(self) -> dict:
         if self.body is None or len(self.body) == 0:
@@ -91,12 +138,19 @@ class HTTPThing(Serializable):
 class HTTPRequest(HTTPThing):
     method: HTTPMethod
     requestURI: str
+    routeParams: dict[str, str]  # The parameters captured from the path by a Router
+    _query: Optional[URLSearchParams]  # Parsed on the first use
+    _queryURI: Optional[str]  # The requestURI the query was parsed from
 
     def __init__(self, method: Optional[HTTPMethod] = None, requestURI: Optional[str] = None,
-                 headers: Optional[HTTPHeaders] = None, body: Optional[bytes] = None):
+                 headers: Optional[HTTPHeaders] = None,
+                 body: Optional[ByteBufferLike | BodyChunks] = None):
         super().__init__(headers, body)
         self.method = method or HTTPMethod.GET
         self.requestURI = requestURI or "/"
+        self.routeParams = {}
+        self._query = None
+        self._queryURI = None
 
     def write(self, buff: ByteBuffer):
         buff.write(self.method.value).write(self.SP).write(self.enc(self.requestURI)).write(
@@ -105,13 +159,27 @@ class HTTPRequest(HTTPThing):
         self.writeRest(buff)
 
     def read(self, buff: ByteBuffer):
-        method, requestURI, version = buff.readLine(self.CRLF).split(self.SP)
-        self.method = HTTPMethod(method)
-        self.requestURI = self.dec(requestURI)
-        if version != self.VERSION:
-            raise ValueError(f"Unsupported HTTP version - supported {self.VERSION}, got {version}")
-        self.readRest(buff)
+        """
+        Reads the whole request, see HTTPParser (keep one around to parse partial data repeatedly).
+        :exception NeedMoreDataError: If the request isn't complete, the pointer isn't moved then
+        :exception HTTPParseError: If the request is malformed
+        """
+        from kutil.protocol.HTTP.HTTPParser import HTTPParser
+        HTTPParser(type(self)).parse(buff, self)
+
+    @property
+    def path(self) -> str:
+        """The requestURI without the query"""
+        return self.requestURI.partition("?")[0]
+
+    @property
+    def query(self) -> URLSearchParams:
+        """The query parameters of the requestURI, parsed on the first use"""
+        if self._query is None or self._queryURI is not self.requestURI:
+            self._query = URLSearchParams(self.requestURI.partition("?")[2])
+            self._queryURI = self.requestURI
+        return self._query
 
     def __str__(self) -> str:
         return (f"<HTTP Request - {self.method.name} {self.requestURI} {self.dec(self.VERSION)}, "
-                f"{len(self.headers)} headers, body length: {len(self.body)}>")
+                f"{len(self.headers)} headers, {self.bodyDescription}>")
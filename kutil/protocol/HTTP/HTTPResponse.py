@@ -1,10 +1,9 @@
 #  -*- coding: utf-8 -*-
 __author__ = "kubik.augustyn@post.cz"
 
-from kutil.buffer.ByteBuffer import ByteBuffer
+from kutil.buffer.ByteBuffer import ByteBuffer, ByteBufferLike
 from kutil.protocol.HTTP.HTTPHeaders import HTTPHeaders
-from kutil.protocol.HTTP.HTTPRequest import HTTPThing
-from kutil.protocol.AbstractProtocol import NeedMoreDataError
+from kutil.protocol.HTTP.HTTPRequest import HTTPThing, BodyChunks
 from typing import Optional
 
 
@@ -13,7 +12,8 @@ class HTTPResponse(HTTPThing):
     statusPhrase: str
 
     def __init__(self, statusCode: Optional[int] = None, statusPhrase: Optional[str] = None,
-                 headers: Optional[HTTPHeaders] = None, body: Optional[bytes] = None):
+                 headers: Optional[HTTPHeaders] = None,
+                 body: Optional[ByteBufferLike | BodyChunks] = None):
         super().__init__(headers, body)
         self.statusCode = statusCode or 200
         self.statusPhrase = statusPhrase or "OK"
@@ -26,18 +26,14 @@ class HTTPResponse(HTTPThing):
         self.writeRest(buff)
 
     def read(self, buff: ByteBuffer):
-        # Status line
-        version, statusCode, statusPhrase = buff.readLine(self.CRLF).split(self.SP, maxsplit=2)
-        self.statusCode = int(self.dec(statusCode))
-        self.statusPhrase = self.dec(statusPhrase)
-        if version != self.VERSION:
-            raise ValueError
-        # Rest
-        self.readRest(buff)
-        # Content-Length is required lol, if not provided (None), throws ValueError --> NeedMoreDataError
-        if int(self.headers.get("Content-Length")) > len(self.body):
-            raise NeedMoreDataError
+        """
+        Reads the whole response, see HTTPParser (keep one around to parse partial data repeatedly).
+        :exception NeedMoreDataError: If the response isn't complete, the pointer isn't moved then
+        :exception HTTPParseError: If the response is malformed
+        """
+        from kutil.protocol.HTTP.HTTPParser import HTTPParser
+        HTTPParser(type(self)).parse(buff, self)
 
     def __str__(self) -> str:
         return (f"<HTTP Response - {self.dec(self.VERSION)} {self.statusCode} {self.statusPhrase}, "
-                f"{len(self.headers)} headers, body length: {len(self.body)}>")
+                f"{len(self.headers)} headers, {self.bodyDescription}>")
@@ -0,0 +1,310 @@
+#  -*- coding: utf-8 -*-
+"""
+A cache of whole HTTP responses in front of the handlers, used as Router middleware - a hit skips
+the handler and sends the response's bytes as they were serialized when it was stored.
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+from collections import OrderedDict
+from threading import Lock, Event
+from time import monotonic
+from typing import Final, Optional, Any
+
+from kutil.buffer.ByteBuffer import ByteBuffer
+from kutil.buffer.MemoryByteBuffer import MemoryByteBuffer
+from kutil.protocol.HTTP.HTTPMethod import HTTPMethod
+from kutil.protocol.HTTP.HTTPHeaders import HTTPHeaders
+from kutil.protocol.HTTP.HTTPRequest import HTTPRequest
+from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
+from kutil.protocol.HTTP.HTTPCompression import negotiateEncoding
+from kutil.protocol.HTTP.Router import RouteHandler
+
+type TBaseKey = tuple[HTTPMethod, str]  # The method, the request URI (the path and the query)
+type TCacheKey = tuple[HTTPMethod, str, tuple[Optional[str], ...]]  # + the Vary-selected values
+
+
+class SerializedResponse(HTTPResponse):
+    """
+    A response sent as the bytes it was serialized to, only the headers added to it afterward
+    (e.g., Connection, Age) are serialized when it's sent.
+    """
+    data: bytes  # The status line, the header lines and the body
+    headEnd: int  # Where the header lines end (before the empty line) in data
+
+    def __init__(self, statusCode: int, statusPhrase: str, data: bytes, headEnd: int):
+        super().__init__(statusCode, statusPhrase, HTTPHeaders(), memoryview(data)[headEnd + 2:])
+        self.data = data
+        self.headEnd = headEnd
+
+    @classmethod
+    def serialize(cls, resp: HTTPResponse, excluded: tuple[str, ...] = ()) -> "SerializedResponse":
+        """
+        Serializes a response with a body of a known length.
+        :param resp: The response, it isn't modified
+        :param excluded: The headers to leave out (e.g., the per-connection ones)
+        :return: The serialized response
+        """
+        copy: HTTPResponse = HTTPResponse(resp.statusCode, resp.statusPhrase, resp.headers.copy(),
+                                          resp.body)
+        for name in excluded:
+            if name in copy.headers:
+                del copy.headers[name]
+        buff: MemoryByteBuffer = MemoryByteBuffer()
+        copy.write(buff)
+        data: bytes = buff.export()
+        return cls(resp.statusCode, resp.statusPhrase, data,
+                   data.index(cls.CRLF + cls.CRLF) + len(cls.CRLF))
+
+    def write(self, buff: ByteBuffer):
+        view: memoryview = memoryview(self.data)
+        buff.write(view[:self.headEnd])
+        buff.write(self.headers.serialize())  # Ends with the empty line
+        buff.write(self.body)
+
+    def copy(self) -> "SerializedResponse":
+        """Returns the response sharing the bytes, with its own headers to add"""
+        return SerializedResponse(self.statusCode, self.statusPhrase, self.data, self.headEnd)
+
+
+class _CacheEntry:
+    response: SerializedResponse
+    storedAt: float  # time.monotonic()
+    expiresAt: float
+
+    def __init__(self, response: SerializedResponse, storedAt: float, expiresAt: float):
+        self.response = response
+        self.storedAt = storedAt
+        self.expiresAt = expiresAt
+
+
+class ResponseCache:
+    """
+    An LRU cache of whole responses with a byte budget, keyed by the method, the request URI and
+    the request headers named by the response's Vary. Use it as Router middleware, e.g.,
+    ``router.use(ResponseCache())`` or only for some routes.
+
+    Only the GET requests without ``Cache-Control: no-store`` and ``Authorization`` are served from
+    the cache. A response is stored for its ``Cache-Control: max-age`` (or ``s-maxage``), or for
+    defaultMaxAge if it doesn't say, unless it's ``no-store``, ``no-cache`` or ``private``, sets
+    a cookie, varies on ``*`` or is streamed. Concurrent misses of the same response wait for the
+    first one to fill it (single-flight), so the handler runs once.
+
+    If the connection has a compressor (see HTTPServer.compressor), the response is compressed
+    before it's stored, the compressed variants are keyed by the negotiated encoding.
+    """
+    DEFAULT_BUDGET: Final[int] = 64 * 1024 * 1024  # 64 MB
+    MAX_ENTRY_SIZE: Final[int] = 8 * 1024 * 1024  # Bigger responses aren't stored
+    FILL_TIMEOUT: Final[float] = 30  # Seconds a miss waits for a concurrent fill
+    CACHEABLE_STATUS: Final[frozenset[int]] = frozenset((200, 203, 204, 300, 301, 308, 404, 410))
+    # The hop-by-hop headers, the connection adds its own
+    EXCLUDED_HEADERS: Final[tuple[str, ...]] = ("Connection", "Keep-Alive", "Server", "Age")
+
+    budget: int  # The maximum total size of the stored responses in bytes
+    maxEntrySize: int
+    defaultMaxAge: float  # Seconds to store the responses without max-age for, 0 to not store them
+    # Statistics
+    hits: int
+    misses: int
+    stores: int
+    evictions: int
+    coalesced: int  # The misses that waited for a concurrent fill
+
+    _entries: OrderedDict[TCacheKey, _CacheEntry]
+    _vary: dict[TBaseKey, tuple[str, ...]]  # The lowercase names of the Vary headers
+    _variants: dict[TBaseKey, int]  # How many responses to the request URI are stored
+    _filling: dict[TCacheKey, Event]
+    _size: int
+    _lock: Lock
+
+    def __init__(self, budget: int = DEFAULT_BUDGET, defaultMaxAge: float = 0,
+                 maxEntrySize: int = MAX_ENTRY_SIZE):
+        """
+        Creates a cache.
+        :param budget: The maximum total size of the stored responses in bytes
+        :param defaultMaxAge: Seconds to store the responses without max-age for, 0 to not store
+        :param maxEntrySize: The biggest response to store in bytes
+        """
+        self.budget = budget
+        self.maxEntrySize = maxEntrySize
+        self.defaultMaxAge = defaultMaxAge
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._vary = {}
+        self._variants = {}
+        self._filling = {}
+        self._size = 0
+        self._lock = Lock()
+
+    def __call__(self, conn: Any, req: HTTPRequest,
+                 nextHandler: RouteHandler) -> Optional[HTTPResponse]:
+        """The middleware, returns the stored response or the handler's one"""
+        if not self._isCacheable(req):
+            return nextHandler(conn, req)
+        base: TBaseKey = (req.method, req.requestURI)
+        with self._lock:
+            key: TCacheKey = self._key(base, req, self._vary.get(base, ()))
+            entry: Optional[_CacheEntry] = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return self._respond(entry)
+            filling: Optional[Event] = self._filling.get(key)
+            if filling is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                fill: Event = Event()
+                self._filling[key] = fill
+        if filling is not None:
+            return self._afterFill(conn, req, base, filling, nextHandler)
+        try:
+            resp: Optional[HTTPResponse] = nextHandler(conn, req)
+            if resp is None:
+                return None
+            compressor = getattr(conn, "compressor", None)
+            if compressor is not None:
+                compressor.compress(resp, req.headers.get("Accept-Encoding"))
+            maxAge: Optional[float] = self._maxAge(resp)
+            if maxAge is None:
+                return resp
+            serialized: SerializedResponse = SerializedResponse.serialize(resp,
+                                                                          self.EXCLUDED_HEADERS)
+            self._store(base, req, resp, serialized, maxAge)
+            return resp
+        finally:
+            with self._lock:
+                self._filling.pop(key, None)
+            fill.set()
+
+    def _afterFill(self, conn: Any, req: HTTPRequest, base: TBaseKey, filling: Event,
+                   nextHandler: RouteHandler) -> Optional[HTTPResponse]:
+        """
+        Waits for the concurrent fill, then returns the stored response. If the fill didn't store
+        it (e.g., it isn't cacheable), runs the handler without waiting again, so that the requests
+        of an uncacheable response aren't handled one by one.
+        """
+        filling.wait(self.FILL_TIMEOUT)
+        with self._lock:
+            entry: Optional[_CacheEntry] = self._lookup(self._key(base, req,
+                                                                  self._vary.get(base, ())))
+            if entry is not None:
+                self.hits += 1
+                return self._respond(entry)
+        return nextHandler(conn, req)
+
+    def invalidate(self, requestURI: Optional[str] = None) -> None:
+        """
+        Forgets the stored responses.
+        :param requestURI: Only the responses to this request URI (with the query), None for all
+        """
+        with self._lock:
+            for key in [key for key in self._entries if requestURI in (None, key[1])]:
+                self._remove(key)
+
+    def _isCacheable(self, req: HTTPRequest) -> bool:
+        if req.method is not HTTPMethod.GET or "Authorization" in req.headers:
+            return False
+        cacheControl: Optional[str] = req.headers.get("Cache-Control")
+        return cacheControl is None or "no-store" not in cacheControl.lower()
+
+    def _maxAge(self, resp: HTTPResponse) -> Optional[float]:
+        """Returns for how long to store the response, None to not store it"""
+        if (resp.statusCode not in self.CACHEABLE_STATUS or resp.isStreamed or
+                not isinstance(resp.body, bytes | bytearray | memoryview) or
+                len(resp.body) > self.maxEntrySize or "Set-Cookie" in resp.headers):
+            return None
+        vary: Optional[str] = resp.headers.get("Vary")
+        if vary is not None and vary.strip() == "*":
+            return None
+        maxAge: float = self.defaultMaxAge
+        sharedMaxAge: bool = False
+        for directive in resp.headers.get("Cache-Control", "").lower().split(","):
+            name, _, value = directive.strip().partition("=")
+            if name in ("no-store", "no-cache", "private"):
+                return None
+            if name in ("max-age", "s-maxage") and not (sharedMaxAge and name == "max-age"):
+                try:
+                    maxAge = float(value.strip('"'))
+                except ValueError:
+                    return None
+                sharedMaxAge = name == "s-maxage"  # It takes precedence for a shared cache
+        return maxAge if maxAge > 0 else None
+
+    @staticmethod
+    def _key(base: TBaseKey, req: HTTPRequest, vary: tuple[str, ...]) -> TCacheKey:
+        values: list[Optional[str]] = []
+        for name in vary:
+            value: Optional[str] = req.headers.get(name)
+            if name == "accept-encoding":
+                value = negotiateEncoding(value)  # The variants are per encoding, not per client
+            values.append(value)
+        return base[0], base[1], tuple(values)
+
+    def _lookup(self, key: TCacheKey) -> Optional[_CacheEntry]:
+        entry: Optional[_CacheEntry] = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expiresAt <= monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    @staticmethod
+    def _respond(entry: _CacheEntry) -> SerializedResponse:
+        resp: SerializedResponse = entry.response.copy()
+        resp.headers["Age"] = str(int(monotonic() - entry.storedAt))
+        return resp
+
+    def _store(self, base: TBaseKey, req: HTTPRequest, resp: HTTPResponse,
+               serialized: SerializedResponse, maxAge: float) -> None:
+        vary: tuple[str, ...] = tuple(sorted(
+            {name.strip().lower() for name in resp.headers.get("Vary", "").split(",")
+             if name.strip()}))
+        key: TCacheKey = self._key(base, req, vary)
+        now: float = monotonic()
+        with self._lock:
+            if self._vary.get(base, ()) != vary:  # The old variants can't be found anymore
+                for old in [old for old in self._entries if old[:2] == base]:
+                    self._remove(old)
+            self._vary[base] = vary
+            self._remove(key)
+            if len(serialized.data) > self.budget:
+                return
+            self._entries[key] = _CacheEntry(serialized, now, now + maxAge)
+            self._size += len(serialized.data)
+            self._variants[base] = self._variants.get(base, 0) + 1
+            self.stores += 1
+            while self._size > self.budget:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: TCacheKey) -> None:
+        entry: Optional[_CacheEntry] = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= len(entry.response.data)
+        base: TBaseKey = (key[0], key[1])
+        self._variants[base] -= 1
+        if self._variants[base] == 0:  # Forget the request URI, its Vary may change meanwhile
+            del self._variants[base]
+            self._vary.pop(base, None)
+
+    @property
+    def size(self) -> int:
+        """The total size of the stored responses in bytes."""
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return (f"ResponseCache(entries={len(self)}, size={self._size}, budget={self.budget}, "
+                f"hits={self.hits}, misses={self.misses}, stores={self.stores}, "
+                f"evictions={self.evictions}, coalesced={self.coalesced})")
+
+
+__all__ = ["ResponseCache", "SerializedResponse"]
@@ -0,0 +1,313 @@
+#  -*- coding: utf-8 -*-
+"""
+Dispatches the HTTP requests to their handlers by the method and the path, matched by a radix trie
+(so the matching costs O(path length), however many routes there are).
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+from typing import Callable, Optional, Any, Iterable, Final
+from urllib.parse import unquote
+
+from kutil.protocol.HTTP.HTTPMethod import HTTPMethod
+from kutil.protocol.HTTP.HTTPHeaders import HTTPHeaders
+from kutil.protocol.HTTP.HTTPRequest import HTTPRequest
+from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
+
+# Called with the connection and the request (see HTTPRequest.routeParams), returns the response
+type RouteHandler = Callable[[Any, HTTPRequest], Optional[HTTPResponse]]
+# Called with the connection, the request and the next handler of the chain, returns the response
+# (e.g., the next handler's one, or its own to stop the chain)
+type Middleware = Callable[[Any, HTTPRequest, RouteHandler], Optional[HTTPResponse]]
+
+
+class Route:
+    method: HTTPMethod
+    pattern: str
+    handler: RouteHandler
+    middleware: list[Middleware]  # Run after the router's middleware, in order
+    chain: RouteHandler  # The handler wrapped in all the middleware
+
+    def __init__(self, method: HTTPMethod, pattern: str, handler: RouteHandler,
+                 middleware: Iterable[Middleware] = ()):
+        self.method = method
+        self.pattern = pattern
+        self.handler = handler
+        self.middleware = list(middleware)
+        self.chain = handler
+
+    def compile(self, middleware: list[Middleware]) -> None:
+        """
+        Wraps the handler in the middleware, so a request doesn't build the chain again.
+        :param middleware: The router's middleware, run before the route's one
+        """
+        chain: RouteHandler = self.handler
+        for wrapper in reversed(middleware + self.middleware):
+            chain = self._wrap(wrapper, chain)
+        self.chain = chain
+
+    @staticmethod
+    def _wrap(wrapper: Middleware, nextHandler: RouteHandler) -> RouteHandler:
+        return lambda conn, req: wrapper(conn, req, nextHandler)
+
+    def __repr__(self) -> str:
+        return f"Route({self.method.name} {self.pattern})"
+
+
+class _RouteNode:
+    """A node of the radix trie, its prefix is the static part of the path it matches"""
+    prefix: str
+    children: dict[str, "_RouteNode"]  # The static children by the first character of the prefix
+    paramName: Optional[str]
+    paramChild: Optional["_RouteNode"]  # Matches a :param - up to the next "/"
+    wildcardName: Optional[str]
+    wildcardChild: Optional["_RouteNode"]  # Matches a *wildcard - the rest of the path
+    routes: dict[HTTPMethod, Route]
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self.children = {}
+        self.paramName = None
+        self.paramChild = None
+        self.wildcardName = None
+        self.wildcardChild = None
+        self.routes = {}
+
+    def insertStatic(self, text: str) -> "_RouteNode":
+        """Inserts the static text below this node, returns the node matching its end"""
+        node: _RouteNode = self
+        while len(text) > 0:
+            child: Optional[_RouteNode] = node.children.get(text[0])
+            if child is None:
+                child = _RouteNode(text)
+                node.children[text[0]] = child
+                return child
+            common: int = 0
+            limit: int = min(len(text), len(child.prefix))
+            while common < limit and text[common] == child.prefix[common]:
+                common += 1
+            if common < len(child.prefix):  # Split the child
+                middle: _RouteNode = _RouteNode(child.prefix[:common])
+                child.prefix = child.prefix[common:]
+                middle.children[child.prefix[0]] = child
+                node.children[text[0]] = middle
+                child = middle
+            node = child
+            text = text[common:]
+        return node
+
+    def match(self, method: HTTPMethod, path: str, i: int, params: list[tuple[str, str]],
+              allowed: set[HTTPMethod]) -> Optional["_RouteNode"]:
+        """
+        Matches the rest of the path (after this node's prefix), the static children first, then
+        the parameter, then the wildcard. A node without a route of the method doesn't match, the
+        matching backtracks to the other branches.
+        :param allowed: Collects the methods of the nodes matching the path, but not the method
+        :return: The node with the method's route, None if there's none
+        """
+        if i == len(path):
+            if method in self.routes:
+                return self
+            allowed.update(self.routes)
+            if self.wildcardChild is not None:
+                return self.wildcardChild.matchWildcard(method, self.wildcardName, "", params,
+                                                        allowed)
+            return None
+        child: Optional[_RouteNode] = self.children.get(path[i])
+        if child is not None and path.startswith(child.prefix, i):
+            found: Optional[_RouteNode] = child.match(method, path, i + len(child.prefix), params,
+                                                      allowed)
+            if found is not None:
+                return found
+        if self.paramChild is not None:
+            end: int = path.find("/", i)
+            if end == -1:
+                end = len(path)
+            if end > i:
+                params.append((self.paramName, path[i:end]))
+                found: Optional[_RouteNode] = self.paramChild.match(method, path, end, params,
+                                                                    allowed)
+                if found is not None:
+                    return found
+                params.pop()
+        if self.wildcardChild is not None:
+            return self.wildcardChild.matchWildcard(method, self.wildcardName, path[i:], params,
+                                                    allowed)
+        return None
+
+    def matchWildcard(self, method: HTTPMethod, name: str, value: str,
+                      params: list[tuple[str, str]],
+                      allowed: set[HTTPMethod]) -> Optional["_RouteNode"]:
+        """Matches the rest of the path as this wildcard node's value"""
+        if method not in self.routes:
+            allowed.update(self.routes)
+            return None
+        params.append((name, value))
+        return self
+
+
+class Router:
+    """
+    Matches the (method, path) of the requests to the routes. A route's pattern consists of static
+    parts, ``:name`` parameters (up to the next "/") and a trailing ``*name`` wildcard (the rest of
+    the path), e.g., ``/tile/:mapSet`` or ``/static/*path``. The static parts win over the
+    parameters, the parameters over the wildcards. The captured (decoded) values are in
+    ``req.routeParams``.
+
+    A path without any route gets the notFound handler's response (404), a path with the routes of
+    other methods gets 405 with the Allow header. Use the router as the onData handler of
+    HTTPServer, or call dispatch() in your own one::
+
+        router = Router()
+        router.use(logRequests)  # Middleware of all the routes
+        router.get("/users/:id", getUser)
+        router.add(HTTPMethod.DELETE, "/users/:id", deleteUser, [requireAdmin])
+        server = HTTPServer(address, lambda conn: router)
+    """
+    PARAM: Final[str] = ":"
+    WILDCARD: Final[str] = "*"
+
+    notFound: RouteHandler  # Called when no route matches the path
+    _root: _RouteNode
+    _routes: list[Route]
+    _middleware: list[Middleware]
+
+    def __init__(self):
+        self.notFound = self.notFoundResponse
+        self._root = _RouteNode()
+        self._routes = []
+        self._middleware = []
+
+    def add(self, method: HTTPMethod, pattern: str, handler: RouteHandler,
+            middleware: Iterable[Middleware] = ()) -> Route:
+        """
+        Adds a route.
+        :param method: The request method
+        :param pattern: The path pattern, starting with "/"
+        :param handler: Called with the connection and the request, returns the response
+        :param middleware: Wrap the handler of this route only, after the router's middleware
+        :return: The route
+        :exception ValueError: If the pattern is invalid or conflicts with another route
+        """
+        if not pattern.startswith("/"):
+            raise ValueError(f"The pattern must start with '/': {pattern!r}")
+        node: _RouteNode = self._root
+        i: int = 0
+        while i < len(pattern):
+            special: int = min((pattern.find(char, i) for char in (self.PARAM, self.WILDCARD)
+                                if pattern.find(char, i) != -1), default=len(pattern))
+            node = node.insertStatic(pattern[i:special])
+            if special == len(pattern):
+                break
+            if pattern[special - 1] != "/":
+                raise ValueError(f"A parameter must follow a '/': {pattern!r}")
+            end: int = pattern.find("/", special)
+            if end == -1:
+                end = len(pattern)
+            name: str = pattern[special + 1:end]
+            if not name.isidentifier():
+                raise ValueError(f"Invalid parameter name {name!r} in {pattern!r}")
+            if pattern[special] == self.WILDCARD:
+                if end != len(pattern):
+                    raise ValueError(f"A wildcard must end the pattern: {pattern!r}")
+                if node.wildcardName not in (None, name):
+                    raise ValueError(f"Conflicting wildcards *{node.wildcardName} and *{name}")
+                node.wildcardName = name
+                if node.wildcardChild is None:
+                    node.wildcardChild = _RouteNode()
+                node = node.wildcardChild
+            else:
+                if node.paramName not in (None, name):
+                    raise ValueError(f"Conflicting parameters :{node.paramName} and :{name}")
+                node.paramName = name
+                if node.paramChild is None:
+                    node.paramChild = _RouteNode()
+                node = node.paramChild
+            i = end
+        if method in node.routes:
+            raise ValueError(f"Duplicate route {method.name} {pattern}")
+        route: Route = Route(method, pattern, handler, middleware)
+        route.compile(self._middleware)
+        node.routes[method] = route
+        self._routes.append(route)
+        return route
+
+    def get(self, pattern: str, handler: RouteHandler,
+            middleware: Iterable[Middleware] = ()) -> Route:
+        """Adds a GET route, see add()"""
+        return self.add(HTTPMethod.GET, pattern, handler, middleware)
+
+    def post(self, pattern: str, handler: RouteHandler,
+             middleware: Iterable[Middleware] = ()) -> Route:
+        """Adds a POST route, see add()"""
+        return self.add(HTTPMethod.POST, pattern, handler, middleware)
+
+    def use(self, middleware: Middleware) -> None:
+        """
+        Adds middleware of all the routes (including the ones added before), run in the order
+        they were added.
+        :param middleware: Called with the connection, the request and the next handler
+        """
+        self._middleware.append(middleware)
+        for route in self._routes:
+            route.compile(self._middleware)
+
+    def match(self, method: HTTPMethod, path: str) -> tuple[Optional[Route], dict[str, str],
+                                                          set[HTTPMethod]]:
+        """
+        Finds the route of the request.
+        :param method: The request method
+        :param path: The request's path, without the query
+        :return: The route (None if there's none), the captured parameters and the methods
+         with a route for the path (empty if the path doesn't match any route). A path matching
+         the routes of other methods only falls back to the parameters and the wildcards first.
+        """
+        params: list[tuple[str, str]] = []
+        allowed: set[HTTPMethod] = set()
+        node: Optional[_RouteNode] = (self._root.match(method, path, 0, params, allowed)
+                                      if len(path) > 0 else None)
+        if node is None:
+            return None, {}, allowed
+        return (node.routes[method], {name: unquote(value) for name, value in params},
+                set(node.routes))
+
+    def dispatch(self, conn: Any, req: HTTPRequest) -> Optional[HTTPResponse]:
+        """
+        Runs the route of the request (wrapped in the middleware).
+        :param conn: The connection the request came from
+        :param req: The request, its routeParams are set
+        :return: The handler's response (404 or 405 without a route)
+        """
+        route, params, methods = self.match(req.method, req.path)
+        req.routeParams = params
+        if route is not None:
+            return route.chain(conn, req)
+        if len(methods) > 0:
+            return self.methodNotAllowedResponse(methods)
+        return self.notFound(conn, req)
+
+    def __call__(self, conn: Any, data: Any) -> None:
+        """An onData handler sending the response to every request"""
+        if isinstance(data, HTTPRequest):
+            resp: Optional[HTTPResponse] = self.dispatch(conn, data)
+            if resp is not None:
+                conn.sendData(resp)
+
+    @staticmethod
+    def notFoundResponse(conn: Any, req: HTTPRequest) -> HTTPResponse:
+        headers: HTTPHeaders = HTTPHeaders()
+        headers["Content-Type"] = "text/plain; charset=utf-8"
+        return HTTPResponse(404, "Not Found", headers, b'Not Found')
+
+    @staticmethod
+    def methodNotAllowedResponse(methods: set[HTTPMethod]) -> HTTPResponse:
+        headers: HTTPHeaders = HTTPHeaders()
+        headers["Allow"] = ", ".join(sorted(method.name for method in methods))
+        headers["Content-Type"] = "text/plain; charset=utf-8"
+        return HTTPResponse(405, "Method Not Allowed", headers, b'Method Not Allowed')
+
+    @property
+    def routes(self) -> list[Route]:
+        return list(self._routes)
+
+
+__all__ = ["Router", "Route", "RouteHandler", "Middleware"]
@@ -0,0 +1,344 @@
+#  -*- coding: utf-8 -*-
+"""
+Serves the files of a directory over HTTP - with strong ETags, the conditional requests (304),
+the byte ranges (206) and an LRU cache of the small (hot) files. The bigger files are sent by the
+kernel (``os.sendfile``, see FileByteBuffer), their content never passes through Python.
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+import mimetypes
+import os
+import secrets
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from threading import Lock
+from typing import Final, Optional, Any
+from urllib.parse import unquote
+
+from kutil.buffer.ByteBuffer import ByteBuffer
+from kutil.buffer.MemoryByteBuffer import MemoryByteBuffer
+from kutil.buffer.FileByteBuffer import FileByteBuffer, FileRegionByteBuffer
+from kutil.buffer.AppendedByteBuffer import AppendedByteBuffer
+from kutil.protocol.HTTP.HTTPMethod import HTTPMethod
+from kutil.protocol.HTTP.HTTPHeaders import HTTPHeaders
+from kutil.protocol.HTTP.HTTPRequest import HTTPRequest
+from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
+from kutil.protocol.HTTP.HTTPCompression import ENCODINGS
+
+type TFileSignature = tuple[int, int, int, int]  # Device, inode, modification time, size
+type TByteRange = tuple[int, int]  # The first and the last byte, inclusive
+
+
+def parseRange(value: str, size: int) -> Optional[list[TByteRange]]:
+    """
+    Parses the Range header of a request for a file.
+    :param value: The header's value, e.g., "bytes=0-99, -100"
+    :param size: The file's size
+    :return: The satisfiable ranges (empty if there are none), None if the header is invalid
+    """
+    unit, _, specs = value.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges: list[TByteRange] = []
+    for spec in specs.split(","):
+        first, dash, last = spec.strip().partition("-")
+        if not dash:
+            return None
+        try:
+            if first == "":  # The suffix, e.g., the last 100 bytes
+                length: int = int(last)
+                if length <= 0 or size == 0:  # Nothing to send the end of
+                    continue
+                ranges.append((max(0, size - length), size - 1))
+                continue
+            start: int = int(first)
+            end: int = int(last) if last != "" else start
+        except ValueError:
+            return None
+        if start < 0 or end < start:
+            return None
+        if last == "":
+            end = size - 1
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    return ranges
+
+
+class StaticFileHandler:
+    """
+    Serves the files of a root directory under a URL prefix, e.g.::
+
+        static = StaticFileHandler("public", "/static/")
+        server = HTTPServer(address, lambda conn: static)  # Or static.respond(req) in own handler
+
+    The paths are resolved inside the root (the symbolic links included), anything leading out of
+    it gets 403. A directory is served by its indexFile.
+    """
+    MAX_CACHED_SIZE: Final[int] = 256 * 1024  # Bytes, bigger files are sent by os.sendfile
+    CACHE_BUDGET: Final[int] = 32 * 1024 * 1024  # 32 MB
+    MAX_RANGES: Final[int] = 16  # More ranges get the whole file
+
+    root: str  # The real absolute path
+    prefix: str  # The URL path prefix, e.g., "/static/"
+    indexFile: Optional[str]  # Served for a directory, None to not serve the directories
+    cacheControl: Optional[str]  # The Cache-Control header of the served files, e.g., "max-age=60"
+    maxCachedSize: int
+    cacheBudget: int  # The maximum total size of the cached files in bytes
+    # Statistics
+    hits: int
+    misses: int
+
+    _cache: OrderedDict[str, tuple[TFileSignature, bytes]]  # The path -> (signature, content)
+    _cacheSize: int
+    _lock: Lock
+
+    def __init__(self, root: str, prefix: str = "/", indexFile: Optional[str] = "index.html",
+                 cacheControl: Optional[str] = None):
+        """
+        Creates a handler.
+        :param root: The directory to serve
+        :param prefix: The URL path prefix the directory is served under
+        :param indexFile: The file served for a directory, None to not serve the directories
+        :param cacheControl: The Cache-Control header of the served files, optional
+        """
+        self.root = os.path.realpath(root)
+        self.prefix = prefix if prefix.endswith("/") else prefix + "/"
+        self.indexFile = indexFile
+        self.cacheControl = cacheControl
+        self.maxCachedSize = self.MAX_CACHED_SIZE
+        self.cacheBudget = self.CACHE_BUDGET
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._cacheSize = 0
+        self._lock = Lock()
+
+    def __call__(self, conn: Any, data: Any) -> None:
+        """An onData handler sending the response to every request"""
+        if isinstance(data, HTTPRequest):
+            conn.sendData(self.respond(data))
+
+    def handles(self, req: HTTPRequest) -> bool:
+        """
+        Returns whether the request's path is under the prefix.
+        :param req: The request
+        """
+        path: str = req.path
+        return path.startswith(self.prefix) or path + "/" == self.prefix
+
+    def resolve(self, urlPath: str) -> Optional[str]:
+        """
+        Maps the URL path to a file path inside the root.
+        :param urlPath: The request's path (without the query)
+        :return: The real path, None if it leads out of the root or it's not under the prefix
+        """
+        if not (urlPath.startswith(self.prefix) or urlPath + "/" == self.prefix):
+            return None
+        relative: str = unquote(urlPath[len(self.prefix):], errors="strict")
+        if "\0" in relative:
+            return None
+        path: str = os.path.realpath(os.path.join(self.root, relative.lstrip("/")))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def respond(self, req: HTTPRequest) -> HTTPResponse:
+        """
+        Creates the response to the request.
+        :param req: The request
+        :return: The response, the body of a big file is a FileByteBuffer (destroyed once sent)
+        """
+        if req.method not in (HTTPMethod.GET, HTTPMethod.HEAD):
+            return self._error(405, "Method Not Allowed", {"Allow": "GET, HEAD"})
+        try:
+            path: Optional[str] = self.resolve(req.path)
+        except UnicodeDecodeError:
+            path = None
+        if path is None:
+            return self._error(403, "Forbidden")
+        try:
+            stat: os.stat_result = os.stat(path)
+            if os.path.isdir(path):
+                if self.indexFile is None:
+                    return self._error(404, "Not Found")
+                path = os.path.join(path, self.indexFile)
+                stat = os.stat(path)
+            if not os.path.isfile(path):
+                return self._error(404, "Not Found")
+        except (FileNotFoundError, NotADirectoryError):
+            return self._error(404, "Not Found")
+        except PermissionError:
+            return self._error(403, "Forbidden")
+
+        signature: TFileSignature = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        headers: HTTPHeaders = HTTPHeaders()
+        etag: str = f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        headers["ETag"] = etag
+        headers["Last-Modified"] = formatdate(stat.st_mtime, usegmt=True)
+        if self.cacheControl is not None:
+            headers["Cache-Control"] = self.cacheControl
+        if self._notModified(req, etag, stat.st_mtime):
+            headers["X-Omit-Content-Length"] = "1"  # Content-Length: 0 would be the file's size
+            return HTTPResponse(304, "Not Modified", headers, b'')
+
+        headers["Content-Type"] = self.contentType(path)
+        headers["Accept-Ranges"] = "bytes"
+        size: int = stat.st_size
+        ranges: Optional[list[TByteRange]] = None
+        rangeHeader: Optional[str] = req.headers.get("Range")
+        if rangeHeader is not None and self._rangeApplies(req, etag, stat.st_mtime):
+            ranges = parseRange(rangeHeader, size)
+            if ranges is not None and len(ranges) == 0:
+                headers["Content-Range"] = f"bytes */{size}"
+                del headers["Content-Type"]
+                return HTTPResponse(416, "Range Not Satisfiable", headers, b'')
+            if ranges is not None and len(ranges) > self.MAX_RANGES:
+                ranges = None
+
+        if req.method is HTTPMethod.HEAD:
+            headers["Content-Length"] = str(size)
+            headers["X-Omit-Content-Length"] = "1"  # Keep the file's size
+            return HTTPResponse(200, "OK", headers, b'')
+        try:
+            if ranges is None:
+                return HTTPResponse(200, "OK", headers, self._content(path, signature, 0, size))
+            if len(ranges) == 1:
+                first, last = ranges[0]
+                headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+                return HTTPResponse(206, "Partial Content", headers,
+                                    self._content(path, signature, first, last - first + 1))
+            return self._multipart(path, signature, ranges, headers)
+        except PermissionError:  # Readable by stat() only
+            return self._error(403, "Forbidden")
+        except OSError:  # E.g., deleted meanwhile
+            return self._error(404, "Not Found")
+
+    def contentType(self, path: str) -> str:
+        """
+        Guesses the Content-Type of the file by its extension.
+        :param path: The file's path
+        :return: The type, application/octet-stream if it's unknown
+        """
+        mimeType, _ = mimetypes.guess_type(path, strict=False)
+        if mimeType is None:
+            return "application/octet-stream"
+        if mimeType.startswith("text/") or mimeType in ("application/javascript",
+                                                        "application/json", "image/svg+xml"):
+            return f"{mimeType}; charset=utf-8"
+        return mimeType
+
+    @staticmethod
+    def _error(statusCode: int, statusPhrase: str,
+               extra: Optional[dict[str, str]] = None) -> HTTPResponse:
+        headers: HTTPHeaders = HTTPHeaders(extra)
+        headers["Content-Type"] = "text/plain; charset=utf-8"
+        return HTTPResponse(statusCode, statusPhrase, headers, statusPhrase.encode("utf-8"))
+
+    @staticmethod
+    def _etagMatches(value: str, etag: str) -> bool:
+        """The weak comparison of If-None-Match, including our compressed variants' ETags"""
+        if value.strip() == "*":
+            return True
+        variants: set[str] = {etag} | {f'{etag[:-1]}-{encoding}"' for encoding in ENCODINGS}
+        for tag in value.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag in variants:
+                return True
+        return False
+
+    @staticmethod
+    def _notNewerThan(value: str, mtime: float) -> bool:
+        """Whether the file wasn't modified after the HTTP date (False if it's invalid)"""
+        try:
+            return int(mtime) <= parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+
+    def _notModified(self, req: HTTPRequest, etag: str, mtime: float) -> bool:
+        ifNoneMatch: Optional[str] = req.headers.get("If-None-Match")
+        if ifNoneMatch is not None:  # Takes precedence over If-Modified-Since
+            return self._etagMatches(ifNoneMatch, etag)
+        ifModifiedSince: Optional[str] = req.headers.get("If-Modified-Since")
+        return ifModifiedSince is not None and self._notNewerThan(ifModifiedSince, mtime)
+
+    def _rangeApplies(self, req: HTTPRequest, etag: str, mtime: float) -> bool:
+        """Whether the If-Range (if any) allows sending only the ranges"""
+        ifRange: Optional[str] = req.headers.get("If-Range")
+        if ifRange is None:
+            return True
+        if ifRange.strip().startswith(('"', "W/")):
+            return ifRange.strip() == etag  # The strong comparison
+        return self._notNewerThan(ifRange, mtime)
+
+    def _content(self, path: str, signature: TFileSignature, offset: int,
+                 length: int) -> bytes | memoryview | FileByteBuffer:
+        """Returns a part of the file, cached if it's small, otherwise for os.sendfile"""
+        size: int = signature[3]
+        if size > self.maxCachedSize:
+            file = open(path, "rb")
+            if offset == 0 and length == size:
+                return FileByteBuffer(file)
+            return FileRegionByteBuffer(file, offset, length)
+        content: bytes = self._cached(path, signature)
+        if offset == 0 and length == len(content):
+            return content
+        return memoryview(content)[offset:offset + length]
+
+    def _cached(self, path: str, signature: TFileSignature) -> bytes:
+        with self._lock:
+            entry: Optional[tuple[TFileSignature, bytes]] = self._cache.get(path)
+            if entry is not None and entry[0] == signature:
+                self._cache.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        with open(path, "rb") as file:
+            content: bytes = file.read()
+            stat: os.stat_result = os.fstat(file.fileno())
+        if (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size) != signature:
+            return content  # The file changed since its ETag was computed, don't cache it
+        with self._lock:
+            old: Optional[tuple[TFileSignature, bytes]] = self._cache.pop(path, None)
+            if old is not None:
+                self._cacheSize -= len(old[1])
+            if len(content) <= self.cacheBudget:
+                self._cache[path] = (signature, content)
+                self._cacheSize += len(content)
+                while self._cacheSize > self.cacheBudget:
+                    _, (_, evicted) = self._cache.popitem(last=False)
+                    self._cacheSize -= len(evicted)
+        return content
+
+    def _multipart(self, path: str, signature: TFileSignature, ranges: list[TByteRange],
+                   headers: HTTPHeaders) -> HTTPResponse:
+        """Creates the multipart/byteranges response to more ranges"""
+        boundary: str = secrets.token_hex(12)
+        contentType: str = headers["Content-Type"]
+        size: int = signature[3]
+        parts: list[ByteBuffer] = []
+        try:
+            for first, last in ranges:
+                parts.append(MemoryByteBuffer(
+                    f"\r\n--{boundary}\r\nContent-Type: {contentType}\r\n"
+                    f"Content-Range: bytes {first}-{last}/{size}\r\n\r\n".encode("utf-8")))
+                content = self._content(path, signature, first, last - first + 1)
+                parts.append(content if isinstance(content, ByteBuffer) else
+                             MemoryByteBuffer(bytes(content)))
+        except OSError:
+            for part in parts:  # Close the files opened for the previous ranges
+                part.destroy()
+            raise
+        parts.append(MemoryByteBuffer(f"\r\n--{boundary}--\r\n".encode("utf-8")))
+        headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        return HTTPResponse(206, "Partial Content", headers, AppendedByteBuffer(parts))
+
+    @property
+    def cacheSize(self) -> int:
+        """The total size of the cached files in bytes."""
+        return self._cacheSize
+
+
+__all__ = ["StaticFileHandler", "parseRange"]
@@ -5,3 +5,8 @@ from kutil.protocol.HTTP.HTTPMethod import HTTPMethod
 from kutil.protocol.HTTP.HTTPHeaders import HTTPHeaders
 from kutil.protocol.HTTP.HTTPRequest import HTTPRequest, HTTPThing
 from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
+from kutil.protocol.HTTP.HTTPParser import HTTPParser, HTTPParseError
+from kutil.protocol.HTTP.HTTPCompression import HTTPCompressor, CompressionCache
+from kutil.protocol.HTTP.StaticFileHandler import StaticFileHandler
+from kutil.protocol.HTTP.Router import Router, Route
+from kutil.protocol.HTTP.ResponseCache import ResponseCache
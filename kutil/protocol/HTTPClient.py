@@ -0,0 +1,332 @@
+#  -*- coding: utf-8 -*-
+"""
+An HTTP client reusing its connections - a pool of keep-alive HTTPConnections per host, so the
+repeated requests to an upstream don't pay a TCP handshake each.
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+from collections import deque
+from queue import Queue, Empty
+from threading import Condition
+from time import monotonic
+from typing import Final, Optional, Any
+from urllib.parse import urlsplit, SplitResult
+
+from kutil.buffer.ByteBuffer import ByteBufferLike
+from kutil.protocol.ProtocolConnection import ConnectionClosed
+from kutil.protocol.HTTPConnection import HTTPConnection
+from kutil.protocol.HTTPServer import connectionTokens
+from kutil.protocol.HTTP.HTTPMethod import HTTPMethod
+from kutil.protocol.HTTP.HTTPHeaders import HTTPHeaders
+from kutil.protocol.HTTP.HTTPRequest import HTTPRequest
+from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
+
+type THostKey = tuple[str, int]  # The host, the port
+
+
+class HTTPClientConnection(HTTPConnection):
+    """A pooled connection, its responses (or the cause of its closing) are put into a queue"""
+    host: THostKey
+    responses: Queue[HTTPResponse | Exception]
+    requestCount: int  # How many requests were sent through it
+    idleSince: float  # time.monotonic()
+    idleDeadline: float  # When the server might close it, time.monotonic()
+
+    def __init__(self, host: THostKey):
+        self.host = host
+        self.responses = Queue()
+        self.requestCount = 0
+        self.idleSince = self.idleDeadline = monotonic()
+        super().__init__(host, lambda conn, resp: self.responses.put(resp))
+        self.onCloseListeners.append(
+            lambda conn, cause: self.responses.put(cause if cause is not None else
+                                                   ConnectionClosed()))
+
+    def receive(self):
+        try:
+            super().receive()
+        except Exception as e:  # E.g., an HTTPParseError, don't leave the request waiting
+            self.close(e)
+
+
+class HTTPClient:
+    """
+    Sends the requests over the pooled keep-alive connections, at most maxPerHost connections to
+    a host and maxTotal in total (the requests over the limit wait for a connection). The idle
+    connections are closed after idleTimeout seconds, or sooner if the server's Keep-Alive header
+    says so. A request sent over a reused connection the server has closed meanwhile (a stale
+    connection) is sent again over a new one, if it's idempotent::
+
+        with HTTPClient() as client:
+            resp = client.request(HTTPMethod.GET, "http://localhost:8080/api/items")
+            print(resp.statusCode, resp.json)
+
+    Only the http:// URLs are supported.
+    """
+    MAX_PER_HOST: Final[int] = 8
+    MAX_TOTAL: Final[int] = 64
+    IDLE_TIMEOUT: Final[float] = 30  # Seconds
+    TIMEOUT: Final[float] = 30  # Seconds to wait for a response or a free connection
+    # The methods safe to send again when a stale connection drops the request
+    IDEMPOTENT_METHODS: Final[frozenset[HTTPMethod]] = frozenset((
+        HTTPMethod.GET, HTTPMethod.HEAD, HTTPMethod.OPTIONS, HTTPMethod.PUT, HTTPMethod.DELETE,
+        HTTPMethod.TRACE))
+
+    maxPerHost: int
+    maxTotal: int
+    idleTimeout: float
+    timeout: float
+    # Statistics
+    created: int  # The connections opened
+    reused: int  # The requests sent over an already used connection
+    evicted: int  # The idle connections closed because they were idle for too long or closed
+    retried: int  # The requests sent again after a stale connection dropped them
+
+    _idle: dict[THostKey, deque[HTTPClientConnection]]  # The most recently used last
+    _open: dict[THostKey, int]  # The open connections (idle or in use) per host
+    _total: int
+    _closed: bool
+    _condition: Condition
+
+    def __init__(self, maxPerHost: int = MAX_PER_HOST, maxTotal: int = MAX_TOTAL,
+                 idleTimeout: float = IDLE_TIMEOUT, timeout: float = TIMEOUT):
+        """
+        Creates a client.
+        :param maxPerHost: The most connections open to one host
+        :param maxTotal: The most connections open in total
+        :param idleTimeout: Seconds to keep an idle connection open for
+        :param timeout: Seconds to wait for a response or a free connection
+        """
+        assert 1 <= maxPerHost <= maxTotal
+        self.maxPerHost = maxPerHost
+        self.maxTotal = maxTotal
+        self.idleTimeout = idleTimeout
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.retried = 0
+        self._idle = {}
+        self._open = {}
+        self._total = 0
+        self._closed = False
+        self._condition = Condition()
+
+    def request(self, method: HTTPMethod, url: str, headers: Optional[HTTPHeaders] = None,
+                body: Optional[ByteBufferLike] = None) -> HTTPResponse:
+        """
+        Sends the request and waits for the response.
+        :param method: The request method
+        :param url: The absolute URL, e.g., "http://localhost:8080/path?query"
+        :param headers: The request headers, Host is added
+        :param body: The request body
+        :return: The response
+        :exception ValueError: If the URL isn't a valid http:// URL
+        :exception TimeoutError: If the response or a free connection doesn't come in time
+        :exception ConnectionError: If the connection fails
+        """
+        host, target = self.parseURL(url)
+        req: HTTPRequest = HTTPRequest(method, target,
+                                       headers.copy() if headers is not None else HTTPHeaders(),
+                                       body)
+        if "Host" not in req.headers:
+            req.headers["Host"] = host[0] if host[1] == 80 else f"{host[0]}:{host[1]}"
+        while True:
+            conn: HTTPClientConnection = self._acquire(host)
+            reused: bool = conn.requestCount > 0
+            try:
+                resp: HTTPResponse = self._exchange(conn, req)
+            except (ConnectionClosed, ConnectionError) as e:
+                self._release(conn, False)
+                if reused and method in self.IDEMPOTENT_METHODS:
+                    self.retried += 1
+                    continue  # A stale connection, send it over another one
+                if isinstance(e, ConnectionError):
+                    raise
+                raise ConnectionError("The server closed the connection") from e
+            except BaseException:
+                self._release(conn, False)
+                raise
+            self._release(conn, self._isReusable(req, resp), resp)
+            return resp
+
+    def get(self, url: str, headers: Optional[HTTPHeaders] = None) -> HTTPResponse:
+        """Sends a GET request, see request()"""
+        return self.request(HTTPMethod.GET, url, headers)
+
+    def post(self, url: str, body: ByteBufferLike,
+             headers: Optional[HTTPHeaders] = None) -> HTTPResponse:
+        """Sends a POST request, see request()"""
+        return self.request(HTTPMethod.POST, url, headers, body)
+
+    @staticmethod
+    def parseURL(url: str) -> tuple[THostKey, str]:
+        """
+        Splits the URL into the host to connect to and the request target.
+        :param url: The absolute http:// URL
+        :return: The (host, port) and the path with the query
+        :exception ValueError: If the URL isn't a valid http:// URL
+        """
+        parts: SplitResult = urlsplit(url)
+        if parts.scheme != "http" or not parts.hostname:
+            raise ValueError(f"Only the absolute http:// URLs are supported: {url!r}")
+        target: str = parts.path or "/"
+        if parts.query:
+            target += f"?{parts.query}"
+        return (parts.hostname, parts.port or 80), target
+
+    def _exchange(self, conn: HTTPClientConnection, req: HTTPRequest) -> HTTPResponse:
+        if conn.requestCount > 0:
+            self.reused += 1
+        conn.requestCount += 1
+        if not conn.sendData(req):
+            raise ConnectionClosed()
+        while True:
+            try:
+                result: HTTPResponse | Exception = conn.responses.get(timeout=self.timeout)
+            except Empty:
+                raise TimeoutError(f"No response from {conn.host[0]}:{conn.host[1]} "
+                                   f"in {self.timeout}s") from None
+            if isinstance(result, Exception):
+                raise result
+            if result.statusCode >= 200 or result.statusCode == 101:
+                return result  # Not an interim response (e.g., 100 Continue)
+
+    @staticmethod
+    def _isReusable(req: HTTPRequest, resp: HTTPResponse) -> bool:
+        return ("close" not in connectionTokens(req.headers.get("Connection")) and
+                "close" not in connectionTokens(resp.headers.get("Connection")) and
+                resp.statusCode != 101)
+
+    def _acquire(self, host: THostKey) -> HTTPClientConnection:
+        deadline: float = monotonic() + self.timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise ConnectionError("The client is closed")
+                idle: deque[HTTPClientConnection] = self._idle.get(host, deque())
+                while len(idle) > 0:
+                    conn: HTTPClientConnection = idle.pop()
+                    if self._isAlive(conn):
+                        return conn
+                    self._discard(conn)
+                    self.evicted += 1
+                if self._total >= self.maxTotal:
+                    self._evictIdle(force=True)  # The idle connections to other hosts
+                if self._open.get(host, 0) < self.maxPerHost and self._total < self.maxTotal:
+                    self._open[host] = self._open.get(host, 0) + 1
+                    self._total += 1
+                    break
+                left: float = deadline - monotonic()
+                if left <= 0 or not self._condition.wait(left):
+                    raise TimeoutError(f"No free connection to {host[0]}:{host[1]} "
+                                       f"in {self.timeout}s")
+        try:
+            conn: HTTPClientConnection = HTTPClientConnection(host)  # Outside the lock, it's slow
+        except BaseException:
+            with self._condition:
+                self._forget(host)
+            raise
+        if conn.closed:  # The connecting timed out
+            with self._condition:
+                self._forget(host)
+            raise TimeoutError(f"Connecting to {host[0]}:{host[1]} timed out")
+        self.created += 1
+        return conn
+
+    def _release(self, conn: HTTPClientConnection, reusable: bool,
+                 resp: Optional[HTTPResponse] = None) -> None:
+        with self._condition:
+            if reusable and not self._closed and not conn.closed and conn.responses.empty():
+                now: float = monotonic()
+                conn.idleSince = now
+                conn.idleDeadline = now + min(self.idleTimeout, self._serverTimeout(resp))
+                self._idle.setdefault(conn.host, deque()).append(conn)
+            else:
+                self._discard(conn)
+            self._evictIdle()
+            self._condition.notify()
+
+    def _serverTimeout(self, resp: Optional[HTTPResponse]) -> float:
+        """Returns how long the server keeps the connection open according to its Keep-Alive"""
+        keepAlive: Optional[str] = resp.headers.get("Keep-Alive") if resp is not None else None
+        if keepAlive is None:
+            return self.idleTimeout
+        for param in keepAlive.split(","):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "timeout":
+                try:
+                    return max(0., float(value) - 1)  # Leave it before the server closes it
+                except ValueError:
+                    break
+        return self.idleTimeout
+
+    @staticmethod
+    def _isAlive(conn: HTTPClientConnection) -> bool:
+        # A connection the server closed was closed by its receiver thread already, an idle one
+        # mustn't have received anything
+        return not conn.closed and conn.idleDeadline > monotonic() and conn.responses.empty()
+
+    def _evictIdle(self, force: bool = False) -> None:
+        """Closes the idle connections that can't be used anymore, or the oldest one if forced"""
+        oldest: Optional[HTTPClientConnection] = None
+        for host, idle in list(self._idle.items()):
+            for conn in [conn for conn in idle if not self._isAlive(conn)]:
+                idle.remove(conn)
+                self._discard(conn)
+                self.evicted += 1
+            if len(idle) == 0:
+                del self._idle[host]
+            elif oldest is None or idle[0].idleSince < oldest.idleSince:
+                oldest = idle[0]
+        if force and oldest is not None and self._total >= self.maxTotal:
+            self._idle[oldest.host].remove(oldest)
+            if len(self._idle[oldest.host]) == 0:
+                del self._idle[oldest.host]
+            self._discard(oldest)
+            self.evicted += 1
+
+    def _discard(self, conn: HTTPClientConnection) -> None:
+        conn.close()
+        self._forget(conn.host)
+
+    def _forget(self, host: THostKey) -> None:
+        self._open[host] -= 1
+        if self._open[host] == 0:
+            del self._open[host]
+        self._total -= 1
+        self._condition.notify()
+
+    def close(self) -> None:
+        """Closes the idle connections, the ones in use are closed once their response comes"""
+        with self._condition:
+            self._closed = True
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+                    self._forget(conn.host)
+            self._idle.clear()
+            self._condition.notify_all()
+
+    def __enter__(self) -> "HTTPClient":
+        return self
+
+    def __exit__(self, excType: Any, excValue: Any, traceback: Any) -> None:
+        self.close()
+
+    @property
+    def openConnections(self) -> int:
+        """The open connections, idle or in use"""
+        return self._total
+
+    @property
+    def idleConnections(self) -> int:
+        return sum(len(idle) for idle in self._idle.values())
+
+    def __repr__(self) -> str:
+        return (f"HTTPClient(open={self._total}, idle={self.idleConnections}, "
+                f"created={self.created}, reused={self.reused}, evicted={self.evicted}, "
+                f"retried={self.retried})")
+
+
+__all__ = ["HTTPClient", "HTTPClientConnection"]
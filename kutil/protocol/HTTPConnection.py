@@ -1,24 +1,38 @@
 #  -*- coding: utf-8 -*-
 __author__ = "kubik.augustyn@post.cz"
 
-from typing import Callable
+from collections import deque
+from typing import Callable, Any, Iterator
 
 from kutil.buffer.ByteBuffer import ByteBuffer
 from kutil.protocol.AbstractProtocol import AbstractProtocol, NeedMoreDataError
 from kutil.protocol.ProtocolConnection import ProtocolConnection
 from kutil.protocol.TCPConnection import TCPProtocol
+from kutil.protocol.HTTP.HTTPMethod import HTTPMethod
 from kutil.protocol.HTTP.HTTPRequest import HTTPRequest
 from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
+from kutil.protocol.HTTP.HTTPParser import HTTPParser
 
 type OnHTTPDataListener = Callable[[ProtocolConnection, HTTPResponse], None]
 
 
 class HTTPProtocol(AbstractProtocol):
     name = "HTTPProtocol"
+    parser: HTTPParser  # Keeps the partially received response between the calls
+    requestMethods: deque[HTTPMethod]  # The methods of the requests waiting for their responses
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.parser = HTTPParser(HTTPResponse)
+        self.requestMethods = deque()
 
     def unpackData(self, buff: ByteBuffer) -> HTTPResponse:
-        resp = HTTPResponse()
-        resp.read(buff)  # Don't catch errors!
+        # The response to a HEAD request has the headers of a GET response, but no body
+        self.parser.skipBody = (len(self.requestMethods) > 0 and
+                                self.requestMethods[0] is HTTPMethod.HEAD)
+        resp: HTTPResponse = self.parser.parse(buff)  # Don't catch errors!
+        if len(self.requestMethods) > 0 and (resp.statusCode >= 200 or resp.statusCode == 101):
+            self.requestMethods.popleft()  # Not an interim response
         return resp
 
     def unpackSubProtocol(self, buff: ByteBuffer) -> ByteBuffer:
@@ -29,6 +43,7 @@ class HTTPProtocol(AbstractProtocol):
         data.headers["User-Agent"] = "KUtil"
 
         data.write(buff)
+        self.requestMethods.append(data.method)
 
     def packSubProtocol(self, buff: ByteBuffer):
         pass  # Nothing lol
@@ -37,3 +52,12 @@ class HTTPProtocol(AbstractProtocol):
 class HTTPConnection(ProtocolConnection):
     def __init__(self, address: tuple[str, int], onData: OnHTTPDataListener):
         super().__init__(address, [TCPProtocol(self), HTTPProtocol(self)], onData)
+
+    def sendData(self, data: Any, beginAtLayer: int = -1, allowChunking: bool = True,
+                 chunkSize: int = 1024 * 1024 * 10) -> bool:
+        if not isinstance(data, HTTPRequest) or not data.isStreamed:
+            return super().sendData(data, beginAtLayer, allowChunking, chunkSize)
+        # Send the streamed body (chunked) as it's produced, after the head
+        stream: Iterator[bytes] = data.iterChunks()
+        return self._sendPacked(self._packData(data, beginAtLayer, allowChunking), allowChunking,
+                                chunkSize, stream)
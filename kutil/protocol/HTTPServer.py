@@ -1,26 +1,35 @@
 #  -*- coding: utf-8 -*-
 __author__ = "kubik.augustyn@post.cz"
 
+from collections import deque
 from enum import Enum, unique, auto
-from typing import Callable, Any, Self, Optional
+from socket import SHUT_RDWR
+from threading import Thread
+from time import monotonic, sleep
+from typing import Callable, Any, Self, Optional, Iterator
 
 from kutil.typing_help import neverCall, returnFalse
 
 from kutil.protocol.AbstractProtocol import AbstractProtocol, NeedMoreDataError
-from kutil.buffer.ByteBuffer import ByteBuffer, OutOfBoundsReadError
+from kutil.buffer.ByteBuffer import ByteBuffer
 from kutil.protocol.ProtocolConnection import ProtocolConnection
 from kutil.protocol.ProtocolServer import ProtocolServer
 from kutil.protocol.TCPConnection import TCPProtocol
 from kutil.protocol.HTTP.HTTPRequest import HTTPRequest
 from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
 from kutil.protocol.HTTP.HTTPHeaders import HTTPHeaders
+from kutil.protocol.HTTP.HTTPParser import HTTPParser, HTTPParseError, BodySink
+from kutil.protocol.HTTP.HTTPCompression import HTTPCompressor
 from kutil.protocol.WS.WSMessage import WSMessage
+from kutil.protocol.WS.WSDeflate import PerMessageDeflate, WSDeflateSession
 from kutil.protocol.WSConnection import WSProtocol, WSConnection
 from kutil.protocol.SSE.SSEMessage import SSEMessage
 from kutil.protocol.SSEConnection import SSEProtocol, SSEConnection
 
 type AcceptWSChecker = Callable[[HTTPServerConnection, HTTPRequest], bool]
 type AcceptSSEChecker = Callable[[HTTPServerConnection, HTTPRequest], bool]
+# Called with the request once its head is received, returns where to stream its body to (or None)
+type BodySinkFactory = Callable[[HTTPServerConnection, HTTPRequest], Optional[BodySink]]
 
 
 @unique
@@ -35,14 +44,27 @@ class HTTPConnectionState(Enum):
 
 class HTTPServerProtocol(AbstractProtocol):
     name = "HTTPServerProtocol"
+    parser: HTTPParser  # Keeps the partially received request between the calls
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.parser = HTTPParser(HTTPRequest, self._createBodySink)
+
+    def _createBodySink(self, req: HTTPRequest) -> Optional[BodySink]:
+        factory: Optional[BodySinkFactory] = self.connection.bodySinkFactory
+        return factory(self.connection, req) if factory is not None else None
 
     def unpackData(self, buff: ByteBuffer) -> HTTPRequest:
-        req = HTTPRequest()
+        self.parser.lazyHeaders = self.connection.lazyHeaders  # It may be set after the creation
         try:
-            req.read(buff)
-        except OutOfBoundsReadError:
-            raise NeedMoreDataError
-        return req
+            return self.parser.parse(buff)
+        except HTTPParseError as e:
+            # Answer the malformed request and stop reading, we can't tell where the next one starts
+            headers: HTTPHeaders = HTTPHeaders()
+            headers["Connection"] = "close"
+            self.connection.sendData(HTTPResponse(e.statusCode, e.statusPhrase, headers, b''))
+            self.connection.close(e)
+            raise NeedMoreDataError from e
 
     def unpackSubProtocol(self, buff: ByteBuffer) -> ByteBuffer:
         raise RuntimeError  # Not possible
@@ -59,6 +81,17 @@ class HTTPServerProtocol(AbstractProtocol):
         # pass  # Nothing lol
 
 
+def connectionTokens(value: Optional[str]) -> set[str]:
+    """
+    Splits the Connection header's value into lowercase tokens.
+    :param value: The header's value, None if missing
+    :return: The tokens
+    """
+    if value is None:
+        return set()
+    return {token.strip().lower() for token in value.split(",")}
+
+
 class WebSocketNotAllowed(Exception):
     pass
 
@@ -69,6 +102,23 @@ class ServerSentEventsNotAllowed(Exception):
 
 class HTTPServerConnection(ProtocolConnection):
     # Note that editing the __init__ method might break the whole thing
+    RETRY_AFTER: int = 1  # Seconds, sent with the 503 response when the dispatcher is full
+    # The keep-alive limits, HTTPServer sets them from its own attributes
+    keepAliveTimeout: float  # Seconds a connection may stay idle between the requests
+    maxRequests: int  # How many requests a connection serves before it's closed
+    requestCount: int
+    responseCount: int
+    # Streams the request bodies (e.g., big uploads) instead of buffering them, the request passed
+    # to the onData handler has an empty body then
+    bodySinkFactory: Optional[BodySinkFactory]
+    # Keep the request headers raw, decoding a header once it's accessed - e.g., for a proxy that
+    # looks at a few of them and forwards the rest byte for byte (see HTTPHeaders.fromRaw)
+    lazyHeaders: bool
+    # Encodes the response bodies the client accepts compressed, None to send them as they are
+    compressor: Optional[HTTPCompressor]
+    # Accepts the permessage-deflate WebSocket extension the client offers, None to not accept it
+    wsDeflate: Optional[PerMessageDeflate]
+    lastActivity: float  # The time.monotonic() of the last received data or sent response
     onData: Callable[[Self, HTTPRequest | WSMessage], None]
     _acceptWSChecker: AcceptWSChecker
     _acceptSSEChecker: AcceptSSEChecker
@@ -78,8 +128,21 @@ class HTTPServerConnection(ProtocolConnection):
     onSSEEstablishment: Optional[Callable[[Self, HTTPRequest], None]]
     wsConn: Optional[WSConnection]
     sseConn: Optional[SSEConnection]
+    _closeAfter: deque[bool]  # Whether to close after the response, for each unanswered request
+    _acceptEncodings: deque[Optional[str]]  # The Accept-Encoding of each unanswered request
 
     def init(self):
+        self.keepAliveTimeout = HTTPServer.KEEP_ALIVE_TIMEOUT
+        self.maxRequests = HTTPServer.MAX_REQUESTS
+        self.requestCount = 0
+        self.responseCount = 0
+        self.bodySinkFactory = None
+        self.lazyHeaders = False
+        self.compressor = None
+        self.wsDeflate = None
+        self.lastActivity = monotonic()
+        self._closeAfter = deque()
+        self._acceptEncodings = deque()
         self._state = HTTPConnectionState.HTTP
         self._acceptWSChecker = returnFalse
         self._acceptSSEChecker = returnFalse
@@ -97,6 +160,99 @@ class HTTPServerConnection(ProtocolConnection):
         self.sendData(resp)
         self.close(WebSocketNotAllowed())
 
+    def rejectData(self, data: HTTPRequest | WSMessage | SSEMessage):
+        if not isinstance(data, HTTPRequest):
+            return  # There's no way to tell a WS/SSE client to try again later
+        headers: HTTPHeaders = HTTPHeaders()
+        headers["Retry-After"] = str(self.RETRY_AFTER)
+        headers["Connection"] = "close"
+        headers["Content-Type"] = "text/plain"
+        self.sendData(HTTPResponse(503, "Service Unavailable", headers,
+                                   b'The server is overloaded, try again later.'))
+        self.close()
+
+    def feedData(self, data: bytes | bytearray | memoryview) -> bool:
+        self.lastActivity = monotonic()
+        return super().feedData(data)
+
+    def parseReceived(self) -> bool:
+        # Queue the responses to the pipelined requests, then send them all at once
+        self.cork()
+        try:
+            return super().parseReceived()
+        finally:
+            self.uncork()
+
+    @property
+    def canDropMessages(self) -> bool:
+        # Not the HTTP responses (they answer the requests in order) nor the compressed WS messages
+        # (the client's inflate stream would miss them), the SSE events and other WS messages are
+        # independent
+        return self.didUpgradeToSSE or (self.didUpgradeToWS and self.wsConn.deflate is None)
+
+    def sendData(self, data: Any, beginAtLayer: int = -1, allowChunking: bool = True,
+                 chunkSize: int = 1024 * 1024 * 10) -> bool:
+        deflate: Optional[WSDeflateSession] = self.wsConn.deflate if self.didUpgradeToWS else None
+        if deflate is not None:
+            with deflate.lock:  # Sent in the order the messages were compressed
+                sent: bool = self._sendPacked(self._packData(data, beginAtLayer, allowChunking),
+                                              allowChunking, chunkSize)
+            self.lastActivity = monotonic()
+            return sent
+        close: bool = False
+        if isinstance(data, HTTPResponse) and self.didNotUpgrade and data.statusCode >= 200:
+            close = self._prepareResponse(data)
+        # A streamed body is sent as it's produced, after the head
+        stream: Optional[Iterator[bytes]] = (data.iterChunks() if isinstance(data, HTTPResponse)
+                                             and data.isStreamed else None)
+        sent: bool = self._sendPacked(self._packData(data, beginAtLayer, allowChunking),
+                                      allowChunking, chunkSize, stream)
+        self.lastActivity = monotonic()
+        if close:
+            self.close()
+        return sent
+
+    def _prepareResponse(self, resp: HTTPResponse) -> bool:
+        """
+        Adds the keep-alive headers to a final response, and compresses its body.
+        :param resp: The response
+        :return: Whether to close the connection after sending it
+        """
+        self.responseCount += 1
+        close: bool = self._closeAfter.popleft() if len(self._closeAfter) > 0 else False
+        acceptEncoding: Optional[str] = (self._acceptEncodings.popleft()
+                                         if len(self._acceptEncodings) > 0 else None)
+        if self.compressor is not None:
+            self.compressor.compress(resp, acceptEncoding)
+        connection: Optional[str] = resp.headers.get("Connection")
+        if close or "close" in connectionTokens(connection):
+            resp.headers["Connection"] = "close"
+            return True
+        if connection is None:
+            resp.headers["Connection"] = "keep-alive"
+            resp.headers["Keep-Alive"] = (f"timeout={int(self.keepAliveTimeout)}, "
+                                          f"max={max(0, self.maxRequests - self.responseCount)}")
+        return False
+
+    def isIdle(self, now: Optional[float] = None) -> bool:
+        """
+        Returns whether the connection waits for the next request for longer than keepAliveTimeout.
+        :param now: The current time.monotonic()
+        """
+        if now is None:
+            now = monotonic()
+        return (self.didNotUpgrade and len(self._closeAfter) == 0 and
+                now - self.lastActivity >= self.keepAliveTimeout)
+
+    def closeIdle(self):
+        """Closes the idle connection, waking up its receiver thread if it has one"""
+        if self.receiverThread is not None:
+            try:
+                self.sock.shutdown(SHUT_RDWR)  # close() alone doesn't interrupt a blocking recv()
+            except OSError:
+                pass
+        self.close()
+
     def _denySSEConnection(self):
         resp: HTTPResponse = HTTPResponse(406, "Not Acceptable", HTTPHeaders(), b'')
         self.sendData(resp)
@@ -114,6 +270,13 @@ class HTTPServerConnection(ProtocolConnection):
         else:
             raise ValueError
 
+        if self.didNotUpgrade:
+            self.requestCount += 1
+            if self.requestCount > self.maxRequests:
+                return False  # Pipelined past the limit, the connection closes after the last one
+            self._closeAfter.append(self.requestCount >= self.maxRequests or
+                                    "close" in connectionTokens(data.headers.get("Connection")))
+            self._acceptEncodings.append(data.headers.get("Accept-Encoding"))
         if self.didNotUpgrade and not self.didUpgradeToWS:
             if (data.headers.get("Upgrade") == "websocket" and
                     data.headers.get("Connection").capitalize() == "Upgrade"):
@@ -134,11 +297,18 @@ class HTTPServerConnection(ProtocolConnection):
                 # headers["Sec-WebSocket-Protocol"] = "chat" - breaks stuff, although on Wikipedia
                 headers["Sec-WebSocket-Accept"] = WSProtocol.createAcceptHeader(
                     data.headers.get("Sec-WebSocket-Key"))
+                deflate: Optional[WSDeflateSession] = (
+                    self.wsDeflate.negotiate(data.headers.get("Sec-WebSocket-Extensions"))
+                    if self.wsDeflate is not None else None)
+                if deflate is not None:
+                    headers["Sec-WebSocket-Extensions"] = deflate.responseHeader
                 resp: HTTPResponse = HTTPResponse(101, "Switching Protocols", headers, b'')
                 self.sendData(resp)
                 self.removeProtocol(self.layers[-1])  # Remove the HTTP protocol
-                self.addProtocol(WSProtocol(self))
+                self.addProtocol(WSProtocol(self, deflate))
                 self.wsConn = WSConnection(("", 0), [], neverCall, self.sock)
+                self.wsConn.deflate = deflate
+                self._shareSocketWith(self.wsConn)
                 self._state = HTTPConnectionState.WS
                 if self.onWebsocketEstablishment:
                     self.onWebsocketEstablishment(self, data)
@@ -159,12 +329,18 @@ class HTTPServerConnection(ProtocolConnection):
                 self.removeProtocol(self.layers[-1])  # Remove the HTTP protocol
                 self.addProtocol(SSEProtocol(self))
                 self.sseConn = SSEConnection(("", 0), [], neverCall, self.sock)
+                self._shareSocketWith(self.sseConn)
                 self._state = HTTPConnectionState.SSE
                 if self.onSSEEstablishment:
                     self.onSSEEstablishment(self, data)
                 return False  # Don't call the onData with the SSE request
         return True
 
+    def _shareSocketWith(self, conn: ProtocolConnection):
+        """Makes the upgraded connection close this one (and release the socket properly)"""
+        conn.eventLoop = self.eventLoop
+        conn.onCloseListeners.append(lambda _, cause: self.close(cause))
+
     def acceptWebsocket(self, acceptWSChecker: AcceptWSChecker):
         self._acceptWSChecker = acceptWSChecker
 
@@ -205,8 +381,18 @@ type onConnectionListener = Callable[
 
 class HTTPServer(ProtocolServer):
     connectionType: type[ProtocolConnection] = HTTPServerConnection
+    KEEP_ALIVE_TIMEOUT: float = 5  # Seconds
+    MAX_REQUESTS: int = 100
     acceptWSChecker: AcceptWSChecker
     acceptSSEChecker: AcceptSSEChecker
+    # Change these before listen() to change the keep-alive limits of the new connections
+    keepAliveTimeout: float
+    maxRequests: int
+    bodySinkFactory: Optional[BodySinkFactory]  # See HTTPServerConnection.bodySinkFactory
+    lazyHeaders: bool  # See HTTPServerConnection.lazyHeaders
+    compressor: Optional[HTTPCompressor]  # See HTTPServerConnection.compressor
+    wsDeflate: Optional[PerMessageDeflate]  # See HTTPServerConnection.wsDeflate
+    _reaper: Optional[Thread]  # Closes the idle connections
 
     def __init__(self, address: tuple[str, int],
                  onConnection: onConnectionListener):
@@ -214,6 +400,13 @@ class HTTPServer(ProtocolServer):
                          onConnection)
         self.acceptWSChecker = returnFalse
         self.acceptSSEChecker = returnFalse
+        self.keepAliveTimeout = self.KEEP_ALIVE_TIMEOUT
+        self.maxRequests = self.MAX_REQUESTS
+        self.bodySinkFactory = None
+        self.lazyHeaders = False
+        self.compressor = None
+        self.wsDeflate = None
+        self._reaper = None
 
     def acceptWebsocket(self, acceptWSChecker: AcceptWSChecker):
         self.acceptWSChecker = acceptWSChecker
@@ -224,7 +417,26 @@ class HTTPServer(ProtocolServer):
     def onConnectionInner(self, conn: HTTPServerConnection) -> bool:
         conn.acceptWebsocket(self.acceptWSChecker)
         conn.acceptServerSentEvents(self.acceptSSEChecker)
+        conn.keepAliveTimeout = self.keepAliveTimeout
+        conn.maxRequests = self.maxRequests
+        conn.bodySinkFactory = self.bodySinkFactory
+        conn.lazyHeaders = self.lazyHeaders
+        conn.compressor = self.compressor
+        conn.wsDeflate = self.wsDeflate
+        if self._reaper is None:
+            self._reaper = Thread(target=self._reapIdle, name="HTTPServer-reaper", daemon=True)
+            self._reaper.start()
         return True
 
+    def _reapIdle(self):
+        """The reaper thread's loop, closing the connections idle for longer than keepAliveTimeout"""
+        while not (self.closed and len(self.connections) == 0):
+            sleep(min(1.0, self.keepAliveTimeout / 4))
+            now: float = monotonic()
+            for conn in list(self.connections):
+                if isinstance(conn, HTTPServerConnection) and conn.isIdle(now):
+                    conn.closeIdle()
+        self._reaper = None
+
 
 __all__ = ["HTTPServer", "HTTPServerConnection", "HTTPServerProtocol"]
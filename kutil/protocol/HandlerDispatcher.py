@@ -0,0 +1,202 @@
+#  -*- coding: utf-8 -*-
+"""
+Runs the onData handlers of a ProtocolServer's connections on a fixed-size thread pool, so a slow
+handler doesn't stall the receiving and the total handler work is bounded.
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum, unique, auto
+from threading import Condition
+from time import perf_counter
+from typing import Any, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from kutil.protocol.ProtocolConnection import ProtocolConnection
+
+
+@unique
+class RejectionPolicy(Enum):
+    """
+    What to do with the received data when the dispatcher is full
+    """
+    REJECT = auto()  # Call the connection's rejectData(), e.g., HTTP 503
+    # Block the receiving until there's room (slows the client down) - on an event loop's I/O thread
+    # the data is accepted and the connection stops reading instead, not to stall the other ones
+    BLOCK = auto()
+    DROP = auto()  # Silently drop the data
+
+
+class HandlerQueueFullError(ConnectionError):
+    """A connection sent more data than its queue in the dispatcher holds, see maxQueued"""
+    pass
+
+
+class HandlerDispatcher:
+    """
+    A fixed-size thread pool running the onData handlers, with a serial queue per connection
+    (so the data of one connection is still handled in order) and a global limit of the pending
+    (queued or running) handlers. A connection whose queue is over maxQueued (e.g., a client
+    pipelining requests while they're being rejected) is closed with HandlerQueueFullError.
+
+    Assign it to ``ProtocolServer.dispatcher`` before calling listen().
+    """
+    PAUSE_REASON: str = "dispatcher"  # See ProtocolConnection.pauseReading()
+
+    workers: int
+    maxPending: int
+    maxQueued: int
+    policy: RejectionPolicy
+    # Statistics
+    completed: int
+    rejected: int
+    peakPending: int  # The highest pending count seen
+    totalWait: float  # The time the handled data spent queued, in seconds
+    maxWait: float
+
+    _executor: ThreadPoolExecutor
+    _queues: dict["ProtocolConnection", deque[tuple[Any, float, bool]]]  # Data, queued at, rejected
+    _pending: int
+    _condition: Condition
+    _paused: set["ProtocolConnection"]  # The connections not reading until there's room
+
+    def __init__(self, workers: int = 8, maxPending: int = 1024,
+                 policy: RejectionPolicy = RejectionPolicy.REJECT, maxQueued: int = 256):
+        """
+        Creates a dispatcher.
+        :param workers: How many handlers run at once
+        :param maxPending: How many handlers may be queued or running at once
+        :param policy: What to do with the data over the limit
+        :param maxQueued: How many data (including the rejected ones) one connection may have queued
+        """
+        assert workers > 0 and maxPending > 0 and maxQueued > 0
+        self.workers = workers
+        self.maxPending = maxPending
+        self.maxQueued = maxQueued
+        self.policy = policy
+        self.completed = 0
+        self.rejected = 0
+        self.peakPending = 0
+        self.totalWait = 0
+        self.maxWait = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="HandlerDispatcher")
+        self._queues = {}
+        self._pending = 0
+        self._condition = Condition()
+        self._paused = set()
+
+    def dispatch(self, conn: "ProtocolConnection", data: Any) -> bool:
+        """
+        Queues the data to be handled by the connection's onData handler.
+        :param conn: The connection
+        :param data: The data
+        :return: Whether the data was accepted (False if it was rejected, dropped or the connection
+         got closed)
+        """
+        from kutil.protocol.EventLoop import inIOThread
+
+        with self._condition:
+            rejected: bool = False
+            queue: Optional[deque] = self._queues.get(conn)
+            overflow: bool = queue is not None and len(queue) >= self.maxQueued
+            if overflow:
+                self.rejected += 1
+            elif self._pending >= self.maxPending:
+                if self.policy is RejectionPolicy.BLOCK:
+                    if inIOThread() and conn.eventLoop is not None:
+                        # The data is accepted, resumed by _handleNext() once there's room
+                        self._paused.add(conn)
+                        conn.pauseReading(self.PAUSE_REASON)
+                    else:
+                        self._condition.wait_for(lambda: self._pending < self.maxPending)
+                else:
+                    self.rejected += 1
+                    if self.policy is RejectionPolicy.DROP:
+                        return False
+                    rejected = True
+            scheduled: bool = queue is not None
+            rejectNow: bool = rejected and not scheduled
+            if not rejectNow and not overflow:
+                # A rejection of a connection with queued data has to wait for its turn too
+                # (e.g., the HTTP responses must be sent in the order of the requests)
+                if queue is None:
+                    queue = self._queues[conn] = deque()
+                queue.append((data, perf_counter(), rejected))
+                self._pending += 1
+                self.peakPending = max(self.peakPending, self._pending)
+        if overflow:
+            conn.close(HandlerQueueFullError(f"More than {self.maxQueued} data queued"))
+            return False
+        if rejectNow:
+            conn.rejectData(data)  # Nothing to keep the order with
+        elif not scheduled:
+            self._executor.submit(self._handleNext, conn)
+        return not rejected
+
+    def _handleNext(self, conn: "ProtocolConnection") -> None:
+        """Handles one queued data of the connection, then lets the other connections go first"""
+        with self._condition:
+            data, queuedAt, rejected = self._queues[conn].popleft()
+            if not rejected:
+                wait: float = perf_counter() - queuedAt
+                self.totalWait += wait
+                self.maxWait = max(self.maxWait, wait)
+        try:
+            if conn.closed:
+                pass
+            elif rejected:
+                conn.rejectData(data)
+            else:
+                conn.onData(conn, data)
+        except Exception as e:
+            conn.close(e)
+        finally:
+            with self._condition:
+                self._pending -= 1
+                if not rejected:
+                    self.completed += 1
+                more: bool = len(self._queues[conn]) > 0
+                if not more:
+                    del self._queues[conn]
+                resumed: list["ProtocolConnection"] = []
+                if self._pending < self.maxPending:
+                    resumed = list(self._paused)
+                    self._paused.clear()
+                self._condition.notify_all()
+            for pausedConn in resumed:
+                pausedConn.resumeReading(self.PAUSE_REASON)
+            if more:
+                self._executor.submit(self._handleNext, conn)
+
+    @property
+    def pending(self) -> int:
+        """How many handlers are queued or running"""
+        return self._pending
+
+    @property
+    def queuedConnections(self) -> int:
+        """How many connections have pending data"""
+        return len(self._queues)
+
+    @property
+    def averageWait(self) -> float:
+        """The average time the handled data spent queued, in seconds"""
+        return self.totalWait / self.completed if self.completed > 0 else 0
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stops the worker threads.
+        :param wait: Whether to wait for the pending handlers
+        """
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def __repr__(self) -> str:
+        return (f"HandlerDispatcher(workers={self.workers}, pending={self._pending}/"
+                f"{self.maxPending}, peak={self.peakPending}, completed={self.completed}, "
+                f"rejected={self.rejected}, averageWait={self.averageWait * 1000:.1f}ms, "
+                f"maxWait={self.maxWait * 1000:.1f}ms)")
+
+
+__all__ = ["HandlerDispatcher", "RejectionPolicy", "HandlerQueueFullError"]
@@ -1,34 +1,125 @@
 #  -*- coding: utf-8 -*-
 __author__ = "kubik.augustyn@post.cz"
 
+import errno
+import os
+import socket as _socket
+from collections import deque
+from enum import Enum, unique, auto
 from threading import Thread, Lock
-from typing import Callable, Any, Optional, Self
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_RCVBUF, SO_SNDBUF
+from time import monotonic
+from typing import Callable, Any, Optional, Self, Iterable, TYPE_CHECKING
+from socket import (socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_RCVBUF, SO_SNDBUF, IPPROTO_TCP,
+                    TCP_NODELAY)
 
 from kutil.buffer.AppendedByteBuffer import AppendedByteBuffer
+from kutil.buffer.FileByteBuffer import FileByteBuffer
 
 from kutil.protocol.AbstractProtocol import AbstractProtocol, NeedMoreDataError, StopUnpacking
+from kutil.protocol.DNSCache import dnsCache
 from kutil.buffer.ByteBuffer import ByteBuffer
 from kutil.buffer.MemoryByteBuffer import MemoryByteBuffer
 
+if TYPE_CHECKING:
+    from kutil.protocol.EventLoop import EventLoop
+    from kutil.protocol.HandlerDispatcher import HandlerDispatcher
+
 type OnDataListener = Callable[[ProtocolConnection, Any], None]
 type OnEstablishedListener = Callable[[ProtocolEstablishedConnection], None]
 type OnCloseListener = Callable[[ProtocolConnection, Optional[Exception]], None]
+type OnDrainListener = Callable[[ProtocolConnection], None]
+
+# Tells the kernel more data follows (Linux), so the head and the sendfile()'d body share packets
+MSG_MORE: int = getattr(_socket, "MSG_MORE", 0)
+# Makes one send() on a blocking socket non-blocking (not on Windows)
+MSG_DONTWAIT: int = getattr(_socket, "MSG_DONTWAIT", 0)
+try:
+    IOV_MAX: int = os.sysconf("SC_IOV_MAX")  # How many buffers one sendmsg() accepts
+except (AttributeError, ValueError, OSError):
+    IOV_MAX: int = -1
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
 
 
 class ConnectionClosed(Exception):
     pass
 
 
+class SlowConsumerError(ConnectionError):
+    """The peer didn't read the sent data fast enough, see SlowConsumerPolicy.DISCONNECT"""
+    pass
+
+
+@unique
+class SlowConsumerPolicy(Enum):
+    """
+    What a connection does when more than its highWatermark bytes wait to be sent
+    """
+    # The sender waits until the peer reads the data down to the lowWatermark - except on an event
+    # loop's I/O thread (a handler without a dispatcher), which would stall all its connections,
+    # there the connection stops reading (so the peer stops sending) until it's writable again
+    BLOCK = auto()
+    # Drop the oldest whole messages that weren't being sent yet, only where the messages don't
+    # depend on each other (see ProtocolConnection.canDropMessages), BLOCK elsewhere
+    DROP_OLDEST = auto()
+    DISCONNECT = auto()  # Close the connection (with SlowConsumerError)
+
+
 class ProtocolConnection:
-    """An event-based connection, doesn't block any thread (creates one thread for its needs)"""
+    """
+    An event-based connection, doesn't block any thread (creates one thread for its needs,
+    or none when served by an EventLoop)
+
+    The sent data can be coalesced: between cork() and uncork() it's queued and then sent in as few
+    system calls as possible - e.g., when broadcasting many small WS messages or SSE events.
+
+    The data the socket doesn't accept right away waits in an outbound buffer (sent as the peer reads)
+    instead of blocking the sender. Once it holds more than highWatermark bytes, the connection isn't
+    writable (see isWritable) and the slowConsumerPolicy applies, the onDrain listeners are called
+    when it's down to lowWatermark bytes again. This needs a real socket, the socket-like objects
+    (e.g., an ssl.SSLSocket) always block the sender. A message bigger than the highWatermark
+    streams through the buffer, the slowConsumerPolicy counts only the messages sent after it.
+    """
+    FLUSH_SIZE: int = 64 * 1024  # The corked queue is sent once it has this many bytes
+    FLUSH_DELAY: float = .005  # Seconds, the corked queue is sent at latest this long after the data
+    HIGH_WATERMARK: int = 1024 * 1024  # 1 MB
+    LOW_WATERMARK: int = 256 * 1024  # 256 kB
+    SLOW_CONSUMER_POLICY: SlowConsumerPolicy = SlowConsumerPolicy.BLOCK
+    CLOSE_TIMEOUT: float = 30  # Seconds close() waits for the buffered data to be sent
+    WRITABLE_RETRY: float = .01  # Seconds, see _onWritable()
+    SLOW_CONSUMER: str = "slowConsumer"  # The reason of the reading pause, see pauseReading()
     layers: list[AbstractProtocol]
     onData: OnDataListener
     onCloseListeners: list[OnCloseListener]
-    receiverThread: Thread
+    receiverThread: Optional[Thread]
+    eventLoop: Optional["EventLoop"]  # Set it before startRecv() to use the event loop
+    dispatcher: Optional["HandlerDispatcher"]  # Runs the onData handler on a worker thread
     sendingLock: Lock
     closed: bool
     sock: socket
+    flushSize: int  # See FLUSH_SIZE, it's also the most data the queue holds
+    flushDelay: float  # See FLUSH_DELAY
+    queueHighWater: int  # The most bytes the queue ever held
+    highWatermark: int  # See HIGH_WATERMARK
+    lowWatermark: int  # See LOW_WATERMARK
+    slowConsumerPolicy: SlowConsumerPolicy
+    onDrainListeners: list[OnDrainListener]  # Called when the connection becomes writable again
+    droppedMessages: int  # See SlowConsumerPolicy.DROP_OLDEST
+    _recvBuffer: ByteBuffer
+    _queue: list[ByteBuffer]  # The packed data waiting for uncork() or a flush
+    _queued: int  # The bytes in the queue
+    _corked: int  # How many cork() calls weren't uncork()ed yet
+    _flushScheduled: bool
+    _noDelay: bool  # Whether TCP_NODELAY was set
+    _queueLock: Lock
+    _outbound: deque[ByteBuffer]  # The packed data the socket didn't accept yet
+    _outboundBytes: int
+    _writable: bool
+    _watching: Optional["EventLoop"]  # The loop watching the socket's writability
+    _watchPaused: bool  # Whether the watch is off while another thread holds the sendingLock
+    _readPauses: set[str]  # Why the reading is paused (see pauseReading()), empty if it isn't
+    _closing: bool  # Whether close() was called, it might wait for the buffered data to be sent
+    _closeCause: Optional[Exception]
 
     def __init__(self, address: tuple[str, int], layers: list[AbstractProtocol],
                  onData: OnDataListener, sock: Optional[socket] = None,
@@ -36,9 +127,34 @@ class ProtocolConnection:
         self.layers = layers
         self.onData = onData
         self.onCloseListeners = onClose if onClose is not None else []
-        self.receiverThread = Thread(target=self.receive)
+        self.receiverThread = None
+        self.eventLoop = None
+        self.dispatcher = None
         self.sendingLock = Lock()
         self.closed = False
+        self.flushSize = self.FLUSH_SIZE
+        self.flushDelay = self.FLUSH_DELAY
+        self.queueHighWater = 0
+        self.highWatermark = self.HIGH_WATERMARK
+        self.lowWatermark = self.LOW_WATERMARK
+        self.slowConsumerPolicy = self.SLOW_CONSUMER_POLICY
+        self.onDrainListeners = []
+        self.droppedMessages = 0
+        self._recvBuffer = MemoryByteBuffer()
+        self._queue = []
+        self._queued = 0
+        self._corked = 0
+        self._flushScheduled = False
+        self._noDelay = False
+        self._queueLock = Lock()
+        self._outbound = deque()
+        self._outboundBytes = 0
+        self._writable = True
+        self._watching = None
+        self._watchPaused = False
+        self._readPauses = set()
+        self._closing = False
+        self._closeCause = None
         if sock is None:  # If we are a client connection
             self.connect(address)
             self.startRecv()
@@ -55,6 +171,10 @@ class ProtocolConnection:
         return True  # Subclasses will overwrite this, return whether you want to call the onData handler
 
     def startRecv(self):
+        if self.eventLoop is not None:
+            self.eventLoop.register(self.sock, self._onReadable)
+            return
+        self.receiverThread = Thread(target=self.receive)
         self.receiverThread.start()
 
     def connect(self, address: tuple[str, int]):
@@ -62,7 +182,8 @@ class ProtocolConnection:
         self.sock.setsockopt(SOL_SOCKET, SO_RCVBUF, 5 * 1024 * 1024)  # 5 MB max
         self.sock.setsockopt(SOL_SOCKET, SO_SNDBUF, 5 * 1024 * 1024)  # 5 MB max
         try:
-            self.sock.connect(address)
+            # The cached resolution, the host name is kept in the address (e.g., for the TLS SNI)
+            self.sock.connect(dnsCache.resolveAddress(address, AF_INET))
         except TimeoutError as e:
             self.close(e)
 
@@ -76,10 +197,50 @@ class ProtocolConnection:
         self.layers = self.layers[:self.layers.index(protocol)]
 
     def close(self, cause: Optional[Exception] = None):
+        """
+        Closes the connection once the queued and the buffered data are sent (at most CLOSE_TIMEOUT
+        seconds). On an event loop's I/O thread, it doesn't wait - the connection stops reading and
+        the loop finishes the close once the data are sent.
+        :param cause: Why the connection is closed, passed to the onClose listeners
+        """
+        from kutil.protocol.EventLoop import inIOThread, callLater
+
         if self.closed:
             return
+        if self._closing:
+            if cause is not None:
+                self._finishClose(cause)  # E.g., sending the rest failed
+            return
+        self._closing = True
+        if (len(self._queue) > 0 or len(self._outbound) > 0) and not isinstance(cause,
+                                                                                SlowConsumerError):
+            if inIOThread():
+                self._closeCause = cause
+                self.pauseReading("closing")
+                # Might close the connection if sending fails
+                if self._sendLocked(self._flushQueue) and len(self._outbound) > 0:
+                    callLater(self.CLOSE_TIMEOUT, self._closeTimedOut, self.eventLoop)
+                    return  # See _onWritable()
+            else:
+                self.drain(self.CLOSE_TIMEOUT)  # Might close the connection if sending fails
+            if self.closed:
+                return
+        self._finishClose(cause)
 
+    def _finishClose(self, cause: Optional[Exception]) -> None:
+        """Closes the socket without sending the rest of the data, calls the onClose listeners"""
+        if self.closed:
+            return
         self.closed = True
+        if self._watching is not None and self._watching is not self.eventLoop:
+            self._watching.watchWritable(self.sock, None)
+        if self.eventLoop is not None:
+            self.eventLoop.unregister(self.sock)
+        with self._queueLock:
+            for buff in self._queue + list(self._outbound):
+                buff.destroy()  # Not sent
+            self._queue.clear()
+            self._outbound.clear()
         # try:
         self.sock.close()
         # except OSError:
@@ -88,32 +249,106 @@ class ProtocolConnection:
         for listener in self.onCloseListeners:
             listener(self, cause)
 
+    def _closeTimedOut(self) -> None:
+        self._finishClose(TimeoutError("The peer didn't read the data sent before the close"))
+
+    def pauseReading(self, reason: str) -> None:
+        """
+        Stops reading from the socket of a connection served by an event loop (the peer's data wait
+        in the kernel, so TCP slows the peer down) until resumeReading() is called with each reason
+        the reading was paused for.
+        :param reason: Why, e.g., SLOW_CONSUMER
+        """
+        with self._queueLock:
+            first: bool = len(self._readPauses) == 0
+            self._readPauses.add(reason)
+        if first and self.eventLoop is not None:
+            self.eventLoop.pauseReading(self.sock, True)
+
+    def resumeReading(self, reason: str) -> None:
+        """
+        Ends the pauseReading() for the reason, the reading continues once there's no other one.
+        :param reason: The reason passed to pauseReading()
+        """
+        with self._queueLock:
+            resume: bool = reason in self._readPauses and len(self._readPauses) == 1
+            self._readPauses.discard(reason)
+        if resume and self.eventLoop is not None and not self.closed:
+            # The data received before the pause first, then the socket
+            self.eventLoop.callSoon(self._continueReading)
+
+    @property
+    def readingPaused(self) -> bool:
+        return len(self._readPauses) > 0
+
+    def _continueReading(self) -> None:
+        if self.closed or self.readingPaused:
+            return
+        try:
+            self.parseReceived()
+        except Exception as e:
+            self.close(e)
+            return
+        if not self.closed and not self.readingPaused:
+            self.eventLoop.pauseReading(self.sock, False)
+
     def receive(self):
-        buff: ByteBuffer = MemoryByteBuffer()
+        """The receiver thread's loop, used when the connection isn't served by an event loop"""
         try:
             while not self.closed:
-                data = self.sock.recv(1024 * 1024)
-                if not len(data):
-                    self.close(ConnectionClosed())
+                if not self.feedData(self.sock.recv(1024 * 1024)):
                     return
-                buff.write(data)
-                buff.resetPointer()
-                while buff.has(1) and not self.closed:
-                    # Read all the packets that are packed tightly one after another
-                    # print(f"Pointer: {buff.pointer}, length: {len(buff.export())}")
-                    # print("Data:", buff.export())
-                    if self.tryReceivedData(buff):
-                        # print(f"Pointer after read: {buff.pointer}")
-                        buff.resetBeforePointer()
-                        # print(f"Length: {len(buff.export())}")
-                    else:
-                        # print("Not successful")
-                        break
         except OSError as e:
             self.close(e)
         except (ConnectionAbortedError, ConnectionError, ConnectionResetError) as e:
             self.close(e)
 
+    def _onReadable(self):
+        """Called by the event loop when the socket has data to read"""
+        if self.closed:
+            return
+        recvBuffer: bytearray = self.eventLoop.recvBuffer()
+        try:
+            received: int = self.sock.recv_into(recvBuffer)
+        except (BlockingIOError, InterruptedError):
+            return  # A spurious wakeup
+        except OSError as e:
+            self.close(e)
+            return
+        try:
+            with memoryview(recvBuffer) as view:
+                self.feedData(view[:received])
+        except Exception as e:
+            # Would kill the receiver thread, here it just kills the connection
+            self.close(e)
+
+    def feedData(self, data: bytes | bytearray | memoryview) -> bool:
+        """
+        Handles the data received from the socket, parsing all the complete packets in it.
+        :param data: The received data, empty when the peer closed the connection
+        :return: Whether the connection is still open
+        """
+        if len(data) == 0:
+            self.close(ConnectionClosed())
+            return False
+        self._recvBuffer.write(data)
+        return self.parseReceived()
+
+    def parseReceived(self) -> bool:
+        """
+        Parses the complete packets of the received data, until the reading is paused
+        :return: Whether the connection is still open
+        """
+        buff: ByteBuffer = self._recvBuffer
+        buff.resetPointer()
+        while buff.has(1) and not self.closed and not self._closing and not self.readingPaused:
+            # Read all the packets that are packed tightly one after another
+            if self.tryReceivedData(buff):
+                buff.resetBeforePointer()
+            else:
+                break
+        return not self.closed
+
     def tryReceivedData(self, buff: ByteBuffer) -> bool:
         """
         Tries to parse and handle the received data,
@@ -126,11 +361,13 @@ class ProtocolConnection:
             return True
 
         layerI: int = -1
-        lastBuff: ByteBuffer = buff.copy()
+        # Remember where the layer started reading instead of copying the whole buffer
+        lastBuff: ByteBuffer = buff
+        lastLeft: int = buff.leftLength()
         try:
             for layerI in range(len(self.layers) - 1):
                 buff = self.layers[layerI].unpackSubProtocol(buff)
-                lastBuff = buff.copy()
+                lastBuff, lastLeft = buff, buff.leftLength()
                 if self.closed:
                     # If the sub-protocol unpacker closed the connection, cancel the onData handler
                     return True
@@ -145,24 +382,392 @@ class ProtocolConnection:
                     # print(data, "-->", dataInner)
                     data = dataInner
                 # print("On data:", data, "with inner:", dataInner)
-                self.onData(self, data)
+                self.handleData(data)
             return True
-        except NeedMoreDataError:
+        except NeedMoreDataError as e:
             # print("Need more data!")
             # print(buff.export())
+            if e.consumed:
+                buff.resetBeforePointer()  # The protocol keeps what it has read so far
             return False
         except StopUnpacking:
             # Basically, this error means that at the current layer we should stop unpacking the
             # protocol layers and pass the data directly to the connection to be processed and never
             # passed to the last protocol, because it's a not-final-layer data packet.
             # print("Stop unpacking!")
+            if lastBuff.leftLength() < lastLeft:
+                lastBuff.back(lastLeft - lastBuff.leftLength())
             data: Any = self.layers[layerI].unpackData(lastBuff)
             dataInner: bool | Any = self.onDataInner(data, True, self.layers[layerI])
             assert isinstance(dataInner, bool) and dataInner is False
             return True
 
+    def handleData(self, data: Any):
+        """
+        Passes the unpacked data to the onData handler, through the dispatcher if there's one.
+        Subclasses may overwrite this to run the handler elsewhere
+        :param data: The data
+        """
+        if self.dispatcher is not None:
+            self.dispatcher.dispatch(self, data)
+        else:
+            self.onData(self, data)
+
+    def rejectData(self, data: Any):
+        """
+        Called instead of the onData handler when the dispatcher is full, drops the data by default
+        :param data: The data
+        """
+        pass  # Subclasses will overwrite this, e.g., to tell the client to try again later
+
     def sendData(self, data: Any, beginAtLayer: int = -1, allowChunking: bool = True,
                  chunkSize: int = 1024 * 1024 * 10) -> bool:
+        return self._sendPacked(self._packData(data, beginAtLayer, allowChunking), allowChunking,
+                                chunkSize)
+
+    def _sendPacked(self, buff: ByteBuffer, allowChunking: bool = True,
+                    chunkSize: int = 1024 * 1024 * 10,
+                    stream: Optional[Iterable[bytes]] = None) -> bool:
+        """
+        Sends the packed data and destroys the buffer
+        :param buff: The packed data, see _packData()
+        :param allowChunking: Whether to send the data in chunks of chunkSize
+        :param chunkSize: How much data to send at once
+        :param stream: The (already packed) data to send right after the buffer as it's produced,
+         e.g., a streamed HTTP body - the connection is closed if producing it raises an exception
+        :return: Whether the data was sent or queued (False if the connection got closed)
+        """
+        if stream is None and allowChunking:
+            if self._enqueue(buff):
+                return True
+            if self._canDefer():
+                return self._sendLocked(self._write, [buff])
+        try:
+            with self.sendingLock:
+                self._flushQueue()  # The queued and the buffered data go first
+                self._drainOutbound(0)
+                if allowChunking:
+                    if self._sendSegments([buff], stream is not None) is None:
+                        for chunk in buff.batched(chunkSize):  # Default is 10 MB
+                            self._sendAll(chunk)
+                else:
+                    self._sendAll(buff.export())
+                if stream is not None:
+                    for chunk in stream:
+                        self._sendAll(chunk)
+            return True
+        except OSError as e:
+            self.close(e)
+            return False
+        except Exception as e:
+            if stream is None:
+                raise
+            self.close(e)  # The stream failed half-way, the peer can't tell the data is cut
+            return False
+        finally:
+            buff.destroy()
+
+    def _sendLocked(self, send: Callable[..., None], *args: Any) -> bool:
+        """
+        Calls the sending method holding the sendingLock, then calls the onDrain listeners if the
+        connection became writable
+        :return: Whether it succeeded (False if the connection got closed)
+        """
+        try:
+            with self.sendingLock:
+                send(*args)
+                drained: bool = self._updateWritable()
+        except OSError as e:
+            self.close(e)
+            return False
+        if drained:
+            for listener in list(self.onDrainListeners):
+                listener(self)
+        return True
+
+    def cork(self) -> None:
+        """
+        Starts queueing the sent data instead of sending it right away, until the matching uncork()
+        (the calls nest). The queue is sent anyway once it has flushSize bytes or flushDelay seconds
+        after the data was queued. As the queue coalesces the small writes, TCP_NODELAY is set, so
+        the kernel doesn't delay them once more.
+        """
+        with self._queueLock:
+            self._corked += 1
+        if not self._noDelay:
+            self._noDelay = True
+            try:
+                self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            except (OSError, AttributeError):
+                pass  # Not a TCP socket (or not a real one)
+
+    def uncork(self) -> bool:
+        """
+        Ends a cork(), sending the queued data if it was the outermost one
+        :return: Whether the data was sent (False if the connection got closed)
+        """
+        with self._queueLock:
+            assert self._corked > 0, "uncork() without cork()"
+            self._corked -= 1
+            corked: bool = self._corked > 0
+        return True if corked else self.flush()
+
+    @property
+    def corked(self) -> bool:
+        return self._corked > 0
+
+    @property
+    def queuedBytes(self) -> int:
+        """How many bytes wait in the queue"""
+        return self._queued
+
+    def flush(self) -> bool:
+        """
+        Sends the queued data now, even if corked
+        :return: Whether the data was sent or buffered (False if the connection got closed)
+        """
+        return self._sendLocked(self._flushQueue)
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Sends the queued and the buffered data now, blocking until the socket accepts all of it
+        :param timeout: Seconds to wait at most, None for no limit - the connection is closed (with
+         TimeoutError) if the peer doesn't read the data in time
+        :return: Whether the data was sent (False if the connection got closed)
+        """
+        return self._sendLocked(self._drainOutbound, 0, True, timeout)
+
+    @property
+    def isWritable(self) -> bool:
+        """
+        Whether the connection accepts more data without exceeding its highWatermark, once it
+        doesn't, it becomes writable again (calling the onDrain listeners) at the lowWatermark
+        """
+        return self._writable and not self.closed
+
+    @property
+    def outboundBytes(self) -> int:
+        """How many bytes wait for the socket to accept them"""
+        return self._outboundBytes
+
+    def _enqueue(self, buff: ByteBuffer) -> bool:
+        """
+        Queues the packed data if corked, sending the queue once it's full
+        :param buff: The packed data, the queue destroys it once it's sent
+        :return: Whether the data was queued, False if it should be sent right away
+        """
+        with self._queueLock:
+            if self._corked == 0:
+                return False
+            self._queue.append(buff)
+            self._queued += buff.leftLength()
+            self.queueHighWater = max(self.queueHighWater, self._queued)
+            full: bool = self._queued >= self.flushSize
+            schedule: bool = not full and not self._flushScheduled
+            if schedule:
+                self._flushScheduled = True
+        if full:
+            self.flush()
+        elif schedule:
+            from kutil.protocol.EventLoop import callLater
+
+            callLater(self.flushDelay, self._timedFlush, self.eventLoop)
+        return True
+
+    def _timedFlush(self) -> None:
+        self._flushScheduled = False
+        if len(self._queue) > 0 and not self.closed:
+            self.flush()
+
+    def _flushQueue(self) -> None:
+        """Sends the queued data, the caller must hold the sendingLock"""
+        with self._queueLock:
+            if len(self._queue) == 0:
+                return
+            queue: list[ByteBuffer] = self._queue
+            self._queue = []
+            self._queued = 0
+        if self._canDefer():
+            self._write(queue)
+            return
+        try:
+            for buff in queue:
+                for chunk in buff.batched(1024 * 1024 * 10):
+                    self._sendAll(chunk)
+        finally:
+            for buff in queue:
+                buff.destroy()
+
+    def _canDefer(self) -> bool:
+        """Whether the data the socket doesn't accept right away can wait in the outbound buffer"""
+        # Not for the socket-like objects and subclasses (an ssl.SSLSocket must encrypt the data)
+        return (type(self.sock) is socket and hasattr(self.sock, "sendmsg") and
+                (MSG_DONTWAIT != 0 or not self.sock.getblocking()))
+
+    def _write(self, buffers: list[ByteBuffer]) -> None:
+        """
+        Sends what the socket accepts right away, the rest waits in the outbound buffer. The caller
+        must hold the sendingLock
+        :param buffers: The packed data, destroyed once it's sent
+        :exception SlowConsumerError: If the connection should be closed, see SlowConsumerPolicy
+        """
+        for buff in buffers:
+            self._outbound.append(buff)
+            self._outboundBytes += buff.leftLength()
+        if self._watching is None:  # Otherwise the socket was full, the loop sends it when it isn't
+            self._sendOutbound()
+        if self._outboundBytes > self.highWatermark:
+            self._writable = False
+        if self._countedBytes() > self.highWatermark:
+            from kutil.protocol.EventLoop import inIOThread
+
+            policy: SlowConsumerPolicy = self.slowConsumerPolicy
+            if policy is SlowConsumerPolicy.DROP_OLDEST and not self.canDropMessages:
+                policy = SlowConsumerPolicy.BLOCK
+            if policy is SlowConsumerPolicy.BLOCK:
+                if inIOThread():
+                    self.pauseReading(self.SLOW_CONSUMER)  # Until _updateWritable()
+                else:
+                    self._drainOutbound(self.lowWatermark)
+            elif policy is SlowConsumerPolicy.DROP_OLDEST:
+                self._dropOldest()
+            else:
+                raise SlowConsumerError(f"{self._outboundBytes} bytes wait to be sent")
+        if len(self._outbound) > 0 and self._watching is None:
+            from kutil.protocol.EventLoop import backgroundLoop
+
+            self._watching = self.eventLoop if self.eventLoop is not None else backgroundLoop()
+            self._watching.watchWritable(self.sock, self._onWritable)
+
+    def _sendOutbound(self) -> int:
+        """
+        Sends what the socket accepts of the outbound buffer right away, the caller must hold the
+        sendingLock
+        :return: How many bytes were sent
+        """
+        sent: int = self._sendSegments(list(self._outbound), block=False)
+        self._outboundBytes -= sent
+        while len(self._outbound) > 0 and self._outbound[0].leftLength() == 0:
+            self._outbound.popleft().destroy()
+        if len(self._outbound) == 0 and self._watching is not None:
+            self._watching.watchWritable(self.sock, None)
+            self._watching = None
+        return sent
+
+    def _drainOutbound(self, limit: int, flushQueue: bool = False,
+                       timeout: Optional[float] = None) -> None:
+        """
+        Sends the outbound buffer until at most limit bytes are left in it, blocking. The caller
+        must hold the sendingLock
+        :param limit: The bytes that may be left
+        :param flushQueue: Whether to send the corked queue first
+        :param timeout: Seconds to wait at most, None for no limit
+        :exception TimeoutError: If the peer doesn't read the data in time
+        """
+        from kutil.protocol.EventLoop import waitWritable
+
+        if flushQueue:
+            self._flushQueue()
+        deadline: Optional[float] = monotonic() + timeout if timeout is not None else None
+        while self._outboundBytes > limit:
+            if self._sendOutbound() == 0:
+                left: Optional[float] = deadline - monotonic() if deadline is not None else None
+                if left is not None and (left <= 0 or not waitWritable(self.sock, left)):
+                    raise TimeoutError(f"{self._outboundBytes} bytes weren't sent in {timeout}s")
+                if left is None:
+                    waitWritable(self.sock)
+
+    def _dropOldest(self) -> None:
+        """Drops the oldest messages until the outbound buffer fits the highWatermark"""
+        # A partially sent message has to be sent whole, the newest one is always kept
+        i: int = 1 if self._outbound[0].leftLength() < self._outbound[0].fullLength() else 0
+        while self._outboundBytes > self.highWatermark and len(self._outbound) - i > 1:
+            buff: ByteBuffer = self._outbound[i]
+            del self._outbound[i]
+            self._outboundBytes -= buff.leftLength()
+            buff.destroy()
+            self.droppedMessages += 1
+
+    def _countedBytes(self) -> int:
+        """
+        The outbound bytes the SlowConsumerPolicy applies to - the first message bigger than the
+        highWatermark streams through the buffer, it doesn't count (the messages after it do), the
+        caller must hold the sendingLock
+        """
+        for buff in self._outbound:
+            left: int = buff.leftLength()
+            if left > self.highWatermark:
+                return self._outboundBytes - left
+        return self._outboundBytes
+
+    @property
+    def canDropMessages(self) -> bool:
+        """
+        Whether SlowConsumerPolicy.DROP_OLDEST may drop the sent messages - not where they depend
+        on each other (e.g., the HTTP responses answer the requests in order)
+        """
+        return True  # Subclasses will overwrite this
+
+    def _updateWritable(self) -> bool:
+        """
+        Updates the writable state, the caller must hold the sendingLock
+        :return: Whether the connection became writable
+        """
+        if self._writable:
+            if self._outboundBytes > self.highWatermark:
+                self._writable = False
+            return False
+        if self._outboundBytes <= self.lowWatermark:
+            self._writable = True
+            self.resumeReading(self.SLOW_CONSUMER)
+            return True
+        return False
+
+    def _onWritable(self):
+        """Called by the event loop when the socket can accept more of the outbound data"""
+        from kutil.protocol.EventLoop import callLater
+
+        if self.closed:
+            return
+        if not self.sendingLock.acquire(blocking=False):
+            # Whoever holds the lock sends the outbound data first anyway, the level-triggered
+            # watch would only spin meanwhile - try again later
+            watching: Optional["EventLoop"] = self._watching
+            if watching is not None and not self._watchPaused:
+                self._watchPaused = True
+                watching.watchWritable(self.sock, None)
+                callLater(self.WRITABLE_RETRY, self._onWritable, watching)
+            return
+        drained: bool = False
+        try:
+            if self._watchPaused:
+                self._watchPaused = False
+                if self._watching is not None and len(self._outbound) > 0:
+                    self._watching.watchWritable(self.sock, self._onWritable)
+            self._sendOutbound()
+            drained = self._updateWritable()
+            flushed: bool = self._closing and len(self._outbound) == 0
+        except OSError as e:
+            self.sendingLock.release()
+            self.close(e)
+            return
+        self.sendingLock.release()
+        if flushed:
+            self._finishClose(self._closeCause)  # See close()
+            return
+        if drained:
+            for listener in list(self.onDrainListeners):
+                listener(self)
+
+    def _packData(self, data: Any, beginAtLayer: int = -1,
+                  allowChunking: bool = True) -> ByteBuffer:
+        """
+        Packs the data through the protocol layers, from beginAtLayer down to the TCP layer
+        :param data: The data
+        :param beginAtLayer: The index of the layer packing the data, -1 for the last one
+        :param allowChunking: Whether the result may be an AppendedByteBuffer
+        :return: The packed data, destroy it when you're done with it
+        """
         if beginAtLayer == -1:
             beginAtLayer = len(self.layers) - 1
         if beginAtLayer < 0 or beginAtLayer >= len(self.layers):
@@ -181,19 +786,168 @@ class ProtocolConnection:
                 self.layers[beginAtLayer].packData(data, buff)
             else:
                 self.layers[i].packSubProtocol(buff)
+        return buff
+
+    @staticmethod
+    def _segmentsOf(buffers: list[ByteBuffer]) -> Iterable[tuple[ByteBuffer, int, int]]:
+        """Yields the (buffer, offset, length) parts of the unread data of the buffers"""
+        for buff in buffers:
+            if isinstance(buff, AppendedByteBuffer):
+                yield from buff.segments()
+            else:
+                yield buff, buff.fullLength() - buff.leftLength(), buff.leftLength()
+
+    def _sendSegments(self, buffers: list[ByteBuffer], more: bool = False,
+                      block: bool = True) -> Optional[int]:
+        """
+        Sends the packed data without copying it: the in-memory parts are gathered into as few
+        ``sendmsg`` calls as possible and the file-backed parts (FileByteBuffer) are sent by the
+        kernel (``os.sendfile``), so their content never passes through Python
+        :param buffers: The packed data, in order, their pointers are moved past the sent data
+        :param more: Whether more data follows right after
+        :param block: Whether to wait until all the data is sent, otherwise only what the socket
+         accepts right away is sent (a file on a blocking socket may still block)
+        :return: How many bytes were sent, None if this isn't possible (nothing was sent then)
+        """
+        # Not for the socket-like objects and subclasses (an ssl.SSLSocket must encrypt the data)
+        if type(self.sock) is not socket or not hasattr(self.sock, "sendmsg"):
+            return None
+        useSendfile: bool = hasattr(os, "sendfile")
+        dontWait: int = MSG_DONTWAIT if not block and self.sock.getblocking() else 0
+        views: list[memoryview] = []  # The in-memory parts before the next file
+        viewsLength: int = 0
+        sent: int = 0
         try:
-            with self.sendingLock:
-                if allowChunking:
-                    for chunk in buff.batched(chunkSize):  # Default is 10 MB
-                        self.sock.sendall(chunk)
+            for segment, offset, length in self._segmentsOf(buffers):
+                if length == 0:
+                    continue
+                fd: Optional[int] = (segment.fileno() if useSendfile and
+                                     isinstance(segment, FileByteBuffer) else None)
+                if fd is not None:
+                    sentViews: int = self._sendGathered(views, MSG_MORE | dontWait, block)
+                    sent += sentViews
+                    if sentViews < viewsLength:
+                        break
+                    for view in views:
+                        view.release()
+                    views.clear()
+                    viewsLength = 0
+                    sentFile: int = self._sendFile(segment, fd, offset, length, block)
+                    sent += sentFile
+                    if sentFile < length:
+                        break
+                elif isinstance(segment, MemoryByteBuffer):
+                    views.append(segment.view(offset, length))
+                    viewsLength += length
                 else:
-                    self.sock.sendall(buff.export())
-            return True
-        except OSError as e:
-            self.close(e)
-            return False
+                    segment.resetPointer()
+                    if offset > 0:
+                        segment.skip(offset)
+                    views.append(memoryview(segment.read(length)))
+                    viewsLength += length
+            else:
+                sent += self._sendGathered(views, (MSG_MORE if more else 0) | dontWait, block)
         finally:
-            buff.destroy()
+            for view in views:
+                view.release()  # Let the buffers be destroyed
+        left: int = sent
+        for buff in buffers:
+            if left == 0:
+                break
+            amount: int = min(left, buff.leftLength())
+            buff.skip(amount)
+            left -= amount
+        return sent
+
+    def _sendGathered(self, views: list[memoryview], flags: int = 0, block: bool = True) -> int:
+        """
+        Sends the views using as few ``sendmsg`` calls as possible, handling the partial writes
+        :param views: The data, the list is modified
+        :param flags: The flags of socket.sendmsg(), e.g., MSG_MORE
+        :param block: Whether to wait until all the data is sent
+        :return: How many bytes were sent
+        """
+        from kutil.protocol.EventLoop import waitWritable
+
+        i: int = 0
+        total: int = 0
+        while i < len(views):
+            batch: list[memoryview] = views[i:i + IOV_MAX]
+            last: bool = i + len(batch) == len(views)
+            try:
+                sent: int = self.sock.sendmsg(batch, [], flags if last else flags | MSG_MORE)
+            except (BlockingIOError, InterruptedError):
+                if not block:
+                    break
+                waitWritable(self.sock)
+                continue
+            total += sent
+            # Skip the sent views, then cut the sent part of a partially sent one
+            while i < len(views) and sent >= len(views[i]):
+                sent -= len(views[i])
+                i += 1
+            if sent > 0:
+                views[i] = views[i][sent:]
+        return total
+
+    def _sendFile(self, file: FileByteBuffer, fd: int, offset: int, count: int,
+                  block: bool = True) -> int:
+        """
+        Sends a part of a file using ``os.sendfile``
+        :param file: The file's buffer, read if the file doesn't support sendfile()
+        :param fd: The file's descriptor
+        :param offset: Where the part starts in the buffer (see FileByteBuffer.fileOffset)
+        :param count: The part's length
+        :param block: Whether to wait until all the part is sent
+        :return: How many bytes were sent
+        """
+        from kutil.protocol.EventLoop import waitWritable
+
+        total: int = 0
+        while total < count:
+            try:
+                sent: int = os.sendfile(self.sock.fileno(), fd, file.fileOffset + offset + total,
+                                        count - total)
+            except (BlockingIOError, InterruptedError):
+                if not block:
+                    break
+                waitWritable(self.sock)
+                continue
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                # E.g., a file system without sendfile() support, send the rest the usual way
+                file.resetPointer()
+                if offset + total > 0:
+                    file.skip(offset + total)
+                for chunk in file.batched(1024 * 1024):
+                    self._sendAll(chunk)
+                return count
+            if sent == 0:
+                raise BrokenPipeError("The file ended before all of it was sent")
+            total += sent
+        return total
+
+    def _sendAll(self, data: bytes | bytearray | memoryview, flags: int = 0) -> None:
+        """
+        Sends all the data, waiting for the socket to be writable if it's non-blocking
+        :param data: The data
+        :param flags: The flags of socket.send(), e.g., MSG_MORE
+        """
+        if self.sock.getblocking():
+            if flags != 0:
+                self.sock.sendall(data, flags)
+            else:
+                self.sock.sendall(data)  # Also works for the sockets without flags support
+            return
+        from kutil.protocol.EventLoop import waitWritable
+
+        with memoryview(data) as view:
+            while len(view) > 0:
+                try:
+                    view = view[self.sock.send(view, flags):]
+                except (BlockingIOError, InterruptedError):
+                    waitWritable(self.sock)
 
     @property
     def ownConnection(self):
@@ -2,12 +2,14 @@
 __author__ = "kubik.augustyn@post.cz"
 
 from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_RCVBUF,SO_SNDBUF
-from typing import Callable, Any, Optional
+from typing import Callable, Any, Optional, Final
 
 from kutil.typing_help import neverCall
 
 from kutil.protocol.AbstractProtocol import AbstractProtocol
 from kutil.protocol.ProtocolConnection import ProtocolConnection
+from kutil.protocol.EventLoop import EventLoop
+from kutil.protocol.HandlerDispatcher import HandlerDispatcher
 
 type OnConnectionListener = Callable[
     [ProtocolConnection], Callable[[ProtocolConnection, Any], None]]
@@ -16,12 +18,17 @@ type LayersGetter = Callable[[ProtocolConnection], list[AbstractProtocol]]
 
 class ProtocolServer:
     connectionType: type[ProtocolConnection] = ProtocolConnection
+    MAX_ACCEPTS_PER_WAKEUP: Final[int] = 64  # Don't starve the other sockets of the event loop
 
     sock: socket
     layersGetter: LayersGetter
     onConnection: OnConnectionListener
     closed: bool
     connections: list[ProtocolConnection]
+    eventLoop: Optional[EventLoop]
+    dispatcher: Optional[HandlerDispatcher]  # Set it before listen() to use it
+    _accepted: int
+    _maxAmount: Optional[int]
 
     def __init__(self, address: tuple[str, int], layersGetter: LayersGetter,
                  onConnection: OnConnectionListener):
@@ -32,30 +39,85 @@ class ProtocolServer:
         self.onConnection = onConnection
         self.closed = True
         self.connections = []
+        self.eventLoop = None
+        self.dispatcher = None
+        self._accepted = 0
+        self._maxAmount = None
 
         self.sock.bind(address)
 
-    def listen(self, maxAmount: Optional[int] = None):
+    def listen(self, maxAmount: Optional[int] = None, *, eventLoop: Optional[EventLoop] = None):
+        """
+        Accepts the incoming connections.
+
+        Without an event loop, this blocks and every connection gets its own receiver thread.
+        With one, the accepting and receiving is readiness-driven on the loop's I/O threads -
+        if the loop isn't running yet, it's run in this thread (blocking until it's stopped),
+        otherwise this returns immediately.
+        :param maxAmount: How many connections to accept, None for no limit
+        :param eventLoop: The event loop to serve the connections on
+        """
         if maxAmount is None:
             self.sock.listen()
         else:
             self.sock.listen(maxAmount)
         self.closed = False
-        i = 0
-        while (i < maxAmount) if maxAmount is not None else True:
+        self._accepted = 0
+        self._maxAmount = maxAmount
+
+        if eventLoop is not None:
+            self.eventLoop = eventLoop
+            eventLoop.register(self.sock, self._onAcceptable)
+            if not eventLoop.running:
+                eventLoop.run()
+            return
+
+        while self._canAccept():
             # print("Accept...")
             conn, addr = self.sock.accept()
-            i += 1
-            # I hope that the lambda will know the changed onData value
-            connection: ProtocolConnection = self.connectionType(addr, [], neverCall, conn)
-            for protocol in self.layersGetter(connection):
-                connection.addProtocol(protocol)
-            if not self.onConnectionInner(connection):
-                continue
-            connection.onData = self.onConnection(connection)
-            connection.onCloseListeners.append(self.__onConnectionClose)
-            self.connections.append(connection)
-            connection.startRecv()
+            self._acceptConnection(conn, addr)
+
+    def _canAccept(self) -> bool:
+        return not self.closed and (self._maxAmount is None or self._accepted < self._maxAmount)
+
+    def _onAcceptable(self):
+        """Called by the event loop when there are connections waiting to be accepted"""
+        for _ in range(self.MAX_ACCEPTS_PER_WAKEUP):
+            if not self._canAccept():
+                break
+            try:
+                conn, addr = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # E.g., too many open files - keep serving the existing connections
+                return
+            self._acceptConnection(conn, addr)
+        if not self.closed and not self._canAccept():
+            self.eventLoop.unregister(self.sock)
+
+    def _acceptConnection(self, conn: socket,
+                          addr: tuple[str, int]) -> Optional[ProtocolConnection]:
+        """
+        Sets up and starts a connection of the accepted socket
+        :param conn: The socket (or something acting like one)
+        :param addr: The peer's address
+        :return: The connection, or None if onConnectionInner() didn't want it
+        """
+        self._accepted += 1
+        # I hope that the lambda will know the changed onData value
+        connection: ProtocolConnection = self.connectionType(addr, [], neverCall, conn)
+        connection.eventLoop = self.eventLoop
+        connection.dispatcher = self.dispatcher
+        for protocol in self.layersGetter(connection):
+            connection.addProtocol(protocol)
+        if not self.onConnectionInner(connection):
+            return None
+        connection.onData = self.onConnection(connection)
+        connection.onCloseListeners.append(self.__onConnectionClose)
+        self.connections.append(connection)
+        connection.startRecv()
+        return connection
 
     def __onConnectionClose(self, connection: ProtocolConnection,
                             cause: Optional[Exception]) -> None:
@@ -69,5 +131,7 @@ class ProtocolServer:
     def close(self):
         if self.closed:
             return
+        if self.eventLoop is not None:
+            self.eventLoop.unregister(self.sock)
         self.sock.close()
         self.closed = True
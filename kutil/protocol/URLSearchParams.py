@@ -9,7 +9,7 @@ class URLSearchParams:
 
     def __init__(self, val: Optional[str] = None):
         self.params = {}
-        if val.startswith("?") or val.startswith("&"):
+        if val is not None and (val.startswith("?") or val.startswith("&")):
             val = val[1:]
         if val:
             self.parse(val)
@@ -17,8 +17,9 @@ class URLSearchParams:
     def parse(self, val: str):
         self.params = {}
         for part in val.split("&"):
-            key, value = part.split("=", maxsplit=1)
-            self.params[key] = value
+            if part:
+                key, _, value = part.partition("=")  # A flag without '=' has an empty value
+                self.params[key] = value
 
     def __getitem__(self, item):
         return self.params.__getitem__(item)
@@ -0,0 +1,232 @@
+#  -*- coding: utf-8 -*-
+"""
+The permessage-deflate WebSocket extension (RFC 7692) - the messages are compressed by a deflate
+stream kept for the whole connection (unless the context takeover is disabled), so the repeated
+keys and values of chatty JSON messages cost a few bytes each.
+
+>>> parseExtensions("permessage-deflate; client_max_window_bits, permessage-deflate; x=\\"1\\"")
+[('permessage-deflate', {'client_max_window_bits': None}), ('permessage-deflate', {'x': '1'})]
+"""
+__author__ = "kubik.augustyn@post.cz"
+
+import zlib
+from threading import Lock
+from typing import Final, Optional
+
+from kutil.buffer.ByteBuffer import ByteBufferLike
+
+type TExtension = tuple[str, dict[str, Optional[str]]]  # The name, the parameters
+
+# Removed from the end of every compressed message, added back before decompressing it
+DEFLATE_TAIL: Final[bytes] = b'\x00\x00\xff\xff'
+
+
+def parseExtensions(value: Optional[str]) -> list[TExtension]:
+    """
+    Parses the Sec-WebSocket-Extensions header.
+    :param value: The header's value, None if missing
+    :return: The offered extensions in the order of the client's preference, without the offers
+     with a duplicate parameter (they're invalid)
+    """
+    extensions: list[TExtension] = []
+    if not value:
+        return extensions
+    for offer in value.split(","):
+        name, *params = offer.split(";")
+        if not name.strip():
+            continue
+        parsed: dict[str, Optional[str]] = {}
+        for param in params:
+            key, sep, paramValue = param.partition("=")
+            key = key.strip().lower()
+            if key in parsed:
+                break
+            parsed[key] = paramValue.strip().strip('"') if sep else None
+        else:
+            extensions.append((name.strip().lower(), parsed))
+    return extensions
+
+
+class WSDeflateSession:
+    """
+    The negotiated permessage-deflate of a connection, it compresses the sent messages and
+    decompresses the received ones. Send the messages in the order they were compressed (see lock).
+    """
+    responseHeader: str  # The Sec-WebSocket-Extensions header of the handshake response
+    minSize: int  # The smaller messages are sent as they are
+    level: int
+    maxMessageSize: int  # The biggest decompressed message
+    serverNoContextTakeover: bool  # Compress each sent message on its own
+    clientNoContextTakeover: bool  # Decompress each received message on its own
+    serverWindowBits: int
+    lock: Lock  # Held while a message is compressed and sent
+    _compressor: "zlib._Compress"
+    _decompressor: "zlib._Decompress"
+
+    def __init__(self, responseHeader: str, minSize: int, level: int, maxMessageSize: int,
+                 serverNoContextTakeover: bool, clientNoContextTakeover: bool,
+                 serverWindowBits: int):
+        self.responseHeader = responseHeader
+        self.minSize = minSize
+        self.level = level
+        self.maxMessageSize = maxMessageSize
+        self.serverNoContextTakeover = serverNoContextTakeover
+        self.clientNoContextTakeover = clientNoContextTakeover
+        self.serverWindowBits = serverWindowBits
+        self.lock = Lock()
+        self._compressor = self._createCompressor()
+        self._decompressor = self._createDecompressor()
+
+    def _createCompressor(self) -> "zlib._Compress":
+        return zlib.compressobj(self.level, zlib.DEFLATED, -self.serverWindowBits)
+
+    @staticmethod
+    def _createDecompressor() -> "zlib._Decompress":
+        # A bigger window decompresses the data of a smaller one, whatever the client uses
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def shouldCompress(self, data: ByteBufferLike) -> bool:
+        return len(data) >= self.minSize
+
+    def compress(self, data: ByteBufferLike) -> bytes:
+        """
+        Compresses a whole message.
+        :param data: The message's payload
+        :return: The compressed payload to send with the RSV1 bit set
+        """
+        compressed: bytes = (self._compressor.compress(data) +
+                             self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        if self.serverNoContextTakeover:
+            self._compressor = self._createCompressor()
+        if compressed.endswith(DEFLATE_TAIL):
+            compressed = compressed[:-len(DEFLATE_TAIL)]
+        return compressed if len(compressed) > 0 else b'\x00'  # An empty stored block
+
+    def decompress(self, data: ByteBufferLike) -> bytes:
+        """
+        Decompresses a whole received message (all its frames).
+        :param data: The compressed payload
+        :return: The message's payload
+        :exception ValueError: If the data is invalid or the message is too big
+        """
+        try:
+            message: bytes = self._decompressor.decompress(bytes(data) + DEFLATE_TAIL,
+                                                           self.maxMessageSize)
+        except zlib.error as e:
+            raise ValueError(f"Invalid compressed message: {e}") from e
+        if len(self._decompressor.unconsumed_tail) > 0:
+            raise ValueError(f"The message is bigger than {self.maxMessageSize} bytes")
+        if self.clientNoContextTakeover:
+            self._decompressor = self._createDecompressor()
+        return message
+
+    def __repr__(self) -> str:
+        return f"WSDeflateSession({self.responseHeader})"
+
+
+class PerMessageDeflate:
+    """
+    The server's permessage-deflate settings, assign them to ``HTTPServer.wsDeflate`` to accept
+    the extension when a WebSocket client offers it. The messages smaller than minSize are sent
+    uncompressed, compressing them isn't worth it.
+
+    Without the context takeover, every message is compressed on its own - it costs the ratio,
+    but the connection doesn't keep the deflate window (up to 2 ** windowBits bytes, plus zlib's
+    state) between the messages.
+    """
+    EXTENSION: Final[str] = "permessage-deflate"
+    MIN_SIZE: Final[int] = 256  # Bytes
+    LEVEL: Final[int] = 6
+    MAX_MESSAGE_SIZE: Final[int] = 64 * 1024 * 1024  # 64 MB, against decompression bombs
+
+    minSize: int
+    level: int
+    maxMessageSize: int
+    serverNoContextTakeover: bool  # Don't keep the compression context between the sent messages
+    clientNoContextTakeover: bool  # Ask the client not to keep it between the received ones
+    serverMaxWindowBits: int  # 9-15, the window of the compression of the sent messages
+    clientMaxWindowBits: int  # 8-15, asked of the clients supporting it
+
+    def __init__(self, minSize: int = MIN_SIZE, level: int = LEVEL,
+                 serverNoContextTakeover: bool = False, clientNoContextTakeover: bool = False,
+                 serverMaxWindowBits: int = zlib.MAX_WBITS,
+                 clientMaxWindowBits: int = zlib.MAX_WBITS,
+                 maxMessageSize: int = MAX_MESSAGE_SIZE):
+        """
+        Creates the settings.
+        :param minSize: The smallest message (in bytes) to compress
+        :param level: The zlib compression level (1-9)
+        :param serverNoContextTakeover: Compress each sent message on its own
+        :param clientNoContextTakeover: Ask the clients to compress each message on its own
+        :param serverMaxWindowBits: The window size (as a power of 2) of the sent messages (9-15)
+        :param clientMaxWindowBits: The window size to ask the clients for (8-15)
+        :param maxMessageSize: The biggest decompressed message, bigger ones close the connection
+        """
+        assert 1 <= level <= 9
+        assert 9 <= serverMaxWindowBits <= 15 and 8 <= clientMaxWindowBits <= 15
+        self.minSize = minSize
+        self.level = level
+        self.maxMessageSize = maxMessageSize
+        self.serverNoContextTakeover = serverNoContextTakeover
+        self.clientNoContextTakeover = clientNoContextTakeover
+        self.serverMaxWindowBits = serverMaxWindowBits
+        self.clientMaxWindowBits = clientMaxWindowBits
+
+    def negotiate(self, offers: Optional[str]) -> Optional[WSDeflateSession]:
+        """
+        Accepts the first acceptable permessage-deflate offer of the client.
+        :param offers: The request's Sec-WebSocket-Extensions header, None if missing
+        :return: The connection's session, None if the client offers no acceptable one
+        """
+        for name, params in parseExtensions(offers):
+            if name == self.EXTENSION:
+                session: Optional[WSDeflateSession] = self._accept(params)
+                if session is not None:
+                    return session
+        return None
+
+    def _accept(self, params: dict[str, Optional[str]]) -> Optional[WSDeflateSession]:
+        response: list[str] = [self.EXTENSION]
+        serverNoContextTakeover: bool = self.serverNoContextTakeover
+        clientNoContextTakeover: bool = self.clientNoContextTakeover
+        serverWindowBits: int = self.serverMaxWindowBits
+        clientWindowBits: Optional[int] = None  # Not told to the client
+        for key, value in params.items():
+            if key == "server_no_context_takeover" and value is None:
+                serverNoContextTakeover = True
+            elif key == "client_no_context_takeover" and value is None:
+                clientNoContextTakeover = True
+            elif key == "server_max_window_bits":
+                bits: Optional[int] = self._windowBits(value)
+                if bits is None or bits < 9:  # zlib can't compress with the 256 B window
+                    return None
+                serverWindowBits = min(serverWindowBits, bits)
+            elif key == "client_max_window_bits":
+                bits: Optional[int] = self._windowBits(value) if value is not None else 15
+                if bits is None:
+                    return None
+                if self.clientMaxWindowBits < bits:
+                    clientWindowBits = self.clientMaxWindowBits
+            else:
+                return None  # An unknown parameter or an invalid value
+        if serverNoContextTakeover:
+            response.append("server_no_context_takeover")
+        if clientNoContextTakeover:
+            response.append("client_no_context_takeover")
+        if serverWindowBits < zlib.MAX_WBITS or "server_max_window_bits" in params:
+            response.append(f"server_max_window_bits={serverWindowBits}")
+        if clientWindowBits is not None:
+            response.append(f"client_max_window_bits={clientWindowBits}")
+        return WSDeflateSession("; ".join(response), self.minSize, self.level,
+                                self.maxMessageSize, serverNoContextTakeover,
+                                clientNoContextTakeover, serverWindowBits)
+
+    @staticmethod
+    def _windowBits(value: Optional[str]) -> Optional[int]:
+        if value is None or not value.isdigit() or len(value) > 2:
+            return None
+        bits: int = int(value)
+        return bits if 8 <= bits <= 15 else None
+
+
+__all__ = ["PerMessageDeflate", "WSDeflateSession", "parseExtensions", "DEFLATE_TAIL"]
@@ -2,6 +2,7 @@
 __author__ = "kubik.augustyn@post.cz"
 
 from enum import Enum, unique
+from typing import Final, Self
 
 from kutil.buffer.ByteBuffer import ByteBuffer, ByteBufferLike
 from kutil.buffer.Serializable import Serializable
@@ -17,9 +18,53 @@ class WSOpcode(Enum):
     PONG = 0xA
 
 
+MASK_CHUNK: Final[int] = 64 * 1024  # Bytes (a multiple of 4) maskInPlace() XORs at once
+
+
+def maskData(data: ByteBufferLike, maskingKey: bytes) -> bytes:
+    """
+    XORs the data with the repeated masking key (masking and unmasking are the same), the whole
+    payload at once as one big integer instead of byte by byte.
+    :param data: The payload
+    :param maskingKey: The 4 bytes of the masking key
+    :return: The (un)masked payload
+    """
+    assert len(maskingKey) == 4
+    length: int = len(data)
+    if length == 0:
+        return b''
+    key: bytes = (maskingKey * ((length + 3) // 4))[:length]
+    return (int.from_bytes(data, "little") ^ int.from_bytes(key, "little")).to_bytes(length,
+                                                                                     "little")
+
+
+def maskInPlace(data: bytearray | memoryview, maskingKey: bytes) -> None:
+    """
+    (Un)masks the writable data in place, MASK_CHUNK bytes at a time, so it needs only a few
+    chunks of memory more, however big the payload is (see maskData()).
+    :param data: The payload, e.g., a bytearray read from the receive buffer
+    :param maskingKey: The 4 bytes of the masking key
+    """
+    assert len(maskingKey) == 4
+    view: memoryview = memoryview(data).cast("B")
+    length: int = len(view)
+    rest: int = length % MASK_CHUNK
+    if length >= MASK_CHUNK:
+        key: int = int.from_bytes(maskingKey * (MASK_CHUNK // 4), "little")
+        for start in range(0, length - rest, MASK_CHUNK):
+            chunk: memoryview = view[start:start + MASK_CHUNK]
+            chunk[:] = (int.from_bytes(chunk, "little") ^ key).to_bytes(MASK_CHUNK, "little")
+    if rest > 0:  # The chunks keep the key aligned
+        view[length - rest:] = maskData(view[length - rest:], maskingKey)
+
+
 class WSData:
+    """
+    A message's payload. A given bytearray (or memoryview) is copied once, so masking the payload
+    never changes the caller's buffer, and raw is always immutable.
+    """
     isBinary: bool
-    __raw: ByteBufferLike
+    __raw: ByteBufferLike  # A bytearray only if it's owned, e.g., a received frame's payload
 
     def __init__(self, data: ByteBufferLike | str | None = None):
         if data is None:
@@ -30,6 +75,17 @@ class WSData:
         else:
             self.text = data
 
+    @classmethod
+    def owning(cls, data: bytearray) -> Self:
+        """
+        Wraps a buffer nobody else references without copying it, mask() changes it in place.
+        :param data: The payload, e.g., a bytearray read from the receive buffer
+        :return: The binary WSData
+        """
+        wsData: Self = cls()
+        wsData.__raw = data
+        return wsData
+
     @property
     def superSecretRawAccess(self) -> ByteBufferLike:
         """Lol. Just don't use this if you don't know what you are doing."""
@@ -37,20 +93,25 @@ class WSData:
 
     @property
     def raw(self) -> bytes:
+        """The payload, not a copy if it's bytes (a received message's is, not an owned frame's)"""
         assert self.isBinary
         if isinstance(self.__raw, ByteBuffer):
             return self.__raw.export()
+        if isinstance(self.__raw, bytes):
+            return self.__raw
         return bytes(self.__raw)
 
     @raw.setter
     def raw(self, newBytes: ByteBufferLike):
         assert self.isBinary
-        self.__raw = newBytes
+        self.__raw = bytes(newBytes) if isinstance(newBytes, (bytearray, memoryview)) else newBytes
 
     @property
     def text(self) -> str:
         assert not self.isBinary
-        return bytes(self.__raw).decode("utf-8")
+        if isinstance(self.__raw, ByteBuffer):
+            return self.__raw.export().decode("utf-8")
+        return str(self.__raw, "utf-8")  # Decodes a bytearray without copying it first
 
     @text.setter
     def text(self, newText: str):
@@ -70,16 +131,16 @@ class WSData:
         return len(self.__raw)
 
     def mask(self, maskingKey: bytes):
-        assert len(maskingKey) == 4
-        masked: bytearray = bytearray(self.__raw)
-        for i, byte in enumerate(self.__raw):
-            masked[i] = byte ^ maskingKey[i % 4]
-        self.__raw = bytes(masked)
+        if isinstance(self.__raw, bytearray):
+            maskInPlace(self.__raw, maskingKey)
+        else:
+            self.__raw = maskData(self.__raw.export() if isinstance(self.__raw, ByteBuffer)
+                                  else self.__raw, maskingKey)
 
 
 class WSMessage(Serializable):
     isFin: bool
-    # rsv: int - not used, we don't use any extension
+    isCompressed: bool  # The RSV1 bit, set on the first frame of a permessage-deflate message
     opcode: WSOpcode
     maskingKey: bytes | None
     payload: WSData
@@ -87,7 +148,7 @@ class WSMessage(Serializable):
     def __init__(self):
         super().__init__()
         self.isFin = True
-        # self.rsv = 0
+        self.isCompressed = False
         self.opcode = WSOpcode.TEXT_FRAME
         self.maskingKey = None
         self.payload = WSData()
@@ -96,6 +157,7 @@ class WSMessage(Serializable):
         # https://en.wikipedia.org/wiki/WebSocket#Base_Framing_Protocol
         byte: int = buff.readByte()
         self.isFin = bool(byte & 0b10000000)
+        self.isCompressed = bool(byte & 0b01000000)
         self.opcode = WSOpcode(byte & 0x0F)
         byte: int = buff.readByte()
         isMasked = bool(byte & 0b10000000)
@@ -109,7 +171,7 @@ class WSMessage(Serializable):
             # raise ValueError("Unknown endianness - big or little?")
             payloadLength = int.from_bytes(buff.read(8), "big", signed=False)
         self.maskingKey = buff.read(4) if isMasked else None
-        self.payload = WSData(bytes(buff.read(payloadLength)))
+        self.payload = WSData.owning(buff.read(payloadLength))  # Already a copy, unmasked in place
         self.payload.isBinary = self.opcode != WSOpcode.TEXT_FRAME
         if isMasked:
             self.payload.mask(self.maskingKey)
@@ -118,6 +180,8 @@ class WSMessage(Serializable):
         byte: int = 0
         if self.isFin:
             byte |= 0b10000000
+        if self.isCompressed:
+            byte |= 0b01000000
         byte |= self.opcode.value
         buff.writeByte(byte)
         byte: int = 0
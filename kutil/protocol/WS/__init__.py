@@ -1,4 +1,5 @@
 #  -*- coding: utf-8 -*-
 __author__ = "kubik.augustyn@post.cz"
 
-from kutil.protocol.WS.WSMessage import WSMessage, WSOpcode, WSData
+from kutil.protocol.WS.WSMessage import WSMessage, WSOpcode, WSData, maskData, maskInPlace
+from kutil.protocol.WS.WSDeflate import PerMessageDeflate, WSDeflateSession
@@ -13,11 +13,16 @@ from kutil.protocol.AbstractProtocol import AbstractProtocol, NeedMoreDataError
 from kutil.buffer.ByteBuffer import ByteBuffer, OutOfBoundsReadError
 from kutil.buffer.MemoryByteBuffer import MemoryByteBuffer
 from kutil.protocol.ProtocolConnection import ProtocolConnection, ConnectionClosed
-from kutil.protocol.WS import WSMessage, WSOpcode, WSData
+from kutil.protocol.WS import WSMessage, WSOpcode, WSData, WSDeflateSession
 
 
 class WSProtocol(AbstractProtocol):
     name = "WSProtocol"
+    deflate: Optional[WSDeflateSession]  # Compresses the sent messages, None if not negotiated
+
+    def __init__(self, connection, deflate: Optional[WSDeflateSession] = None):
+        super().__init__(connection)
+        self.deflate = deflate
 
     def unpackData(self, buff: ByteBuffer) -> WSMessage:
         # print("WS message:", buff.data)
@@ -38,6 +43,11 @@ class WSProtocol(AbstractProtocol):
             msg.opcode = WSOpcode.BINARY_FRAME if data.isBinary else WSOpcode.TEXT_FRAME
             msg.isFin = True
             msg.payload = data
+            if self.deflate is not None and self.deflate.shouldCompress(data):
+                # A text's payload is always bytes, a binary one may be a ByteBuffer
+                msg.payload = WSData(self.deflate.compress(data.raw if data.isBinary
+                                                           else data.superSecretRawAccess))
+                msg.isCompressed = True
             msg.write(buff)
             return
         data.write(buff)
@@ -56,18 +66,39 @@ class WSProtocol(AbstractProtocol):
 
 class WSConnection(ProtocolConnection):
     dataBuffer: ByteBuffer
+    deflate: Optional[WSDeflateSession]  # Decompresses the received messages, or None
+    _opcode: WSOpcode  # The opcode of the message being received (its first frame's)
+    _compressed: bool  # Whether the message being received is compressed
 
     def init(self):
         self.dataBuffer = MemoryByteBuffer()
+        self.deflate = None
+        self._opcode = WSOpcode.TEXT_FRAME
+        self._compressed = False
 
     def onDataInner(self, data: WSMessage, stoppedUnpacking: bool = False,
                     layer: Optional[AbstractProtocol] = None) -> bool | WSData:
-        if data.opcode in (WSOpcode.BINARY_FRAME, WSOpcode.TEXT_FRAME):
+        if data.opcode in (WSOpcode.BINARY_FRAME, WSOpcode.TEXT_FRAME,
+                           WSOpcode.CONTINUATION_FRAME):
+            if data.opcode is not WSOpcode.CONTINUATION_FRAME:
+                self._opcode = data.opcode
+                self._compressed = data.isCompressed
+            if data.isCompressed and (self.deflate is None or
+                                      data.opcode is WSOpcode.CONTINUATION_FRAME):
+                self.close(ValueError("Unexpected RSV1 bit, permessage-deflate wasn't negotiated"))
+                return False
             self.dataBuffer.write(data.payload.superSecretRawAccess)
             if data.isFin:
-                message: WSData = WSData(self.dataBuffer.export())
-                message.isBinary = data.opcode == WSOpcode.BINARY_FRAME
+                payload: bytes = self.dataBuffer.export()
                 self.dataBuffer.reset() # Clear it, so it can accept a new message (issue #8)
+                if self._compressed:
+                    try:
+                        payload = self.deflate.decompress(payload)
+                    except ValueError as e:
+                        self.close(e)
+                        return False
+                message: WSData = WSData(payload)
+                message.isBinary = self._opcode == WSOpcode.BINARY_FRAME
                 return message
             return False
         if data.opcode == WSOpcode.CONNECTION_CLOSE:
@@ -2,11 +2,19 @@
 __author__ = "kubik.augustyn@post.cz"
 
 from kutil.protocol.AbstractProtocol import AbstractProtocol
-from kutil.protocol.ProtocolConnection import ProtocolConnection
+from kutil.protocol.ProtocolConnection import (ProtocolConnection, SlowConsumerPolicy,
+                                               SlowConsumerError)
 from kutil.protocol.ProtocolServer import ProtocolServer
+from kutil.protocol.EventLoop import EventLoop
+from kutil.protocol.DNSCache import DNSCache, dnsCache
+from kutil.protocol.HandlerDispatcher import (HandlerDispatcher, RejectionPolicy,
+                                              HandlerQueueFullError)
 from kutil.protocol.TCPConnection import TCPConnection
 from kutil.protocol.HTTPConnection import HTTPConnection
+from kutil.protocol.HTTPClient import HTTPClient
 from kutil.protocol.HTTPSConnection import HTTPSConnection
 from kutil.protocol.HTTPServer import HTTPServer, HTTPServerConnection
+from kutil.protocol.AsyncProtocolServer import AsyncProtocolServer, AsyncProtocolConnection
+from kutil.protocol.AsyncHTTPServer import AsyncHTTPServer, AsyncHTTPServerConnection
 # from kutil.protocol.HTTPSServer import HTTPServer, HTTPServerConnection
 from kutil.protocol.WSConnection import WSConnection
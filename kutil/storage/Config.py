@@ -164,14 +164,14 @@ class Config:
         root = entry
         while not root.isRoot():
             root = root.getParent()
-        writeFile(self._getConfigPath(root.getPath()), root.getJson())
+        writeFile(self._getConfigPath(root.getPath()), root.getJson(), atomic=True)
 
     def delete(self, key: str, entry: ConfigEntry):
         del entry.getRaw()[key]
         root = entry
         while not root.isRoot():
             root = root.getParent()
-        writeFile(self._getConfigPath(root.getPath()), root.getJson())
+        writeFile(self._getConfigPath(root.getPath()), root.getJson(), atomic=True)
 
     def __getattr__(self, key):
         return self.read(key)
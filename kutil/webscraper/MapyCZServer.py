@@ -7,7 +7,6 @@ from typing import Optional, Final
 import requests  # Sadly, Mapy.cz only supports HTTPS, which KUtil doesn't
 
 from kutil import ProtocolConnection, getFileExtension
-from kutil.protocol.HTTP.HTTPMethod import HTTPMethod
 from requests.cookies import RequestsCookieJar
 import os
 from enum import Enum, unique
@@ -17,6 +16,9 @@ from kutil.threads.ThreadWaiter import ThreadWaiter
 from kutil.protocol.HTTP.HTTPHeaders import HTTPHeaders
 from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
 from kutil.protocol.HTTP.HTTPRequest import HTTPRequest
+from kutil.protocol.HTTP.HTTPMethod import HTTPMethod
+from kutil.protocol.HTTP.Router import Router, RouteHandler, Middleware
+from kutil.protocol.HTTP.ResponseCache import ResponseCache
 from kutil.protocol.HTTPServer import HTTPServerConnection
 from kutil.protocol.URLSearchParams import URLSearchParams
 from kutil.io.file import readFile, writeFile
@@ -46,6 +48,7 @@ class MapyCZServer(WebScraperServer):
     usageHTMLTemplate: Optional[bytes] = None
     usageQGIS: Optional[bytes] = None
     cacheControl: Final[str] = "max-age=3600, public"
+    proxyCacheControl: Final[str] = "max-age=300, public"  # The routing and geocoding results
     languages: Final[set[str]] = {"cs", "de", "el", "en", "es", "fr", "it", "nl", "pl", "pt",
                                   "ru", "sk", "tr", "uk"}
 
@@ -67,6 +70,8 @@ class MapyCZServer(WebScraperServer):
     __sessions: list[requests.Session]
     __sessionPointer: int
     __sessionCount: int
+    router: Router  # Maps the endpoints to their handlers
+    responseCache: ResponseCache  # The tiles.json, routing and geocoding responses
 
     def __init__(self, port: int = 666, host: str = "localhost",
                  scrapeAroundAutomatically: bool = False,
@@ -85,6 +90,8 @@ class MapyCZServer(WebScraperServer):
         self.__sessions = []
         self.__sessionPointer = 0
         self.__sessionCount = sessionCount
+        self.responseCache = ResponseCache(16 * 1024 * 1024)
+        self.router = self.__createRouter()
         if scrapeAroundAutomatically:
             print("Warning: Scrape around rises your CPU usage too much. I recommend not using it")
             for i in range(scrapeAroundWorkerCount):
@@ -131,12 +138,29 @@ class MapyCZServer(WebScraperServer):
         self.__connectionCloseWaiter.reset()
 
     def onDataInner(self, conn: HTTPServerConnection, req: HTTPRequest) -> HTTPResponse:
-        # print("URL:", req.requestURI)
-        query = req.requestURI[req.requestURI.index("?"):] if "?" in req.requestURI else ""
-        params: URLSearchParams = URLSearchParams(query)
-        uriWithoutQuery = req.requestURI.split("?", maxsplit=1)[0]
         if req.method != HTTPMethod.GET:
-            return WebScraperServer.badMethod()
+            return WebScraperServer.badMethod()  # Also of the unknown paths, not the router's 405
+        return self.router.dispatch(conn, req)
+
+    def __createRouter(self) -> Router:
+        router: Router = Router()
+        throttled: list[Middleware] = [self.__throttle]
+        # The tiles are kept on the disk, don't let them push the JSON out (a hit isn't throttled)
+        cached: list[Middleware] = [self.responseCache, self.__throttle]
+        router.get("/tile/:mapSet", self.__tile, throttled)
+        router.get("/tiles.json", self.__tilesJson, cached)
+        router.get("/api_key.txt", self.__apiKeyText, throttled)
+        router.get("/api_key.json", self.__apiKeyJSON, throttled)
+        router.get("/routing/route", self.__routing, cached)
+        router.get("/geocoding/:kind", self.__geocoding, cached)
+        router.get("/qgis.png", lambda conn, req: self.__getQgis(), throttled)
+        # If a bad endpoint is requested, show the usage page (throttled like the routes)
+        router.notFound = lambda conn, req: self.__throttle(conn, req,
+                                                            lambda c, r: self.__getUsage())
+        return router
+
+    def __throttle(self, conn: HTTPServerConnection, req: HTTPRequest,
+                   nextHandler: RouteHandler) -> HTTPResponse:
         # print(f"Handling the connection with {len(self.server.connections)} connections together")
         retryCount = 0
         while len(self.__workingConnections) > self.__maxConnections:
@@ -156,117 +180,121 @@ class MapyCZServer(WebScraperServer):
                                         f'Currently actively handling {len(self.__workingConnections)} '
                                         f'out of {len(self.server.connections)} requests.')
                 return HTTPResponse(429, "Too many requests", headers, body)
+        return nextHandler(conn, req)
 
-        if req.requestURI.startswith("/tile/"):
-            mapSetStr = uriWithoutQuery[6:]
-            mapSet = self.__parseMapSet(mapSetStr, req.requestURI)
-            if isinstance(mapSet, HTTPResponse):
-                return mapSet
-            try:
-                x = int(params["x"])
-                y = int(params["y"])
-                zoom = int(params["z"])
-                tileSize = params.get("tileSize", "256")
-                lang = params.get("lang", "cs")
-                # https://api.mapy.cz/v1/docs/maptiles/#/tiles/get_v1_maptiles__mapset___tileSize___z___x___y_
-                assert tileSize in ("256", "256@2x"), "Invalid tile size"
-                if tileSize == "256@2x":
-                    assert mapSet in (MapSet.ZAKLADNI, MapSet.TURISTICKA, MapSet.ZIMNI), \
-                        "Invalid tile size - used 256@2x in other mapSet than ZAKLADNI, TURISTICKA, ZIMNI"
-                assert lang in MapyCZServer.languages, "Invalid language"
-            except (ValueError, KeyError, AssertionError) as e:
-                resp = WebScraperServer.badRequest()
-                resp.body = (b'<h1>Bad request - bad params</h1>'
-                             b'Required params: x, y, z (zoom), tileSize ("256" or "256@2x", '
-                             b'by default "256"), lang ' +
-                             HTTPResponse.enc(f"(language (default: cs) - one "
-                                              f"of: {', '.join(MapyCZServer.languages)})"
-                                              f"<br>Caused by error: {str(e)}"))
-                print(f"Bad request: bad params while requesting {req.requestURI}")
-                return resp
-            # Scrape for the image
-            try:
-                self.pushWorkingConnection(conn)
-                image: bytes = self.__scrape(x, y, zoom, tileSize, mapSet, lang)
-            except Exception as e:
-                print("Unexpected error:", e)
-                return WebScraperServer.internalError()
-            finally:
-                self.popWorkingConnection(conn)
-            # Form a response
-            headers: HTTPHeaders = HTTPHeaders()
-            headers["Content-Type"] = f"image/{imageTypes[mapSet]}"
-            headers["Cache-Control"] = MapyCZServer.cacheControl
-            resp: HTTPResponse = HTTPResponse(200, "OK", headers, image)
-            return resp
-        elif uriWithoutQuery == "/tiles.json":
-            try:
-                mapSetStr = params["mapSet"]
-                lang = params.get("lang", "cs")
-                assert lang in MapyCZServer.languages, "Invalid language"
-            except KeyError as e:
-                resp = WebScraperServer.badRequest()
-                resp.body = HTTPResponse.enc(
-                    f'<h1>Bad request - bad params</h1>'
-                    f'Required params: mapSet, lang (language (default: cs) - one of: '
-                    f'{", ".join(MapyCZServer.languages)})<br>Caused by error: {str(e)}'
-                )
-                print(f"Bad request: bad params while requesting {req.requestURI}")
-                return resp
-            mapSet = self.__parseMapSet(mapSetStr, req.requestURI)
-            if isinstance(mapSet, HTTPResponse):
-                return mapSet
-            # Scrape for the tiles.json file
-            try:
-                self.pushWorkingConnection(conn)
-                tilesJson: bytes = self.__scrapeTilesJson(mapSet, lang)
-            except Exception as e:
-                print("Unexpected error:", e)
-                return WebScraperServer.internalError()
-            finally:
-                self.popWorkingConnection(conn)
-            # Form a response
-            headers: HTTPHeaders = HTTPHeaders()
-            headers["Content-Type"] = "application/json"
-            headers["Cache-Control"] = MapyCZServer.cacheControl
-            resp: HTTPResponse = HTTPResponse(200, "OK", headers, tilesJson)
+    def __tile(self, conn: HTTPServerConnection, req: HTTPRequest) -> HTTPResponse:
+        params: URLSearchParams = req.query
+        mapSet = self.__parseMapSet(req.routeParams["mapSet"], req.requestURI)
+        if isinstance(mapSet, HTTPResponse):
+            return mapSet
+        try:
+            x = int(params["x"])
+            y = int(params["y"])
+            zoom = int(params["z"])
+            tileSize = params.get("tileSize", "256")
+            lang = params.get("lang", "cs")
+            # https://api.mapy.cz/v1/docs/maptiles/#/tiles/get_v1_maptiles__mapset___tileSize___z___x___y_
+            assert tileSize in ("256", "256@2x"), "Invalid tile size"
+            if tileSize == "256@2x":
+                assert mapSet in (MapSet.ZAKLADNI, MapSet.TURISTICKA, MapSet.ZIMNI), \
+                    "Invalid tile size - used 256@2x in other mapSet than ZAKLADNI, TURISTICKA, ZIMNI"
+            assert lang in MapyCZServer.languages, "Invalid language"
+        except (ValueError, KeyError, AssertionError) as e:
+            resp = WebScraperServer.badRequest()
+            resp.body = (b'<h1>Bad request - bad params</h1>'
+                         b'Required params: x, y, z (zoom), tileSize ("256" or "256@2x", '
+                         b'by default "256"), lang ' +
+                         HTTPResponse.enc(f"(language (default: cs) - one "
+                                          f"of: {', '.join(MapyCZServer.languages)})"
+                                          f"<br>Caused by error: {str(e)}"))
+            print(f"Bad request: bad params while requesting {req.requestURI}")
             return resp
-        elif req.requestURI == "/api_key.txt":
+        # Scrape for the image
+        try:
             self.pushWorkingConnection(conn)
-            headers: HTTPHeaders = HTTPHeaders()
-            headers["Content-Type"] = "text/plain"
-            resp: HTTPResponse = HTTPResponse(200, "OK", headers,
-                                              HTTPResponse.enc(self.__obtainAPIKey()))
+            image: bytes = self.__scrape(x, y, zoom, tileSize, mapSet, lang)
+        except Exception as e:
+            print("Unexpected error:", e)
+            return WebScraperServer.internalError()
+        finally:
             self.popWorkingConnection(conn)
+        # Form a response
+        headers: HTTPHeaders = HTTPHeaders()
+        headers["Content-Type"] = f"image/{imageTypes[mapSet]}"
+        headers["Cache-Control"] = MapyCZServer.cacheControl
+        resp: HTTPResponse = HTTPResponse(200, "OK", headers, image)
+        return resp
+
+    def __tilesJson(self, conn: HTTPServerConnection, req: HTTPRequest) -> HTTPResponse:
+        params: URLSearchParams = req.query
+        try:
+            mapSetStr = params["mapSet"]
+            lang = params.get("lang", "cs")
+            assert lang in MapyCZServer.languages, "Invalid language"
+        except KeyError as e:
+            resp = WebScraperServer.badRequest()
+            resp.body = HTTPResponse.enc(
+                f'<h1>Bad request - bad params</h1>'
+                f'Required params: mapSet, lang (language (default: cs) - one of: '
+                f'{", ".join(MapyCZServer.languages)})<br>Caused by error: {str(e)}'
+            )
+            print(f"Bad request: bad params while requesting {req.requestURI}")
             return resp
-        elif req.requestURI == "/api_key.json":
+        mapSet = self.__parseMapSet(mapSetStr, req.requestURI)
+        if isinstance(mapSet, HTTPResponse):
+            return mapSet
+        # Scrape for the tiles.json file
+        try:
             self.pushWorkingConnection(conn)
-            headers: HTTPHeaders = HTTPHeaders()
-            headers["Content-Type"] = "application/json"
-            try:
-                body = {"key": self.__obtainAPIKey(), "error": False}
-            except Exception as e:
-                body = {"key": None, "error": True, "error_str": str(e)}
-            resp: HTTPResponse = HTTPResponse(200, "OK", headers,
-                                              HTTPResponse.enc(json.dumps(body)))
+            tilesJson: bytes = self.__scrapeTilesJson(mapSet, lang)
+        except Exception as e:
+            print("Unexpected error:", e)
+            return WebScraperServer.internalError()
+        finally:
             self.popWorkingConnection(conn)
-            return resp
-        elif uriWithoutQuery == "/routing/route":
-            # https://api.mapy.cz/v1/docs/routing/
-            assert len(params.params) > 0, "Query params are required"
-            uri = f"https://api.mapy.cz/v1/routing/route?{params}&apikey=API"
-        elif req.requestURI.startswith("/geocoding/"):
-            # https://api.mapy.cz/v1/docs/geocode/
-            assert len(params.params) > 0, "Query params are required"
-            kind = uriWithoutQuery[11:]
-            assert kind in ("rgeocode", "geocode", "suggest"), "Invalid kind"
-            uri = f"https://api.mapy.cz/v1/{kind}?{params}&apikey=API"
-        elif req.requestURI == "/qgis.png":
-            return self.__getQgis()
-        else:
-            # If a bad endpoint is requested, show the usage page
-            return self.__getUsage()
-        return self.__performRequest(uri, conn)
+        # Form a response
+        headers: HTTPHeaders = HTTPHeaders()
+        headers["Content-Type"] = "application/json"
+        headers["Cache-Control"] = MapyCZServer.cacheControl
+        resp: HTTPResponse = HTTPResponse(200, "OK", headers, tilesJson)
+        return resp
+
+    def __apiKeyText(self, conn: HTTPServerConnection, req: HTTPRequest) -> HTTPResponse:
+        self.pushWorkingConnection(conn)
+        headers: HTTPHeaders = HTTPHeaders()
+        headers["Content-Type"] = "text/plain"
+        resp: HTTPResponse = HTTPResponse(200, "OK", headers,
+                                          HTTPResponse.enc(self.__obtainAPIKey()))
+        self.popWorkingConnection(conn)
+        return resp
+
+    def __apiKeyJSON(self, conn: HTTPServerConnection, req: HTTPRequest) -> HTTPResponse:
+        self.pushWorkingConnection(conn)
+        headers: HTTPHeaders = HTTPHeaders()
+        headers["Content-Type"] = "application/json"
+        try:
+            body = {"key": self.__obtainAPIKey(), "error": False}
+        except Exception as e:
+            body = {"key": None, "error": True, "error_str": str(e)}
+        resp: HTTPResponse = HTTPResponse(200, "OK", headers,
+                                          HTTPResponse.enc(json.dumps(body)))
+        self.popWorkingConnection(conn)
+        return resp
+
+    def __routing(self, conn: HTTPServerConnection, req: HTTPRequest) -> HTTPResponse:
+        # https://api.mapy.cz/v1/docs/routing/
+        params: URLSearchParams = req.query
+        assert len(params.params) > 0, "Query params are required"
+        return self.__performRequest(f"https://api.mapy.cz/v1/routing/route?{params}&apikey=API",
+                                     conn)
+
+    def __geocoding(self, conn: HTTPServerConnection, req: HTTPRequest) -> HTTPResponse:
+        # https://api.mapy.cz/v1/docs/geocode/
+        params: URLSearchParams = req.query
+        assert len(params.params) > 0, "Query params are required"
+        kind = req.routeParams["kind"]
+        assert kind in ("rgeocode", "geocode", "suggest"), "Invalid kind"
+        return self.__performRequest(f"https://api.mapy.cz/v1/{kind}?{params}&apikey=API", conn)
 
     def __parseMapSet(self, mapSetName: str, requestURI: str) -> MapSet | HTTPResponse:
         try:
@@ -307,6 +335,8 @@ class MapyCZServer(WebScraperServer):
             if name not in ("content-type", "content-encoding"):
                 continue
             headers[name] = value
+        if r.status_code == 200:
+            headers["Cache-Control"] = MapyCZServer.proxyCacheControl
         resp = HTTPResponse(r.status_code, r.reason, headers, r.content)
         return resp
 
@@ -452,7 +482,7 @@ class MapyCZServer(WebScraperServer):
         if self.__cachePath is None:
             return
         self.__cacheSizeLimiterWaiter.reset()
-        writeFile(self.__getCacheFilePath(x, y, zoom, tileSize, mapSet, lang), data)
+        writeFile(self.__getCacheFilePath(x, y, zoom, tileSize, mapSet, lang), data, atomic=True)
 
     def __obtainFromCache(self, x: int, y: int, zoom: int, tileSize: str, mapSet: MapSet,
                           lang: str) -> Optional[bytes]:
@@ -2,13 +2,16 @@
 __author__ = "kubik.augustyn@post.cz"
 
 from abc import abstractmethod, ABC
+from typing import Optional
 
 from kutil.protocol.HTTP.HTTPHeaders import HTTPHeaders
 from kutil.protocol.HTTP.HTTPResponse import HTTPResponse
 from kutil.protocol.HTTP.HTTPRequest import HTTPRequest
 from kutil.protocol.ProtocolConnection import ProtocolConnection
+from kutil.protocol.EventLoop import EventLoop
 
 from kutil.protocol.HTTPServer import HTTPServer, HTTPServerConnection
+from kutil.protocol.AsyncHTTPServer import AsyncHTTPServer
 
 
 class WebScraperServer(ABC):
@@ -21,9 +24,24 @@ class WebScraperServer(ABC):
         self.port = port
         self.host = host
 
-    def listen(self):
+    def listen(self, eventLoop: Optional[EventLoop] = None):
+        """
+        Starts the server, blocking until it's closed.
+        :param eventLoop: The event loop to serve the connections on, None for a thread
+         per connection (see ProtocolServer.listen())
+        """
         self.server = HTTPServer((self.host, self.port), self.onConnection)
-        self.server.listen()
+        self.server.lazyHeaders = True  # Only a few headers are looked at
+        self.server.listen(eventLoop=eventLoop)
+
+    async def listenAsync(self):
+        """
+        Runs the server on the running asyncio event loop until it's closed. The synchronous
+        onDataInner() runs in the loop's executor, so it may still block (e.g., on a download).
+        """
+        self.server = AsyncHTTPServer((self.host, self.port), self.onConnection)
+        self.server.lazyHeaders = True
+        await self.server.serve()
 
     def onConnection(self, conn: ProtocolConnection):
         # print(conn)
@@ -43,10 +61,9 @@ class WebScraperServer(ABC):
             resp = HTTPResponse(500, "Internal server error", HTTPHeaders(),
                                 HTTPResponse.enc(content))
             resp.headers["Content-Type"] = "text/plain"
-        # Don't close the socket if the client wants to request more data
-        close = req.headers.get("Connection", "close") != "keep-alive"
         resp.headers["Access-Control-Allow-Origin"] = "*"
-        WebScraperServer.sendResponse(resp, conn, close)
+        # The connection decides itself whether to stay open (see HTTPServer.keepAliveTimeout)
+        WebScraperServer.sendResponse(resp, conn, False)
 
     @abstractmethod
     def onDataInner(self, conn: HTTPServerConnection, req: HTTPRequest) -> HTTPResponse:
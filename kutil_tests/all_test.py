@@ -15,6 +15,17 @@ if __name__ == "__main__":
     from kutil_tests.test_js import TestJavascript  # Test JS
     from kutil_tests.test_memorybytebuffer import TestMemoryByteBuffer  # Test TestMemoryByteBuffer
     from kutil_tests.test_filebytebuffer import TestFileByteBuffer  # Test TestFileByteBuffer
+    from kutil_tests.test_file import TestFile  # Test file helpers
+    from kutil_tests.test_directory import TestDirectory  # Test directory helpers
+    from kutil_tests.test_event_loop import TestEventLoop  # Test the event loop server
+    from kutil_tests.test_async_server import TestAsyncServer  # Test the asyncio server
+    from kutil_tests.test_dispatcher import TestDispatcher  # Test the handler dispatcher
+    from kutil_tests.test_http import TestHTTP  # Test the HTTP parsing
+    from kutil_tests.test_send import TestSend  # Test the vectored sending
+    from kutil_tests.test_static_files import TestStaticFiles  # Test the static file serving
+    from kutil_tests.test_http_client import TestHTTPClient  # Test the pooled HTTP client
+    from kutil_tests.test_dns_cache import TestDNSCache  # Test the DNS resolution cache
+    from kutil_tests.test_ws import TestWS  # Test the WebSocket frames
 
     main()
 
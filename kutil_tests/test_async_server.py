@@ -0,0 +1,72 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+import asyncio
+import time
+from unittest import IsolatedAsyncioTestCase
+
+from kutil import AsyncHTTPServer, AsyncHTTPServerConnection
+from kutil.protocol.HTTP import HTTPRequest, HTTPResponse, HTTPHeaders
+
+
+class TestAsyncServer(IsolatedAsyncioTestCase):
+    server: AsyncHTTPServer
+    serverTask: asyncio.Task
+    address: tuple[str, int]
+    syncHandler: bool
+
+    async def asyncSetUp(self):
+        self.syncHandler = False
+        self.server = AsyncHTTPServer(("127.0.0.1", 0), self.onConnection)
+        self.address = self.server.sock.getsockname()
+        self.serverTask = asyncio.create_task(self.server.serve())
+        await asyncio.sleep(0)
+
+    async def asyncTearDown(self):
+        for conn in list(self.server.connections):
+            conn.close()
+        self.server.close()
+        await self.serverTask
+
+    def onConnection(self, conn: AsyncHTTPServerConnection):
+        return self.onSyncData if self.syncHandler else self.onAsyncData
+
+    @staticmethod
+    async def onAsyncData(conn: AsyncHTTPServerConnection, req: HTTPRequest):
+        # The first request takes the longest, yet it's answered first
+        await asyncio.sleep(.1 if req.requestURI == "/slow" else 0)
+        await conn.sendDataAsync(HTTPResponse(200, "OK", HTTPHeaders(),
+                                              req.requestURI.encode("utf-8")))
+
+    @staticmethod
+    def onSyncData(conn: AsyncHTTPServerConnection, req: HTTPRequest):
+        time.sleep(.05)  # Runs in the executor, so this doesn't block the loop
+        conn.sendData(HTTPResponse(200, "OK", HTTPHeaders(), b'x' * 1024 * 1024))
+        conn.close()
+
+    async def request(self, *paths: str) -> bytes:
+        reader, writer = await asyncio.open_connection(*self.address)
+        writer.write(b''.join(f"GET {path} HTTP/1.1\r\nHost: x\r\n\r\n".encode("utf-8")
+                              for path in paths))
+        data: bytes = b''
+        while not data.endswith(paths[-1].encode("utf-8")):
+            chunk: bytes = await asyncio.wait_for(reader.read(65536), 5)
+            self.assertTrue(chunk, "The server closed the connection")
+            data += chunk
+        writer.close()
+        return data
+
+    async def test_async_handlers(self):
+        responses = await asyncio.gather(*(self.request("/slow", "/fast") for _ in range(10)))
+        for response in responses:
+            self.assertEqual(response.count(b'HTTP/1.1 200 OK'), 2)
+            self.assertLess(response.index(b'/slow'), response.index(b'/fast'))
+
+    async def test_sync_handler(self):
+        self.syncHandler = True
+        reader, writer = await asyncio.open_connection(*self.address)
+        writer.write(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+        data: bytes = await asyncio.wait_for(reader.read(), 5)  # Until the server closes
+        self.assertTrue(data.startswith(b'HTTP/1.1 200 OK'))
+        self.assertTrue(data.endswith(b'x' * 1024 * 1024))
+        writer.close()
@@ -0,0 +1,54 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from kutil.io.directory import walkFiles
+from kutil.io.file import writeFile
+
+
+class TestDirectory(TestCase):
+    tmpDir: tempfile.TemporaryDirectory
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        root: str = self.tmpDir.name
+        for i in range(3):
+            subdir: str = os.path.join(root, f"dir{i}", "nested")
+            os.makedirs(subdir)
+            writeFile(os.path.join(root, f"dir{i}", f"small{i}.png"), b'x')
+            writeFile(os.path.join(subdir, f"big{i}.png"), b'x' * 1000)
+            writeFile(os.path.join(subdir, f"text{i}.txt"), b'x' * 10)
+        old: float = time.time() - 3600
+        os.utime(os.path.join(root, "dir0", "small0.png"), (old, old))
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def names(self, **kwargs) -> list[str]:
+        return sorted(name for name, _ in walkFiles(self.tmpDir.name, workers=2, **kwargs))
+
+    def test_walk(self):
+        self.assertEqual(len(self.names()), 9)
+        self.assertEqual(self.names(pattern="*.txt"), ["text0.txt", "text1.txt", "text2.txt"])
+        self.assertEqual(self.names(pattern="*.png", minSize=100), ["big0.png", "big1.png",
+                                                                   "big2.png"])
+        self.assertEqual(self.names(maxSize=1), ["small0.png", "small1.png", "small2.png"])
+        self.assertEqual(self.names(maxSize=1, newerThan=time.time() - 60),
+                         ["small1.png", "small2.png"])
+
+        for name, path, dirEntry in walkFiles(self.tmpDir.name, extendedInfo=True):
+            self.assertEqual(dirEntry.name, name)
+            self.assertTrue(os.path.isfile(path))
+
+    def test_walk_errors(self):
+        with self.assertRaises(FileNotFoundError):
+            list(walkFiles(os.path.join(self.tmpDir.name, "missing")))
+
+        # Stopping early must not hang
+        iterator = walkFiles(self.tmpDir.name, workers=1)
+        next(iterator)
+        iterator.close()
@@ -0,0 +1,162 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+import socket
+import time
+from threading import Event, Timer
+from typing import Any
+from unittest import TestCase
+
+from kutil import (HTTPServer, HTTPServerConnection, EventLoop, HandlerDispatcher, RejectionPolicy,
+                   HandlerQueueFullError)
+from kutil.protocol.HTTP import HTTPRequest, HTTPResponse, HTTPHeaders
+
+
+class FakeConnection:
+    closed: bool
+    closeCause: Any
+    handled: list[Any]
+    rejected: list[Any]
+    release: Event
+    eventLoop: Any
+    readPauses: set[str]
+
+    def __init__(self):
+        self.closed = False
+        self.closeCause = None
+        self.handled = []
+        self.rejected = []
+        self.release = Event()
+        self.release.set()
+        self.eventLoop = None
+        self.readPauses = set()
+
+    def onData(self, conn, data: Any):
+        self.release.wait(5)
+        time.sleep(.001)
+        self.handled.append(data)
+
+    def rejectData(self, data: Any):
+        self.rejected.append(data)
+
+    def close(self, cause=None):
+        self.closed = True
+        self.closeCause = cause
+
+    def pauseReading(self, reason: str):
+        self.readPauses.add(reason)
+
+    def resumeReading(self, reason: str):
+        self.readPauses.discard(reason)
+
+
+class TestDispatcher(TestCase):
+    def waitIdle(self, dispatcher: HandlerDispatcher):
+        deadline: float = time.time() + 5
+        while dispatcher.pending > 0 and time.time() < deadline:
+            time.sleep(.01)
+        self.assertEqual(dispatcher.pending, 0)
+
+    def test_ordering(self):
+        dispatcher: HandlerDispatcher = HandlerDispatcher(workers=4, maxPending=1000)
+        connections: list[FakeConnection] = [FakeConnection() for _ in range(5)]
+        for i in range(50):
+            for conn in connections:
+                self.assertTrue(dispatcher.dispatch(conn, i))
+        self.waitIdle(dispatcher)
+        for conn in connections:
+            self.assertEqual(conn.handled, list(range(50)))
+        self.assertEqual(dispatcher.completed, 250)
+        self.assertEqual(dispatcher.queuedConnections, 0)
+        self.assertGreater(dispatcher.maxWait, 0)
+        dispatcher.shutdown()
+
+    def test_policies(self):
+        for policy in RejectionPolicy:
+            dispatcher: HandlerDispatcher = HandlerDispatcher(workers=1, maxPending=2,
+                                                              policy=policy)
+            busy, other = FakeConnection(), FakeConnection()
+            busy.release.clear()
+            dispatcher.dispatch(busy, 1)
+            dispatcher.dispatch(busy, 2)
+            if policy is RejectionPolicy.BLOCK:
+                Timer(.1, busy.release.set).start()
+                self.assertTrue(dispatcher.dispatch(other, 1))  # Waits for a free slot
+            else:
+                self.assertFalse(dispatcher.dispatch(other, 1))
+                self.assertFalse(dispatcher.dispatch(busy, 3))  # Rejected after its turn
+                self.assertEqual(dispatcher.rejected, 2)
+                busy.release.set()
+            self.waitIdle(dispatcher)
+            if policy is RejectionPolicy.REJECT:
+                self.assertEqual((busy.handled, busy.rejected, other.rejected), ([1, 2], [3], [1]))
+            elif policy is RejectionPolicy.DROP:
+                self.assertEqual((busy.handled, busy.rejected, other.rejected), ([1, 2], [], []))
+            else:
+                self.assertEqual((busy.handled, other.handled), ([1, 2], [1]))
+            dispatcher.shutdown()
+
+    def test_block_on_io_thread(self):
+        dispatcher: HandlerDispatcher = HandlerDispatcher(workers=1, maxPending=1,
+                                                          policy=RejectionPolicy.BLOCK)
+        busy, other = FakeConnection(), FakeConnection()
+        other.eventLoop = loop = EventLoop()
+        busy.release.clear()
+        dispatcher.dispatch(busy, 1)
+        dispatched: Event = Event()
+        loop.start()
+        try:
+            loop.callSoon(lambda: dispatcher.dispatch(other, 1) and dispatched.set())
+            self.assertTrue(dispatched.wait(1))  # Didn't wait for a free slot
+            self.assertEqual(other.readPauses, {HandlerDispatcher.PAUSE_REASON})
+        finally:
+            loop.close()
+        busy.release.set()
+        self.waitIdle(dispatcher)
+        self.assertEqual((busy.handled, other.handled), ([1], [1]))
+        self.assertEqual(other.readPauses, set())  # Reads again
+        dispatcher.shutdown()
+
+    def test_queue_limit(self):
+        dispatcher: HandlerDispatcher = HandlerDispatcher(workers=1, maxPending=1, maxQueued=3)
+        conn: FakeConnection = FakeConnection()
+        conn.release.clear()
+        accepted: int = 0
+        while not conn.closed and accepted < 10:
+            accepted += dispatcher.dispatch(conn, accepted)
+        self.assertIsInstance(conn.closeCause, HandlerQueueFullError)
+        self.assertEqual(accepted, 1)  # The others were rejected until the queue was full
+        conn.release.set()
+        self.waitIdle(dispatcher)
+        self.assertEqual((conn.handled, conn.rejected), ([0], []))  # The rest after it got closed
+        dispatcher.shutdown()
+
+    def test_http_503(self):
+        loop: EventLoop = EventLoop()
+        loop.start()
+        release: Event = Event()
+
+        def onData(conn: HTTPServerConnection, req: HTTPRequest):
+            release.wait(5)
+            conn.sendData(HTTPResponse(200, "OK", HTTPHeaders(), b'slow'))
+
+        server: HTTPServer = HTTPServer(("127.0.0.1", 0), lambda conn: onData)
+        server.dispatcher = HandlerDispatcher(workers=1, maxPending=1)
+        server.listen(eventLoop=loop)
+        try:
+            first = socket.create_connection(server.sock.getsockname(), timeout=5)
+            first.sendall(b'GET / HTTP/1.1\r\n\r\n')
+            time.sleep(.1)
+            with socket.create_connection(server.sock.getsockname(), timeout=5) as second:
+                second.sendall(b'GET / HTTP/1.1\r\n\r\n')
+                response: bytes = second.recv(65536)
+                self.assertTrue(response.startswith(b'HTTP/1.1 503 Service Unavailable'))
+                self.assertIn(b'Retry-After: 1', response)
+            release.set()
+            self.assertIn(b'slow', first.recv(65536))
+            first.close()
+        finally:
+            release.set()
+            server.close()
+            loop.close()
+            server.dispatcher.shutdown()
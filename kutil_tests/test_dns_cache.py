@@ -0,0 +1,66 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+import socket
+import time
+from threading import Thread
+from unittest import TestCase
+
+from kutil import HTTPServer, HTTPClient, EventLoop, DNSCache, dnsCache
+from kutil.protocol.HTTP import HTTPResponse
+
+
+class TestDNSCache(TestCase):
+    def setUp(self):
+        self.lookups: list[str] = []
+
+    def resolver(self, host: str, port: int, family: int, type: int) -> list[tuple]:
+        self.lookups.append(host)
+        time.sleep(.05)  # Let the concurrent resolutions wait
+        if host.endswith(".invalid"):
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(family, type, 6, "", (address, port))
+                for address in ("10.0.0.1", "10.0.0.1", "10.0.0.2")]  # With a duplicate
+
+    def test_cache(self):
+        cache: DNSCache = DNSCache(ttl=.2, resolver=self.resolver)
+        threads: list[Thread] = [Thread(target=cache.resolve, args=("Upstream.test", 80))
+                                 for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.resolve("upstream.test", 80), [("10.0.0.1", 80), ("10.0.0.2", 80)])
+        self.assertEqual(self.lookups, ["Upstream.test"])  # Single-flight
+        self.assertEqual((cache.misses, cache.coalesced, cache.hits), (1, 3, 4))
+
+        time.sleep(.25)  # Expired
+        cache.resolve("upstream.test", 80)
+        self.assertEqual(len(self.lookups), 2)
+
+        for _ in range(2):  # Remembered as failed
+            with self.assertRaises(socket.gaierror):
+                cache.resolve("missing.invalid", 80)
+        self.assertEqual((self.lookups.count("missing.invalid"), cache.failures), (1, 1))
+
+        self.assertEqual(cache.resolve("127.0.0.1", 80), [("127.0.0.1", 80)])
+        cache.override("upstream.test", ["192.168.0.1"])
+        self.assertEqual(cache.resolveAddress(("upstream.test", 443)), ("192.168.0.1", 443))
+        self.assertEqual(len(self.lookups), 3)
+
+    def test_connection(self):
+        loop: EventLoop = EventLoop()
+        loop.start()
+        server: HTTPServer = HTTPServer(("127.0.0.1", 0), lambda conn: lambda c, req: c.sendData(
+            HTTPResponse(200, "OK", None, req.headers["Host"].encode("utf-8"))))
+        server.listen(eventLoop=loop)
+        port: int = server.sock.getsockname()[1]
+        dnsCache.override("upstream.test", ["127.0.0.1"])
+        try:
+            with HTTPClient() as client:
+                self.assertEqual(client.get(f"http://upstream.test:{port}/").body,
+                                 f"upstream.test:{port}".encode("utf-8"))
+        finally:
+            dnsCache.override("upstream.test", None)
+            server.close()
+            loop.close()
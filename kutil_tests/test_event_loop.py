@@ -0,0 +1,107 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+import os
+import socket
+import tempfile
+import time
+from unittest import TestCase, mock
+
+from kutil import HTTPServer, HTTPServerConnection, EventLoop, FileByteBuffer
+from kutil.protocol.HTTP import HTTPRequest, HTTPResponse, HTTPHeaders
+
+
+class TestEventLoop(TestCase):
+    loop: EventLoop
+    server: HTTPServer
+    address: tuple[str, int]
+
+    def setUp(self):
+        self.loop = EventLoop(ioThreads=2)
+        self.loop.start()
+        self.server = HTTPServer(("127.0.0.1", 0), self.onConnection)
+        self.address = self.server.sock.getsockname()
+        self.server.listen(eventLoop=self.loop)  # Returns immediately, the loop is running
+
+    def tearDown(self):
+        for conn in list(self.server.connections):
+            conn.close()
+        self.server.close()
+        self.loop.close()
+
+    def onConnection(self, conn: HTTPServerConnection):
+        return self.onData
+
+    @staticmethod
+    def onData(conn: HTTPServerConnection, req: HTTPRequest):
+        conn.sendData(HTTPResponse(200, "OK", HTTPHeaders(), req.requestURI.encode("utf-8")))
+
+    def request(self, sock: socket.socket, *paths: str) -> bytes:
+        sock.sendall(b''.join(f"GET {path} HTTP/1.1\r\nHost: x\r\n\r\n".encode("utf-8")
+                              for path in paths))
+        expected: bytes = paths[-1].encode("utf-8")
+        data: bytes = b''
+        while not data.endswith(expected):
+            chunk: bytes = sock.recv(65536)
+            self.assertTrue(chunk, "The server closed the connection")
+            data += chunk
+        return data
+
+    def test_requests(self):
+        clients: list[socket.socket] = [socket.create_connection(self.address, timeout=5)
+                                        for _ in range(20)]
+        try:
+            for i, client in enumerate(clients):
+                response: bytes = self.request(client, f"/{i}")
+                self.assertTrue(response.startswith(b'HTTP/1.1 200 OK'))
+            # Pipelined requests are all answered in order
+            response: bytes = self.request(clients[0], "/a", "/b", "/c")
+            self.assertLess(response.index(b'/a'), response.index(b'/b'))
+            self.assertEqual(response.count(b'HTTP/1.1 200 OK'), 3)
+            self.assertEqual(len(self.server.connections), 20)
+            for conn in self.server.connections:
+                self.assertIsNone(conn.receiverThread)  # No thread per connection
+        finally:
+            for client in clients:
+                client.close()
+
+        deadline: float = time.time() + 5
+        while len(self.server.connections) > 0 and time.time() < deadline:
+            time.sleep(.01)
+        self.assertEqual(len(self.server.connections), 0)
+
+    def test_big_request(self):
+        with socket.create_connection(self.address, timeout=5) as client:
+            body: bytes = b'x' * 1024 * 1024  # Bigger than the receive buffer
+            client.sendall(b'POST /big HTTP/1.1\r\nContent-Length: %d\r\n\r\n%b' %
+                           (len(body), body))
+            self.assertTrue(self.request(client, "/after").endswith(b'/after'))
+
+        with socket.create_connection(self.address, timeout=5) as client:
+            client.sendall(b'GET /' + b'x' * 100 * 1024 + b' HTTP/1.1\r\n\r\n')  # Too long
+            self.assertTrue(client.recv(65536).startswith(b'HTTP/1.1 431 '))
+
+    def test_sendfile(self):
+        content: bytes = os.urandom(3 * 1024 * 1024)
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path: str = os.path.join(tmpDir, "big.bin")
+            with open(path, "wb") as f:
+                f.write(content)
+
+            def onData(conn: HTTPServerConnection, req: HTTPRequest):
+                conn.sendData(HTTPResponse(200, "OK", HTTPHeaders(),
+                                           FileByteBuffer(open(path, "rb"))))
+
+            self.server.onConnection = lambda conn: onData
+            with (mock.patch("os.sendfile", wraps=os.sendfile) as sendfile,
+                  socket.create_connection(self.address, timeout=5) as client):
+                client.sendall(b'GET /big HTTP/1.1\r\n\r\n')
+                data: bytes = b''
+                while not data.endswith(content[-1024:]):
+                    chunk: bytes = client.recv(1024 * 1024)
+                    self.assertTrue(chunk, "The server closed the connection")
+                    data += chunk
+                head, body = data.split(b'\r\n\r\n', 1)
+                self.assertIn(b'Content-Length: %d' % len(content), head)
+                self.assertEqual(body, content)
+                self.assertGreater(sendfile.call_count, 0)
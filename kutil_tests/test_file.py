@@ -0,0 +1,195 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from kutil import FileByteBuffer, MemoryByteBuffer
+from kutil.io.file import readFile, readFiles, writeFile, FsyncBatcher
+from kutil.io.json_stream import iterJSON, iterJSONItems, JSONStreamReader
+from kutil.io.read_cache import ReadCache
+
+
+class TestFile(TestCase):
+    tmpDir: tempfile.TemporaryDirectory
+    path: str
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpDir.name, "file.txt")
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def test_write_read(self):
+        writeFile(self.path, "hello")
+        self.assertEqual(readFile(self.path, "text"), "hello")
+        writeFile(self.path, {"hello": [1, 2]})
+        self.assertEqual(readFile(self.path, "json"), {"hello": [1, 2]})
+        writeFile(self.path, b'bytes', fsync=True)
+        self.assertEqual(readFile(self.path, "bytes"), b'bytes')
+
+    def test_atomic(self):
+        writeFile(self.path, "old")
+        os.chmod(self.path, 0o640)
+        writeFile(self.path, "new", atomic=True, fsync=True)
+        self.assertEqual(readFile(self.path, "text"), "new")
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.tmpDir.name), ["file.txt"])  # No temporary files left
+
+        with self.assertRaises(ValueError):
+            writeFile(self.path, object(), atomic=True)
+        self.assertEqual(readFile(self.path, "text"), "new")
+        self.assertEqual(os.listdir(self.tmpDir.name), ["file.txt"])
+
+    def test_fsync_batcher(self):
+        paths: list[str] = [os.path.join(self.tmpDir.name, f"{i}.txt") for i in range(5)]
+        batcher: FsyncBatcher = FsyncBatcher()
+        for i, path in enumerate(paths):
+            writeFile(path, str(i), atomic=True, fsync=batcher)
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        self.assertEqual(batcher.commit(), 5)
+        self.assertEqual([readFile(path, "text") for path in paths], ["0", "1", "2", "3", "4"])
+
+        with self.assertRaises(KeyError):
+            with FsyncBatcher() as batcher:
+                writeFile(paths[0], "discarded", atomic=True, fsync=batcher)
+                raise KeyError
+        self.assertEqual(readFile(paths[0], "text"), "0")
+        self.assertEqual(len(os.listdir(self.tmpDir.name)), 5)
+
+    def test_copy_file_buffer(self):
+        data: bytes = os.urandom(1024 * 1024 + 5)
+        writeFile(self.path, data)
+        copyPath: str = os.path.join(self.tmpDir.name, "copy.bin")
+        buff = readFile(self.path, "buffer")
+        buff.skip(5)
+        writeFile(copyPath, buff, atomic=True)
+        self.assertEqual(readFile(copyPath, "bytes"), data)
+
+        # Into a memory-backed buffer
+        copyBuff = buff.copy()
+        self.assertEqual(copyBuff.export(), data)
+        self.assertEqual(copyBuff.leftLength(), len(data) - 5)
+        buff.destroy()
+        copyBuff.destroy()
+
+        # Into an opened file, which is then read again
+        with open(copyPath, "wb+") as f:
+            target: FileByteBuffer = FileByteBuffer(f)
+            FileByteBuffer(open(self.path, "rb")).copyInto(target)
+            self.assertEqual(target.export(), data)
+            target.write(b'end')
+            self.assertEqual(target.fullLength(), len(data) + 3)
+
+    def test_json_stream(self):
+        data = {"tiles": [{"x": 12345, "y": -1.5e-3, "name": "Příliš žluťoučký kůň"}] * 20,
+                "empty": {"list": [], "dict": {}}, "flags": [True, False, None], "n": 10}
+        encoded: bytes = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        for chunkSize in (1, 3, 7, 1024):
+            events = list(iterJSON(MemoryByteBuffer(encoded), chunkSize=chunkSize))
+            self.assertIn((("tiles", 19, "name"), "Příliš žluťoučký kůň"), events)
+            self.assertIn((("tiles", 0, "x"), 12345), events)
+            self.assertIn((("empty", "list"), []), events)
+            self.assertEqual(events[-1], (("n",), 10))
+            shallow = iterJSON(MemoryByteBuffer(encoded), chunkSize=chunkSize, maxDepth=1)
+            self.assertEqual({path[0]: value for path, value in shallow}, data)
+        self.assertEqual(list(iterJSON(MemoryByteBuffer(b' 42 '), maxDepth=0)), [((), 42)])
+
+        writeFile(self.path, json.dumps(data["tiles"]))
+        self.assertEqual(list(readFile(self.path, "jsonitems")), data["tiles"])
+        self.assertEqual(len(list(readFile(self.path, "jsonstream"))), 60)
+
+        for invalid in (b'{"a": 1', b'[1, 2] 3', b'{"a" 1}', b'[1 2]', b''):
+            with self.assertRaises(json.JSONDecodeError):
+                list(iterJSON(MemoryByteBuffer(invalid), chunkSize=2))
+        with self.assertRaises(ValueError):
+            list(iterJSONItems(MemoryByteBuffer(b'{}')))
+
+    def test_json_stream_lazy(self):
+        read: list[bytes] = []
+
+        def chunks():
+            for char in b'[1234, 1.5e3, ' + b'5, ' * 1000 + b'6]':
+                read.append(bytes([char]))
+                yield read[-1]
+
+        items = JSONStreamReader(chunks(), 1).items()
+        self.assertEqual(next(items), 1234)
+        self.assertEqual(b''.join(read), b'[1234,')  # Only until the number's end
+        self.assertEqual(next(items), 1500)
+        self.assertEqual(b''.join(read), b'[1234, 1.5e3,')
+        self.assertEqual(list(items)[-2:], [5, 6])
+
+        writeFile(self.path, "[1, 2]")
+        with mock.patch("kutil.io.file.open", create=True) as opened:
+            items = readFile(self.path, "jsonitems")
+            opened.assert_not_called()  # Not opened until iterated, so nothing to leak
+        self.assertEqual(list(items), [1, 2])
+        missing = readFile(os.path.join(self.tmpDir.name, "missing.json"), "jsonstream")
+        with self.assertRaises(FileNotFoundError):
+            next(missing)
+
+    def test_cached_read(self):
+        cache: ReadCache = ReadCache()
+        cache.clear()
+        writeFile(self.path, {"a": 1})
+        first = readFile(self.path, "json", cached=True)
+        self.assertIs(readFile(self.path, "json", cached=True), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        writeFile(self.path, {"a": 2})
+        self.assertEqual(readFile(self.path, "json", cached=True), {"a": 2})
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(readFile(self.path, "text", cached=True), '{"a": 2}')
+        copy: bytearray = readFile(self.path, "bytearray", cached=True)
+        copy.clear()
+        self.assertEqual(readFile(self.path, "bytearray", cached=True), b'{"a": 2}')
+
+        # LRU eviction within the budget
+        budget: int = cache.budget
+        try:
+            cache.clear()
+            cache.budget = 3000
+            paths: list[str] = [os.path.join(self.tmpDir.name, f"{i}.bin") for i in range(3)]
+            for path in paths:
+                writeFile(path, b'x' * 1000)
+                readFile(path, "bytes", cached=True)
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(cache.evictions, 1)
+            self.assertLessEqual(cache.size, cache.budget)
+            readFile(paths[2], "bytes", cached=True)
+            self.assertEqual(cache.hits, 1)
+        finally:
+            cache.budget = budget
+            cache.clear()
+
+        with self.assertRaises(ValueError):
+            readFile(self.path, "buffer", cached=True)
+
+    def test_read_files(self):
+        paths: list[str] = [os.path.join(self.tmpDir.name, f"{i}.json") for i in range(50)]
+        for i, path in enumerate(paths):
+            writeFile(path, {"i": i})
+        missing: str = os.path.join(self.tmpDir.name, "missing.json")
+        paths.insert(10, missing)
+
+        results = list(readFiles(paths, "json", workers=4))
+        self.assertEqual([path for path, _, _ in results], paths)
+        self.assertIsInstance(results[10][2], FileNotFoundError)
+        self.assertIsNone(results[10][1])
+        self.assertEqual(results[11], (paths[11], {"i": 10}, None))
+
+        unordered = list(readFiles(paths, "json", workers=4, ordered=False))
+        self.assertCountEqual([(path, data) for path, data, _ in unordered],
+                              [(path, data) for path, data, _ in results])
+
+        with self.assertRaises(ValueError):
+            list(readFiles(paths, "buffer"))
+
+        # Stopping early must not hang
+        iterator = readFiles(paths, "bytes", workers=2)
+        next(iterator)
+        iterator.close()
@@ -0,0 +1,464 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+import socket
+import time
+import zlib
+from threading import Thread
+from unittest import TestCase
+
+from kutil import MemoryByteBuffer, HTTPServer, HTTPServerConnection, EventLoop
+from kutil.protocol.AbstractProtocol import NeedMoreDataError
+from kutil.protocol.HTTP import (HTTPRequest, HTTPResponse, HTTPMethod, HTTPParser, HTTPParseError,
+                                 HTTPHeaders, HTTPCompressor, Router, ResponseCache)
+from kutil.protocol.HTTP.HTTPCompression import negotiateEncoding
+
+
+class TestHTTP(TestCase):
+    @staticmethod
+    def feed(parser: HTTPParser, buff: MemoryByteBuffer, data: bytes) -> list:
+        """Feeds the data like ProtocolConnection does, returning the parsed messages"""
+        messages: list = []
+        buff.write(data)
+        buff.resetPointer()
+        while buff.has(1):
+            try:
+                messages.append(parser.parse(buff))
+            except NeedMoreDataError:
+                break
+            buff.resetBeforePointer()
+        return messages
+
+    def test_parse_request(self):
+        raw: bytes = (b'POST /submit?a=1 HTTP/1.1\r\nHost: example.com\r\nX-Empty:\r\n'
+                      b'Content-Length:  5 \r\n\r\nhello')
+        parser: HTTPParser = HTTPParser(HTTPRequest)
+        buff: MemoryByteBuffer = MemoryByteBuffer()
+        messages: list = []
+        for i in range(len(raw)):  # Byte by byte
+            messages += self.feed(parser, buff, raw[i:i + 1])
+        self.assertEqual(len(messages), 1)
+        req: HTTPRequest = messages[0]
+        self.assertEqual((req.method, req.requestURI, req.body),
+                         (HTTPMethod.POST, "/submit?a=1", b'hello'))
+        self.assertEqual(req.headers.get("content-length"), "5")
+        self.assertEqual(req.headers.get("X-Empty"), "")
+
+        # Pipelined requests in one piece
+        messages = self.feed(parser, buff, raw * 3 + b'GET / HTTP/1.1\r\n\r\nGET')
+        self.assertEqual(len(messages), 4)
+        self.assertEqual(messages[-1].method, HTTPMethod.GET)
+        self.assertEqual(buff.export(), b'GET')
+
+    def test_parse_response(self):
+        resp: HTTPResponse = HTTPResponse()
+        resp.read(MemoryByteBuffer(b'HTTP/1.1 204 No Content\r\nContent-Length: 10\r\n\r\n'))
+        self.assertEqual((resp.statusCode, resp.statusPhrase, resp.body), (204, "No Content", b''))
+
+        buff: MemoryByteBuffer = MemoryByteBuffer(b'HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nab')
+        with self.assertRaises(NeedMoreDataError):
+            HTTPResponse().read(buff)
+        self.assertEqual(buff.leftLength(), buff.fullLength())  # The pointer didn't move
+
+    def test_errors(self):
+        for raw, status in ((b'GET / HTTP/1.0\r\n\r\n', 505), (b'GET /\r\n\r\n', 400),
+                            (b'FOO / HTTP/1.1\r\n\r\n', 400),
+                            (b'GET / HTTP/1.1\r\nBad\r\n\r\n', 400),
+                            (b'GET / HTTP/1.1\r\nContent-Length: x\r\n\r\n', 400)):
+            with self.assertRaises(HTTPParseError) as context:
+                HTTPParser(HTTPRequest).parse(MemoryByteBuffer(raw))
+            self.assertEqual(context.exception.statusCode, status)
+
+        parser: HTTPParser = HTTPParser(HTTPRequest)
+        with self.assertRaises(HTTPParseError) as context:
+            self.feed(parser, MemoryByteBuffer(), b'GET / HTTP/1.1\r\n' + b'X: y\r\n' * 20000)
+        self.assertEqual(context.exception.statusCode, 431)
+
+    def test_slow_client(self):
+        # A 16 kB head sent in 1 byte pieces must not be re-scanned on every piece
+        raw: bytes = b'GET / HTTP/1.1\r\n' + b'X-Header: value\r\n' * 1000 + b'\r\n'
+        parser: HTTPParser = HTTPParser(HTTPRequest)
+        buff: MemoryByteBuffer = MemoryByteBuffer()
+        start: float = time.perf_counter()
+        messages: list = []
+        for i in range(len(raw)):
+            messages += self.feed(parser, buff, raw[i:i + 1])
+        self.assertEqual(len(messages), 1)
+        self.assertLess(time.perf_counter() - start, 2)
+
+    def test_chunked(self):
+        raw: bytes = (b'POST /upload HTTP/1.1\r\nTransfer-Encoding: chunked\r\n'
+                      b'Content-Length: 3\r\n\r\n5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\n'
+                      b'X-Trailer: yes\r\n\r\n')
+        parser: HTTPParser = HTTPParser(HTTPRequest)
+        buff: MemoryByteBuffer = MemoryByteBuffer()
+        messages: list = []
+        for i in range(len(raw)):  # Byte by byte
+            messages += self.feed(parser, buff, raw[i:i + 1])
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].body, b'hello world')
+        self.assertEqual(messages[0].headers.get("X-Trailer"), "yes")
+
+        # Streamed to a sink, the processed data is consumed
+        pieces: list[bytes] = []
+        parser = HTTPParser(HTTPRequest, lambda req: pieces.append)
+        buff = MemoryByteBuffer(raw[:85])
+        with self.assertRaises(NeedMoreDataError) as context:
+            parser.parse(buff)
+        self.assertTrue(context.exception.consumed)
+        buff.resetBeforePointer()
+        buff.write(raw[85:])
+        buff.resetPointer()
+        self.assertEqual(parser.parse(buff).body, b'')
+        self.assertEqual(b''.join(pieces), b'hello world')
+        self.assertEqual(pieces[-1], b'')
+
+        for bad in (b'x\r\n', b'5\r\nhelloXX'):
+            with self.assertRaises(HTTPParseError):
+                HTTPParser(HTTPRequest).parse(MemoryByteBuffer(
+                    b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n' + bad))
+        with self.assertRaises(HTTPParseError) as context:
+            HTTPParser(HTTPRequest).parse(MemoryByteBuffer(
+                b'POST / HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\n'))
+        self.assertEqual(context.exception.statusCode, 501)
+
+    def test_streamed_body(self):
+        def generate():
+            yield b'first '
+            yield b''
+            yield b'second'
+
+        loop: EventLoop = EventLoop()
+        loop.start()
+        uploaded: list[bytes] = []
+        server: HTTPServer = HTTPServer(
+            ("127.0.0.1", 0),
+            lambda conn: lambda c, req: c.sendData(HTTPResponse(200, "OK", None, generate())))
+        server.bodySinkFactory = lambda conn, req: uploaded.append
+        server.listen(eventLoop=loop)
+        try:
+            with socket.create_connection(server.sock.getsockname(), timeout=5) as client:
+                client.sendall(b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+                               b'3\r\nabc\r\n0\r\n\r\n')
+                buff: MemoryByteBuffer = MemoryByteBuffer()
+                parser: HTTPParser = HTTPParser(HTTPResponse)
+                responses: list = []
+                while len(responses) == 0:
+                    responses = self.feed(parser, buff, client.recv(65536))
+                self.assertEqual(responses[0].headers.get("Transfer-Encoding"), "chunked")
+                self.assertIsNone(responses[0].headers.get("Content-Length"))
+                self.assertEqual(responses[0].body, b'first second')
+            self.assertEqual(uploaded, [b'abc', b''])
+        finally:
+            server.close()
+            loop.close()
+
+    def test_streamed_body_error(self):
+        def generate():
+            yield b'first '
+            raise ValueError("The body failed")
+
+        def onData(conn: HTTPServerConnection, req: HTTPRequest):
+            conn.onCloseListeners.append(lambda c, cause: causes.append(cause))
+            results.append(conn.sendData(HTTPResponse(200, "OK", None, generate())))
+
+        loop: EventLoop = EventLoop()
+        loop.start()
+        results: list[bool] = []
+        causes: list = []
+        server: HTTPServer = HTTPServer(("127.0.0.1", 0), lambda conn: onData)
+        server.listen(eventLoop=loop)
+        try:
+            with socket.create_connection(server.sock.getsockname(), timeout=5) as client:
+                client.sendall(b'GET / HTTP/1.1\r\n\r\n')
+                response: bytes = self.receiveAll(client)  # Closed, not left half-written
+                self.assertIn(b'first ', response)
+                self.assertFalse(response.endswith(b'0\r\n\r\n'))  # No last chunk
+            self.assertEqual(results, [False])
+            self.assertIsInstance(causes[0], ValueError)
+        finally:
+            server.close()
+            loop.close()
+
+    def test_headers(self):
+        headers: HTTPHeaders = HTTPHeaders({"x-custom": "1", "CONTENT-LENGTH": "5"})
+        headers.add("Vary", "Accept")
+        headers.add("vary", "Accept-Encoding")
+        self.assertEqual((headers["VARY"], headers.getAll("Vary")),
+                         ("Accept, Accept-Encoding", ["Accept", "Accept-Encoding"]))
+        self.assertIn("Content-Length", headers)
+        self.assertEqual(list(headers), ["x-custom", "Content-Length", "Vary"])
+        headers["vary"] = "Origin"  # Replaces all the values
+        del headers["X-CUSTOM"]
+        self.assertIsNone(headers.get("x-custom"))
+        self.assertEqual(headers.serialize(), b'Content-Length: 5\r\nVary: Origin\r\n\r\n')
+
+        req: HTTPRequest = HTTPParser(HTTPRequest).parse(MemoryByteBuffer(
+            b'GET / HTTP/1.1\r\nCookie: a=1\r\ncookie: b=2\r\n\r\n'))
+        self.assertEqual(req.headers.getAll("Cookie"), ["a=1", "b=2"])
+        self.assertEqual(req.headers["cookie"], "a=1; b=2")  # Cookie's own separator
+
+        cookies: HTTPHeaders = HTTPHeaders()
+        cookies.add("Set-Cookie", "a=1; Expires=Wed, 21 Oct 2026 07:28:00 GMT")
+        cookies.add("Set-Cookie", "b=2")
+        self.assertEqual(cookies.get("set-cookie"), "a=1; Expires=Wed, 21 Oct 2026 07:28:00 GMT")
+        self.assertEqual(HTTPHeaders(cookies).getAll("Set-Cookie"), cookies.getAll("Set-Cookie"))
+        self.assertIn("('Set-Cookie', 'b=2')", repr(cookies))
+
+    def test_lazy_headers(self):
+        block: bytes = b'host: a\r\nX-Odd-Case:  b \r\nCookie: c=1\r\ncookie: d=2'
+        req: HTTPRequest = HTTPParser(HTTPRequest, lazyHeaders=True).parse(MemoryByteBuffer(
+            b'GET /p/a?x=1&flag&&y=2 HTTP/1.1\r\n' + block + b'\r\n\r\n'))
+        headers: HTTPHeaders = req.headers
+        self.assertEqual(headers.raw, block)
+        self.assertEqual((headers["Host"], headers.get("x-odd-case"), headers.getAll("COOKIE")),
+                         ("a", "b", ["c=1", "d=2"]))
+        self.assertEqual(headers["Cookie"], "c=1; d=2")
+        self.assertEqual(len(headers), 3)
+        self.assertEqual(headers.serialize(), block + b'\r\n\r\n')  # Passed through byte for byte
+
+        headers.add("Via", "proxy")
+        self.assertIsNone(headers.raw)
+        self.assertEqual(list(headers), ["Host", "X-Odd-Case", "Cookie", "Via"])
+        self.assertEqual(headers.serialize(), b'Host: a\r\nX-Odd-Case: b\r\nCookie: c=1\r\n'
+                                              b'Cookie: d=2\r\nVia: proxy\r\n\r\n')
+
+        self.assertEqual(req.path, "/p/a")
+        self.assertEqual((req.query["x"], req.query["flag"], req.query["y"]), ("1", "", "2"))
+        req.requestURI = "/other"
+        self.assertIsNone(req.query.get("x"))
+
+        with self.assertRaises(HTTPParseError):
+            HTTPParser(HTTPRequest, lazyHeaders=True).parse(MemoryByteBuffer(
+                b'GET / HTTP/1.1\r\nBad\r\n\r\n'))
+
+    def test_compression(self):
+        self.assertEqual(negotiateEncoding("deflate, gzip;q=0.5"), "deflate")
+        self.assertEqual(negotiateEncoding("gzip, deflate, br"), "gzip")
+        self.assertIsNone(negotiateEncoding("gzip;q=0, br"))
+        self.assertEqual(negotiateEncoding("*"), "gzip")
+
+        compressor: HTTPCompressor = HTTPCompressor()
+        body: bytes = b'{"values": [' + b'1, ' * 1000 + b'1]}'
+
+        def respond(contentType: str, data, etag: str = '"v1"') -> HTTPResponse:
+            return HTTPResponse(200, "OK", HTTPHeaders({"Content-Type": contentType,
+                                                        "ETag": etag}), data)
+
+        for _ in range(2):  # Compressed once, then taken from the cache
+            resp: HTTPResponse = respond("application/json; charset=utf-8", body)
+            self.assertEqual(compressor.compress(resp, "gzip, deflate"), "gzip")
+            self.assertEqual(zlib.decompress(resp.body, 16 + zlib.MAX_WBITS), body)
+            self.assertEqual((resp.headers["Vary"], resp.headers["ETag"]), ("Accept-Encoding",
+                                                                             '"v1-gzip"'))
+        self.assertEqual((compressor.cache.hits, compressor.cache.misses), (1, 1))
+
+        resp = respond("application/json", body[:100])  # Too small, but it still varies
+        self.assertIsNone(compressor.compress(resp, "gzip"))
+        self.assertEqual(resp.headers["Vary"], "Accept-Encoding")
+        resp = respond("image/png", body)
+        self.assertIsNone(compressor.compress(resp, "gzip"))
+        self.assertNotIn("Vary", resp.headers)
+
+        resp = respond("text/plain", iter([b'first ', b'', b'second']), 'W/"v1"')
+        self.assertEqual(compressor.compress(resp, "deflate"), "deflate")
+        self.assertEqual(zlib.decompress(b''.join(resp.body)), b'first second')
+        self.assertEqual(resp.headers["ETag"], 'W/"v1"')
+
+        loop: EventLoop = EventLoop()
+        loop.start()
+        server: HTTPServer = HTTPServer(
+            ("127.0.0.1", 0),
+            lambda conn: lambda c, req: c.sendData(respond("text/html", req.requestURI.encode()
+                                                           * 1000)))
+        server.compressor = compressor
+        server.listen(eventLoop=loop)
+        try:
+            with socket.create_connection(server.sock.getsockname(), timeout=5) as client:
+                client.sendall(b'GET /a HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n'
+                               b'GET /b HTTP/1.1\r\n\r\n')
+                buff: MemoryByteBuffer = MemoryByteBuffer()
+                parser: HTTPParser = HTTPParser(HTTPResponse)
+                responses: list = []
+                while len(responses) < 2:
+                    responses += self.feed(parser, buff, client.recv(65536))
+                self.assertEqual(responses[0].headers.get("Content-Encoding"), "gzip")
+                self.assertEqual(zlib.decompress(responses[0].body, 16 + zlib.MAX_WBITS),
+                                 b'/a' * 1000)
+                self.assertIsNone(responses[1].headers.get("Content-Encoding"))
+                self.assertEqual(responses[1].body, b'/b' * 1000)
+        finally:
+            server.close()
+            loop.close()
+
+    def test_router(self):
+        calls: list[str] = []
+
+        def handler(name: str):
+            return lambda conn, req: HTTPResponse(200, "OK", None, f"{name} {req.routeParams}"
+                                                  .encode("utf-8"))
+
+        def middleware(name: str):
+            def wrapper(conn, req, nextHandler):
+                calls.append(name)
+                return nextHandler(conn, req)
+            return wrapper
+
+        router: Router = Router()
+        router.get("/tile/:mapSet", handler("tile"))
+        router.get("/tile/special", handler("special"))
+        router.get("/static/*path", handler("static"))
+        router.get("/users/:id", handler("user"))
+        router.post("/users/me", handler("me"))
+        router.add(HTTPMethod.DELETE, "/users/:id/posts/:post", handler("delete"),
+                   [middleware("route")])
+        router.use(middleware("all"))  # Also wraps the routes added before
+
+        for method, uri, body in (
+                (HTTPMethod.GET, "/tile/basic?x=1", b"tile {'mapSet': 'basic'}"),
+                (HTTPMethod.GET, "/tile/special", b"special {}"),
+                (HTTPMethod.GET, "/static/a/b%20c", b"static {'path': 'a/b c'}"),
+                (HTTPMethod.GET, "/users/me", b"user {'id': 'me'}"),  # Falls back to :id
+                (HTTPMethod.POST, "/users/me", b"me {}"),
+                (HTTPMethod.DELETE, "/users/5/posts/7", b"delete {'id': '5', 'post': '7'}")):
+            self.assertEqual(router.dispatch(None, HTTPRequest(method, uri)).body, body)
+        self.assertEqual(calls, ["all"] * 5 + ["all", "route"])
+
+        resp: HTTPResponse = router.dispatch(None, HTTPRequest(HTTPMethod.GET, "/users/5/posts/7"))
+        self.assertEqual((resp.statusCode, resp.headers["Allow"]), (405, "DELETE"))
+        resp = router.dispatch(None, HTTPRequest(HTTPMethod.PUT, "/users/me"))
+        self.assertEqual((resp.statusCode, resp.headers["Allow"]), (405, "GET, POST"))
+        self.assertEqual(router.dispatch(None, HTTPRequest(HTTPMethod.GET, "/tile/")).statusCode,
+                         404)
+        for pattern in ("/tile/:other", "tile", "/a:b", "/static/*path/more"):
+            with self.assertRaises(ValueError):
+                router.get(pattern, handler("bad"))
+
+    def test_response_cache(self):
+        calls: list[str] = []
+
+        def handler(conn, req) -> HTTPResponse:
+            calls.append(req.requestURI)
+            time.sleep(.05)  # Let the concurrent requests miss together
+            cacheControl: str = "no-store" if "nostore" in req.requestURI else "max-age=60"
+            return HTTPResponse(200, "OK", HTTPHeaders({"Content-Type": "application/json",
+                                                        "Cache-Control": cacheControl,
+                                                        "Server": "KUtil"}),
+                                req.requestURI.encode("utf-8") * 1000)
+
+        cache: ResponseCache = ResponseCache(budget=5000)
+        router: Router = Router()
+        router.use(cache)
+        router.get("/:name", handler)
+
+        def get(uri: str, conn=None, acceptEncoding: str = None) -> HTTPResponse:
+            headers: HTTPHeaders = HTTPHeaders()
+            if acceptEncoding is not None:
+                headers["Accept-Encoding"] = acceptEncoding
+            return router.dispatch(conn, HTTPRequest(HTTPMethod.GET, uri, headers))
+
+        threads: list[Thread] = [Thread(target=get, args=("/a",)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ["/a"])  # Single-flight
+        self.assertEqual((cache.misses, cache.coalesced, cache.hits), (1, 3, 3))
+
+        resp: HTTPResponse = get("/a")
+        resp.headers["Connection"] = "keep-alive"  # Added when it's sent
+        buff: MemoryByteBuffer = MemoryByteBuffer()
+        resp.write(buff)
+        data: bytes = buff.export()
+        self.assertTrue(data.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'\r\nConnection: keep-alive\r\n', data)
+        self.assertNotIn(b'Server', data)
+        self.assertTrue(data.endswith(b'\r\n\r\n' + b'/a' * 1000))
+        self.assertEqual(len(calls), 1)
+
+        get("/nostore")
+        get("/nostore")
+        self.assertEqual(calls.count("/nostore"), 2)
+        self.assertEqual(len(cache), 1)
+
+        class Conn:
+            compressor: HTTPCompressor = HTTPCompressor()
+
+        self.assertEqual(get("/b", Conn(), "gzip").headers.get("Content-Encoding"), "gzip")
+        self.assertIn(b'Content-Encoding: gzip', get("/b", Conn(), "gzip, br").data)
+        self.assertIsNone(get("/b", Conn()).headers.get("Content-Encoding"))  # Another variant
+        self.assertNotIn(b'Content-Encoding', get("/b", Conn()).data)
+        self.assertEqual(calls.count("/b"), 2)
+
+        cache.invalidate("/b")
+        get("/c")
+        self.assertEqual((len(cache), cache.evictions), (2, 0))  # /a and /c, about 2 kB each
+        get("/d")
+        get("/e")
+        get("/f")
+        self.assertEqual((len(cache), cache.evictions), (2, 3))  # The least recently used first
+        self.assertLessEqual(cache.size, cache.budget)
+        self.assertEqual(get("/f").headers["Age"], "0")
+
+    def test_buffer_index(self):
+        buff: MemoryByteBuffer = MemoryByteBuffer(b'abcabc')
+        buff.skip(1)
+        self.assertEqual(buff.index(b'a'), 2)
+        self.assertEqual(buff.index(b'bc', 1), 3)
+        with self.assertRaises(IndexError):
+            buff.index(b'a', 3)
+
+    @staticmethod
+    def onData(conn: HTTPServerConnection, req: HTTPRequest):
+        conn.sendData(HTTPResponse(200, "OK", HTTPHeaders(), req.requestURI.encode("utf-8")))
+
+    @staticmethod
+    def receiveAll(sock: socket.socket) -> bytes:
+        """Receives until the server closes the connection"""
+        data: bytes = b''
+        while chunk := sock.recv(65536):
+            data += chunk
+        return data
+
+    def test_keep_alive(self):
+        loop: EventLoop = EventLoop()
+        loop.start()
+        server: HTTPServer = HTTPServer(("127.0.0.1", 0), lambda conn: self.onData)
+        server.maxRequests = 3
+        server.listen(eventLoop=loop)
+        try:
+            with socket.create_connection(server.sock.getsockname(), timeout=5) as client:
+                client.sendall(b'GET /a HTTP/1.1\r\n\r\n')
+                response: bytes = client.recv(65536)
+                self.assertIn(b'Connection: keep-alive', response)
+                self.assertIn(b'Keep-Alive: timeout=5, max=2', response)
+                # Pipelined, the last allowed request closes the connection
+                client.sendall(b'GET /b HTTP/1.1\r\n\r\nGET /c HTTP/1.1\r\n\r\n'
+                               b'GET /d HTTP/1.1\r\n\r\n')
+                response = self.receiveAll(client)
+                self.assertLess(response.index(b'/b'), response.index(b'/c'))
+                self.assertNotIn(b'/d', response)
+                self.assertIn(b'Connection: close', response[response.index(b'/b'):])
+                self.assertTrue(response.endswith(b'/c'))
+
+            with socket.create_connection(server.sock.getsockname(), timeout=5) as client:
+                client.sendall(b'GET /e HTTP/1.1\r\nConnection: close\r\n\r\n')
+                self.assertIn(b'Connection: close', self.receiveAll(client))
+        finally:
+            server.close()
+            loop.close()
+
+    def test_idle_timeout(self):
+        server: HTTPServer = HTTPServer(("127.0.0.1", 0), lambda conn: self.onData)
+        server.keepAliveTimeout = .2
+        Thread(target=server.listen, daemon=True).start()  # A receiver thread per connection
+        while server.closed:
+            time.sleep(.01)
+        try:
+            with socket.create_connection(server.sock.getsockname(), timeout=5) as client:
+                client.sendall(b'GET /a HTTP/1.1\r\n\r\n')
+                start: float = time.perf_counter()
+                self.assertTrue(self.receiveAll(client).endswith(b'/a'))
+                self.assertLess(time.perf_counter() - start, 3)
+        finally:
+            server.close()
@@ -0,0 +1,76 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+import time
+from threading import Thread
+from unittest import TestCase
+
+from kutil import HTTPServer, HTTPClient, EventLoop
+from kutil.protocol.HTTP import HTTPRequest, HTTPResponse, HTTPMethod, HTTPHeaders
+
+
+class TestHTTPClient(TestCase):
+    def setUp(self):
+        self.connections: int = 0
+        self.loop: EventLoop = EventLoop()
+        self.loop.start()
+        self.server: HTTPServer = HTTPServer(("127.0.0.1", 0), self.onConnection)
+        self.server.listen(eventLoop=self.loop)
+        self.base: str = "http://127.0.0.1:%d" % self.server.sock.getsockname()[1]
+        self.client: HTTPClient = HTTPClient(maxPerHost=2, timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        self.loop.close()
+
+    def onConnection(self, conn):
+        self.connections += 1
+        return self.onData
+
+    @staticmethod
+    def onData(conn, req: HTTPRequest):
+        if req.path == "/slow":
+            time.sleep(.1)
+        body: bytes = f"{req.method.name} {req.requestURI} ".encode("utf-8") + bytes(req.body)
+        headers: HTTPHeaders = HTTPHeaders({"Content-Type": "text/plain"})
+        if req.method is HTTPMethod.HEAD:
+            headers["Content-Length"] = str(len(body))
+            headers["X-Omit-Content-Length"] = "1"
+            body = b''
+        conn.sendData(HTTPResponse(200, "OK", headers, body))
+
+    def test_reuse(self):
+        for i in range(3):
+            self.assertEqual(self.client.get(f"{self.base}/a?i={i}").body, f"GET /a?i={i} "
+                             .encode("utf-8"))
+        resp: HTTPResponse = self.client.request(HTTPMethod.HEAD, f"{self.base}/head")
+        self.assertEqual((resp.headers["Content-Length"], resp.body), ("11", b''))
+        self.assertEqual(self.client.post(f"{self.base}/echo", b'data').body, b'POST /echo data')
+        self.assertEqual((self.connections, self.client.created, self.client.reused), (1, 1, 4))
+        self.assertEqual(self.client.idleConnections, 1)
+
+        self.client.get(f"{self.base}/bye", HTTPHeaders({"Connection": "close"}))
+        self.assertEqual(self.client.openConnections, 0)  # Not kept after Connection: close
+
+        with self.assertRaises(ValueError):
+            self.client.get("https://example.com/")
+
+    def test_limits(self):
+        threads: list[Thread] = [Thread(target=self.client.get, args=(f"{self.base}/slow",))
+                                 for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((self.client.created, self.connections), (2, 2))  # maxPerHost
+        self.assertEqual(self.client.idleConnections, 2)
+
+    def test_stale(self):
+        self.client.get(f"{self.base}/a")
+        for conn in list(self.server.connections):
+            conn.close()  # E.g., the server's idle timeout
+        time.sleep(.1)
+        self.assertEqual(self.client.get(f"{self.base}/b").body, b'GET /b ')
+        self.assertEqual(self.client.created, 2)
+        self.assertEqual(self.client.evicted + self.client.retried, 1)
@@ -0,0 +1,201 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+import os
+import socket
+import time
+from threading import Thread, Event
+from unittest import TestCase, mock
+
+from kutil import (MemoryByteBuffer, AppendedByteBuffer, ProtocolConnection, SlowConsumerPolicy,
+                   SlowConsumerError, EventLoop)
+from kutil.protocol.EventLoop import inIOThread
+from kutil.protocol.HTTPServer import HTTPServerConnection
+from kutil.protocol.TCPConnection import TCPProtocol
+from kutil.typing_help import neverCall
+
+
+class TestSend(TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.conn = ProtocolConnection(("", 0), [], neverCall, self.server)
+        self.conn.addProtocol(TCPProtocol(self.conn))
+
+    def tearDown(self):
+        self.conn.close()
+        self.client.close()
+
+    def receive(self, amount: int) -> bytes:
+        data: bytes = b''
+        while len(data) < amount:
+            chunk: bytes = self.client.recv(amount - len(data))
+            self.assertTrue(chunk)
+            data += chunk
+        return data
+
+    @staticmethod
+    def packed(*parts: bytes) -> AppendedByteBuffer:
+        return AppendedByteBuffer([MemoryByteBuffer(part) for part in parts])
+
+    def test_gathered(self):
+        calls: list[int] = []  # The amount of buffers of every sendmsg() call
+        original = socket.socket.sendmsg
+
+        def sendmsg(sock: socket.socket, buffers: list, *args) -> int:
+            calls.append(len(buffers))
+            return original(sock, buffers, *args)
+
+        parts: list[bytes] = [b'header', b'', b'framing', b'payload' * 100]
+        with mock.patch.object(socket.socket, "sendmsg", sendmsg):
+            self.assertTrue(self.conn._sendPacked(self.packed(*parts)))
+            self.assertEqual(calls, [3])  # One syscall for all the (non-empty) segments
+            self.assertEqual(self.receive(sum(map(len, parts))), b''.join(parts))
+
+            # More segments than one sendmsg() accepts
+            calls.clear()
+            with mock.patch("kutil.protocol.ProtocolConnection.IOV_MAX", 2):
+                self.assertTrue(self.conn._sendPacked(self.packed(b'a', b'b', b'c', b'd', b'e')))
+            self.assertEqual(calls, [2, 2, 1])
+            self.assertEqual(self.receive(5), b'abcde')
+
+    def test_partial_writes(self):
+        self.server.setblocking(False)
+        # More than the socket's buffer, so sendmsg() sends only a part at a time
+        parts: list[bytes] = [os.urandom(1024 * 1024) for _ in range(4)]
+        received: list[bytes] = []
+        reader: Thread = Thread(target=lambda: received.append(self.receive(4 * 1024 * 1024)))
+        reader.start()
+        self.assertTrue(self.conn._sendPacked(self.packed(*parts)))
+        reader.join(10)
+        self.assertEqual(received, [b''.join(parts)])
+
+    def test_cork(self):
+        calls: list[int] = []
+        original = socket.socket.sendmsg
+
+        def sendmsg(sock: socket.socket, buffers: list, *args) -> int:
+            calls.append(len(buffers))
+            return original(sock, buffers, *args)
+
+        self.conn.flushDelay = 10  # Only the explicit and the size-based flushes
+        with mock.patch.object(socket.socket, "sendmsg", sendmsg):
+            self.conn.cork()
+            self.conn.cork()  # Nested
+            for i in range(100):
+                self.assertTrue(self.conn._sendPacked(self.packed(b'%02d' % i)))
+            self.assertEqual((calls, self.conn.queuedBytes), ([], 200))
+            self.conn.uncork()
+            self.assertEqual(calls, [])
+            self.conn.uncork()
+            self.assertEqual(len(calls), 1)  # All the messages in one syscall
+            self.assertEqual(self.receive(200), b''.join(b'%02d' % i for i in range(100)))
+            self.assertEqual((self.conn.queuedBytes, self.conn.queueHighWater), (0, 200))
+
+            # The queue is bounded, it's sent once it's full
+            self.conn.flushSize = 100
+            self.conn.cork()
+            for i in range(60):
+                self.conn._sendPacked(self.packed(b'ab'))
+            self.assertEqual(self.receive(100), b'ab' * 50)
+            self.assertEqual(self.conn.queuedBytes, 20)
+            self.conn.uncork()
+            self.assertEqual(self.receive(20), b'ab' * 10)
+
+    def test_timed_flush(self):
+        self.client.settimeout(5)
+        self.conn.flushDelay = .01
+        self.conn.cork()
+        self.conn._sendPacked(self.packed(b'event'))
+        self.assertEqual(self.receive(5), b'event')  # Without uncork()
+        self.assertEqual(self.conn.queuedBytes, 0)
+        self.conn.uncork()
+
+    def fillSocket(self) -> None:
+        """Sends until the socket doesn't accept more data, the client reads nothing meanwhile"""
+        sent: int = 0
+        while self.conn.outboundBytes == 0:
+            self.assertTrue(self.conn._sendPacked(self.packed(b'-' * 4096)))
+            sent += 4096
+        self.filled: int = sent - self.conn.outboundBytes
+
+    def test_slow_consumer(self):
+        self.conn.highWatermark, self.conn.lowWatermark = 64 * 1024, 16 * 1024
+        self.conn.slowConsumerPolicy = SlowConsumerPolicy.DROP_OLDEST
+        drained: Event = Event()
+        self.conn.onDrainListeners.append(lambda conn: drained.set())
+        self.fillSocket()
+        messages: list[bytes] = [b'%08d' % i * 1024 for i in range(20)]  # 8 kB each
+        start: float = time.perf_counter()
+        for message in messages:
+            self.assertTrue(self.conn._sendPacked(self.packed(message)))
+        self.assertLess(time.perf_counter() - start, 1)  # Didn't block
+        self.assertFalse(self.conn.isWritable)
+        self.assertGreater(self.conn.droppedMessages, 0)
+        self.assertLessEqual(self.conn.outboundBytes, self.conn.highWatermark)
+
+        # The peer reads, the rest is sent in the background
+        data: bytes = self.receive(self.filled + self.conn.outboundBytes)
+        self.assertTrue(drained.wait(5))
+        self.assertTrue(self.conn.isWritable)
+        self.assertTrue(data.endswith(messages[-1]))
+        received: list[bytes] = [message for message in messages if message in data]
+        self.assertLess(len(received), len(messages))
+        self.assertEqual(received, messages[-len(received):])  # The oldest ones were dropped
+
+    def test_event_loop_thread(self):
+        self.conn.highWatermark, self.conn.lowWatermark = 64 * 1024, 16 * 1024
+        self.assertIs(self.conn.slowConsumerPolicy, SlowConsumerPolicy.BLOCK)
+        self.fillSocket()
+        leftover: int = self.conn.outboundBytes  # The rest of the last message filling the socket
+        sent: Event = Event()
+        messages: list[bytes] = [b'%08d' % i * 1024 for i in range(20)]  # 8 kB each
+
+        def send() -> None:  # A handler on the I/O thread, without a dispatcher
+            for message in messages:
+                self.conn._sendPacked(self.packed(message))
+            sent.set()
+
+        loop: EventLoop = EventLoop()
+        loop.start()
+        try:
+            loop.callSoon(send)
+            self.assertTrue(sent.wait(1))  # Didn't wait for the client to read
+        finally:
+            loop.close()
+        self.assertFalse(inIOThread())
+        self.assertTrue(self.conn.readingPaused)  # Stopped reading instead
+        self.assertEqual(self.conn.droppedMessages, 0)
+
+        data: bytes = self.receive(self.filled + leftover + len(messages) * 8192)
+        self.assertTrue(data.endswith(b''.join(messages)))  # Nothing was dropped
+        for _ in range(100):
+            if not self.conn.readingPaused:
+                break
+            time.sleep(.01)
+        self.assertFalse(self.conn.readingPaused)  # Reads again once drained
+
+    def test_stream_through(self):
+        self.conn.highWatermark, self.conn.lowWatermark = 64 * 1024, 16 * 1024
+        self.conn.slowConsumerPolicy = SlowConsumerPolicy.DISCONNECT
+        self.fillSocket()
+        before: int = self.filled + self.conn.outboundBytes
+        big: bytes = os.urandom(1024 * 1024)
+        self.assertTrue(self.conn._sendPacked(self.packed(big)))  # Not disconnected
+        self.assertFalse(self.conn.closed)
+        self.assertFalse(self.conn.isWritable)
+        self.assertEqual(self.receive(before + len(big))[before:], big)
+
+    def test_http_responses_not_dropped(self):
+        conn: HTTPServerConnection = HTTPServerConnection(("", 0), [], neverCall, self.server)
+        self.assertFalse(conn.canDropMessages)
+        self.assertTrue(self.conn.canDropMessages)
+
+    def test_disconnect(self):
+        causes: list = []
+        self.conn.onCloseListeners.append(lambda conn, cause: causes.append(cause))
+        self.conn.highWatermark = 64 * 1024
+        self.conn.slowConsumerPolicy = SlowConsumerPolicy.DISCONNECT
+        self.fillSocket()
+        while not self.conn.closed:
+            self.conn._sendPacked(self.packed(b'x' * 8192))
+        self.assertIsInstance(causes[0], SlowConsumerError)
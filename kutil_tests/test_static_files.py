@@ -0,0 +1,138 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+import os
+import socket
+import tempfile
+from unittest import TestCase, mock
+
+from kutil import MemoryByteBuffer, HTTPServer, EventLoop, FileRegionByteBuffer
+from kutil.protocol.AbstractProtocol import NeedMoreDataError
+from kutil.protocol.HTTP import (HTTPRequest, HTTPResponse, HTTPMethod, HTTPHeaders, HTTPParser,
+                                 StaticFileHandler)
+from kutil.protocol.HTTP.StaticFileHandler import parseRange
+
+
+class TestStaticFiles(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "public")
+        os.mkdir(self.root)
+        self.content = bytes(range(256)) * 40  # 10 kB
+        with open(os.path.join(self.root, "data.bin"), "wb") as file:
+            file.write(self.content)
+        with open(os.path.join(self.root, "index.html"), "wb") as file:
+            file.write(b'<h1>Index</h1>')
+        with open(os.path.join(self.tmp.name, "secret.txt"), "wb") as file:
+            file.write(b'secret')
+        self.handler = StaticFileHandler(self.root, "/static/")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def get(self, uri: str, headers: dict[str, str] = None,
+            method: HTTPMethod = HTTPMethod.GET) -> HTTPResponse:
+        return self.handler.respond(HTTPRequest(method, uri, HTTPHeaders(headers)))
+
+    def test_conditional(self):
+        resp: HTTPResponse = self.get("/static/data.bin")
+        self.assertEqual((resp.statusCode, bytes(resp.body)), (200, self.content))
+        self.assertEqual(resp.headers["Content-Type"], "application/octet-stream")
+        etag: str = resp.headers["ETag"]
+        self.assertEqual(self.get("/static/data.bin").body, self.content)
+        self.assertEqual((self.handler.hits, self.handler.misses), (1, 1))
+
+        resp304: HTTPResponse = self.get("/static/data.bin", {"If-None-Match": f'"x", {etag}'})
+        self.assertEqual(resp304.statusCode, 304)
+        buff: MemoryByteBuffer = MemoryByteBuffer()
+        resp304.write(buff)
+        data: bytes = buff.export()
+        self.assertTrue(data.startswith(b'HTTP/1.1 304 Not Modified\r\n'))
+        self.assertNotIn(b'Content-Length', data)
+        self.assertNotIn(b'X-Omit-Content-Length', data)
+        self.assertEqual(self.get("/static/data.bin", {"If-None-Match": f'{etag[:-1]}-gzip"'})
+                         .statusCode, 304)  # The compressed variant
+        self.assertEqual(self.get("/static/data.bin", {
+            "If-Modified-Since": resp.headers["Last-Modified"]}).statusCode, 304)
+        self.assertEqual(self.get("/static/data.bin", {
+            "If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"}).statusCode, 200)
+
+        resp = self.get("/static/")
+        self.assertEqual((resp.body, resp.headers["Content-Type"]),
+                         (b'<h1>Index</h1>', "text/html; charset=utf-8"))
+        resp = self.get("/static/data.bin", method=HTTPMethod.HEAD)
+        self.assertEqual((resp.body, resp.headers["Content-Length"]), (b'', "10240"))
+
+    def test_ranges(self):
+        self.assertEqual(parseRange("bytes=0-9, 20-, -5", 100), [(0, 9), (20, 99), (95, 99)])
+        self.assertEqual(parseRange("bytes=200-300", 100), [])
+        self.assertIsNone(parseRange("bytes=5-1", 100))
+        self.assertIsNone(parseRange("items=0-1", 100))
+        self.assertEqual(parseRange("bytes=-100", 0), [])  # An empty file has no last bytes
+
+        resp: HTTPResponse = self.get("/static/data.bin", {"Range": "bytes=100-199"})
+        self.assertEqual((resp.statusCode, resp.headers["Content-Range"]),
+                         (206, "bytes 100-199/10240"))
+        self.assertEqual(bytes(resp.body), self.content[100:200])
+        resp = self.get("/static/data.bin", {"Range": "bytes=99999-"})
+        self.assertEqual((resp.statusCode, resp.headers["Content-Range"]), (416, "bytes */10240"))
+        resp = self.get("/static/data.bin", {"Range": "bytes=0-9", "If-Range": '"old"'})
+        self.assertEqual(resp.statusCode, 200)
+        open(os.path.join(self.root, "empty.txt"), "wb").close()
+        resp = self.get("/static/empty.txt", {"Range": "bytes=-100"})
+        self.assertEqual((resp.statusCode, resp.headers["Content-Range"]), (416, "bytes */0"))
+
+        self.handler.maxCachedSize = 0  # Send the files from the disk
+        resp = self.get("/static/data.bin", {"Range": "bytes=0-1, -3"})
+        self.assertEqual(resp.statusCode, 206)
+        boundary: str = resp.headers["Content-Type"].partition("boundary=")[2]
+        body: bytes = resp.body.export()
+        self.assertIn(b'Content-Range: bytes 10237-10239/10240\r\n\r\n' + self.content[-3:], body)
+        self.assertTrue(body.endswith(f"\r\n--{boundary}--\r\n".encode("utf-8")))
+        resp.body.destroy()
+
+        loop: EventLoop = EventLoop()
+        loop.start()
+        server: HTTPServer = HTTPServer(("127.0.0.1", 0), lambda conn: self.handler)
+        server.listen(eventLoop=loop)
+        try:
+            resp = self.get("/static/data.bin", {"Range": "bytes=1000-4999"})
+            self.assertIsInstance(resp.body, FileRegionByteBuffer)
+            resp.body.destroy()
+            with socket.create_connection(server.sock.getsockname(), timeout=5) as client:
+                client.sendall(b'GET /static/data.bin HTTP/1.1\r\nRange: bytes=1000-4999\r\n\r\n')
+                buff: MemoryByteBuffer = MemoryByteBuffer()
+                parser: HTTPParser = HTTPParser(HTTPResponse)
+                while (resp := self.receive(client, parser, buff)) is None:
+                    pass
+                self.assertEqual(resp.body, self.content[1000:5000])  # Sent by os.sendfile
+        finally:
+            server.close()
+            loop.close()
+
+    @staticmethod
+    def receive(client: socket.socket, parser: HTTPParser,
+                buff: MemoryByteBuffer) -> HTTPResponse | None:
+        buff.write(client.recv(65536))
+        buff.resetPointer()
+        try:
+            return parser.parse(buff)
+        except NeedMoreDataError:
+            return None
+
+    def test_forbidden(self):
+        os.symlink(os.path.join(self.tmp.name, "secret.txt"), os.path.join(self.root, "link"))
+        for uri in ("/static/../secret.txt", "/static/%2e%2e/secret.txt", "/static/link",
+                    "/static/%00", "/other/data.bin"):
+            self.assertEqual(self.get(uri).statusCode, 403, uri)
+        self.assertEqual(self.get("/static/missing").statusCode, 404)
+        resp: HTTPResponse = self.get("/static/data.bin", method=HTTPMethod.POST)
+        self.assertEqual((resp.statusCode, resp.headers["Allow"]), (405, "GET, HEAD"))
+
+    def test_unreadable(self):  # stat() succeeds, but open() or read() fails
+        for error, statusCode in ((PermissionError, 403), (IsADirectoryError, 404),
+                                  (OSError, 404)):
+            with mock.patch.object(self.handler, "_cached", side_effect=error):
+                self.assertEqual(self.get("/static/data.bin").statusCode, statusCode, error)
+                self.assertEqual(self.get("/static/data.bin", {"Range": "bytes=0-1, 5-6"})
+                                 .statusCode, statusCode, error)
@@ -0,0 +1,144 @@
+#  -*- coding: utf-8 -*-
+__author__ = "kubik.augustyn@post.cz"
+
+import json
+import os
+import socket
+import zlib
+from queue import Queue
+from unittest import TestCase
+
+from kutil import MemoryByteBuffer, HTTPServer, EventLoop
+from kutil.protocol.WS import (WSMessage, WSOpcode, WSData, maskData, maskInPlace,
+                               PerMessageDeflate, WSDeflateSession)
+
+
+class TestWS(TestCase):
+    maskingKey: bytes = b'\x12\x34\x56\x78'
+
+    def reference(self, data: bytes) -> bytes:
+        return bytes(byte ^ self.maskingKey[i % 4] for i, byte in enumerate(data))
+
+    def test_mask(self):
+        for length in (0, 1, 3, 4, 5, 125, 126, 65536 + 3):
+            data: bytes = os.urandom(length)
+            self.assertEqual(maskData(data, self.maskingKey), self.reference(data), length)
+            inPlace: bytearray = bytearray(data)
+            maskInPlace(inPlace, self.maskingKey)
+            self.assertEqual(inPlace, self.reference(data))
+            self.assertEqual(maskData(inPlace, self.maskingKey), data)  # Unmasks too
+        self.assertEqual(maskData(b'\x00\x00', self.maskingKey), b'\x12\x34')  # Leading zeros
+
+    def test_frame(self):
+        text: str = "Příliš žluťoučký kůň " * 10
+        msg: WSMessage = WSMessage()
+        msg.opcode = WSOpcode.TEXT_FRAME
+        msg.maskingKey = self.maskingKey
+        msg.payload = WSData(maskData(text.encode("utf-8"), self.maskingKey))  # A client's frame
+        buff: MemoryByteBuffer = MemoryByteBuffer()
+        msg.write(buff)
+        buff.resetPointer()
+
+        received: WSMessage = WSMessage()
+        received.read(buff)
+        self.assertEqual((received.opcode, received.isMasked), (WSOpcode.TEXT_FRAME, True))
+        self.assertEqual(received.payload.text, text)
+        self.assertFalse(buff.has(1))
+        self.assertIsInstance(received.payload.superSecretRawAccess, bytearray)  # Unmasked in place
+
+        given: bytearray = bytearray(b'abc')
+        binary: WSData = WSData(given)
+        given[0] = ord("x")
+        binary.mask(self.maskingKey)
+        self.assertEqual(given, b'xbc')  # Copied on construction, not aliased
+        self.assertIsInstance(binary.raw, bytes)
+        self.assertIs(binary.raw, binary.raw)  # Not copied again
+        self.assertEqual(binary.raw, self.reference(b'abc'))
+        owned: bytearray = bytearray(b'abc')
+        WSData.owning(owned).mask(self.maskingKey)
+        self.assertEqual(owned, self.reference(b'abc'))  # Masked in place
+        self.assertEqual(WSData(MemoryByteBuffer(b'abc')).raw, b'abc')
+
+    def test_deflate_negotiation(self):
+        deflate: PerMessageDeflate = PerMessageDeflate()
+        self.assertIsNone(deflate.negotiate(None))
+        self.assertIsNone(deflate.negotiate("x-webkit-deflate-frame"))
+        session: WSDeflateSession = deflate.negotiate(
+            "permessage-deflate; server_max_window_bits=8, "  # zlib can't do 8
+            "permessage-deflate; client_max_window_bits; server_no_context_takeover")
+        self.assertEqual(session.responseHeader, "permessage-deflate; server_no_context_takeover")
+        self.assertEqual(PerMessageDeflate(clientMaxWindowBits=10).negotiate(
+            "permessage-deflate; client_max_window_bits; server_max_window_bits=12").responseHeader,
+                         "permessage-deflate; server_max_window_bits=12; client_max_window_bits=10")
+        self.assertIsNone(deflate.negotiate("permessage-deflate; unknown"))
+
+        message: bytes = json.dumps({"type": "position", "x": 1, "y": 2}).encode("utf-8") * 10
+        first: bytes = session.compress(message)
+        self.assertEqual(session.compress(message), first)  # No context takeover
+        self.assertEqual(session.decompress(first), message)
+
+    def test_deflate(self):
+        received: Queue = Queue()
+        loop: EventLoop = EventLoop()
+        loop.start()
+        server: HTTPServer = HTTPServer(("127.0.0.1", 0), lambda conn: lambda c, data: received.put(
+            data))
+        server.acceptWebsocket(lambda conn, req: True)
+        server.wsDeflate = PerMessageDeflate(minSize=100)
+        server.listen(eventLoop=loop)
+        try:
+            with socket.create_connection(server.sock.getsockname(), timeout=5) as client:
+                client.sendall(b'GET /ws HTTP/1.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                               b'Sec-WebSocket-Version: 13\r\nSec-WebSocket-Key: dGhlIHNhbXBsZQ==\r\n'
+                               b'Sec-WebSocket-Extensions: permessage-deflate\r\n\r\n')
+                head: bytes = b''
+                while b'\r\n\r\n' not in head:
+                    head += client.recv(65536)
+                self.assertIn(b'\r\nSec-WebSocket-Extensions: permessage-deflate\r\n', head)
+                conn = server.connections[0]
+
+                text: str = json.dumps([{"id": i, "name": "item"} for i in range(20)])
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                for _ in range(2):  # The second one uses the context of the first one
+                    payload: bytes = compressor.compress(text.encode("utf-8")) + compressor.flush(
+                        zlib.Z_SYNC_FLUSH)
+                    msg: WSMessage = WSMessage()
+                    msg.isCompressed = True
+                    msg.maskingKey = self.maskingKey
+                    msg.payload = WSData(maskData(payload[:-4], self.maskingKey))
+                    buff: MemoryByteBuffer = MemoryByteBuffer()
+                    msg.write(buff)
+                    client.sendall(buff.export())
+                    self.assertEqual(received.get(timeout=5).text, text)
+
+                conn.sendData(WSData(text))
+                conn.sendData(WSData("small"))  # Under minSize
+                conn.sendData(WSData(MemoryByteBuffer(b'x' * 1000)))
+                data: MemoryByteBuffer = MemoryByteBuffer()
+                frames: list[WSMessage] = []
+                while len(frames) < 3:
+                    data.write(client.recv(65536))
+                    data.resetPointer()
+                    try:
+                        while data.has(1):
+                            frame: WSMessage = WSMessage()
+                            frame.read(data)
+                            frames.append(frame)
+                            data.resetBeforePointer()
+                    except Exception:
+                        pass
+                self.assertTrue(frames[0].isCompressed)
+                self.assertLess(len(frames[0].payload), len(text) // 2)
+                decompressor = zlib.decompressobj(-15)  # The server keeps the context
+                compressed: bytes = bytes(frames[0].payload.superSecretRawAccess)
+                self.assertEqual(decompressor.decompress(compressed + b'\x00\x00\xff\xff'),
+                                 text.encode("utf-8"))
+                self.assertFalse(frames[1].isCompressed)
+                self.assertEqual(frames[1].payload.text, "small")
+                self.assertEqual((frames[2].opcode, frames[2].isCompressed),
+                                 (WSOpcode.BINARY_FRAME, True))
+                self.assertEqual(decompressor.decompress(
+                    frames[2].payload.raw + b'\x00\x00\xff\xff'), b'x' * 1000)
+        finally:
+            server.close()
+            loop.close()